@@ -0,0 +1,185 @@
+import os
+
+import numpy as np
+from Bio import AlignIO, SeqIO
+from Bio.Align import MultipleSeqAlignment, substitution_matrices
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+import profiling
+
+# BLAST defaults for BLOSUM62: opening a gap costs 11, each further residue 1
+default_gap_open = 11.0
+default_gap_extend = 1.0
+
+_NEG = -1e9
+_blosum62 = substitution_matrices.load("BLOSUM62")
+_alphabet = _blosum62.alphabet
+_residue_codes = {letter: i for i, letter in enumerate(_alphabet)}
+_scores = np.asarray(_blosum62, dtype=np.float64)
+
+
+def encode(seq: str) -> np.ndarray:
+    """Converts a sequence to BLOSUM62 alphabet indices (unknown letters become X)."""
+    unknown = _residue_codes["X"]
+    return np.array([_residue_codes.get(letter, unknown) for letter in seq.upper()], dtype=np.int64)
+
+
+def profile(rows: list) -> np.ndarray:
+    """Returns the (columns x alphabet) residue frequencies of equal-length gapped sequences.
+    Gap positions add nothing, so a column that is half gaps has frequencies summing to 0.5."""
+    length = len(rows[0])
+    freqs = np.zeros((length, len(_alphabet)))
+    for row in rows:
+        positions = np.array([i for i, letter in enumerate(row) if letter != "-"], dtype=np.int64)
+        if positions.size:
+            codes = encode("".join(row[i] for i in positions))
+            np.add.at(freqs, (positions, codes), 1.0)
+    return freqs / len(rows)
+
+
+def affine_align(score_matrix: np.ndarray, gap_open: float = default_gap_open,
+                 gap_extend: float = default_gap_extend):
+    """Global alignment with affine gaps (Gotoh) over a precomputed (n x m) score matrix.
+
+    Each DP row is filled with NumPy operations: match and vertical-gap states only depend
+    on the previous row, and horizontal gaps within a row are a running maximum
+    (np.maximum.accumulate), so there is no Python loop over columns.
+    Returns a list of (i, j) column pairs, with None marking a gap."""
+    n, m = score_matrix.shape
+    cols = np.arange(m + 1)
+
+    match = np.full((n + 1, m + 1), _NEG)
+    vert = np.full((n + 1, m + 1), _NEG)   # residue of the first sequence against a gap
+    horiz = np.full((n + 1, m + 1), _NEG)  # residue of the second sequence against a gap
+    match[0, 0] = 0.0
+    horiz[0, 1:] = -gap_open - (cols[1:] - 1) * gap_extend
+
+    # Traceback pointers: state the cell was reached from (0 match, 1 vert, 2 horiz)
+    tb_match = np.zeros((n + 1, m + 1), dtype=np.int8)
+    tb_vert = np.zeros((n + 1, m + 1), dtype=np.int8)
+    tb_horiz = np.zeros((n + 1, m + 1), dtype=np.int8)
+    tb_horiz[0, 2:] = 2
+
+    for i in range(1, n + 1):
+        # Diagonal moves from the previous row
+        diag = np.stack((match[i - 1, :-1], vert[i - 1, :-1], horiz[i - 1, :-1]))
+        tb_match[i, 1:] = diag.argmax(axis=0)
+        match[i, 1:] = score_matrix[i - 1] + diag.max(axis=0)
+
+        # Vertical gaps also come from the previous row
+        up = np.stack((match[i - 1] - gap_open, vert[i - 1] - gap_extend, horiz[i - 1] - gap_open))
+        tb_vert[i] = up.argmax(axis=0)
+        vert[i] = up.max(axis=0)
+
+        # Horizontal gaps: horiz[j] = max over k < j of (opener[k] - gap_open - (j - 1 - k) * gap_extend)
+        opener_source = (vert[i] > match[i]).astype(np.int8)
+        opener = np.maximum(match[i], vert[i])
+        best_open = np.maximum.accumulate(opener + cols * gap_extend)
+        horiz[i, 1:] = best_open[:-1] - gap_open - (cols[1:] - 1) * gap_extend
+        extended = horiz[i, :-1] - gap_extend > opener[:-1] - gap_open
+        tb_horiz[i, 1:] = np.where(extended, 2, opener_source[:-1])
+
+    # Trace back from the best end state
+    i, j = n, m
+    state = int(np.argmax((match[n, m], vert[n, m], horiz[n, m])))
+    path = []
+    while i > 0 or j > 0:
+        if state == 0:
+            state = tb_match[i, j]
+            path.append((i - 1, j - 1))
+            i, j = i - 1, j - 1
+        elif state == 1:
+            state = tb_vert[i, j]
+            path.append((i - 1, None))
+            i -= 1
+        else:
+            state = tb_horiz[i, j]
+            path.append((None, j - 1))
+            j -= 1
+    path.reverse()
+    return path
+
+
+def align_groups(group_a: list, group_b: list, gap_open: float = default_gap_open,
+                 gap_extend: float = default_gap_extend) -> list:
+    """Aligns two groups of already-aligned sequences (a single sequence is a group of one)
+    by average BLOSUM62 score between their profile columns. Returns the merged gapped rows."""
+    score_matrix = profile(group_a) @ _scores @ profile(group_b).T
+    path = affine_align(score_matrix, gap_open, gap_extend)
+
+    merged_a = ["".join("-" if i is None else row[i] for i, _ in path) for row in group_a]
+    merged_b = ["".join("-" if j is None else row[j] for _, j in path) for row in group_b]
+    return merged_a + merged_b
+
+
+def pairwise_identity(seq_a: str, seq_b: str, gap_open: float = default_gap_open,
+                      gap_extend: float = default_gap_extend) -> float:
+    """Fraction of identical residues over the aligned (non-gap) columns of two sequences."""
+    aligned_a, aligned_b = align_groups([seq_a], [seq_b], gap_open, gap_extend)
+    pairs = [(a, b) for a, b in zip(aligned_a, aligned_b) if a != "-" and b != "-"]
+    if not pairs:
+        return 0.0
+    return sum(a == b for a, b in pairs) / len(pairs)
+
+
+def progressive_align(seqs: list, gap_open: float = default_gap_open,
+                      gap_extend: float = default_gap_extend) -> list:
+    """Progressive multiple alignment: the two closest groups (average pairwise identity)
+    are merged first, until one alignment is left. Rows are returned in input order."""
+    n = len(seqs)
+    if n == 1:
+        return list(seqs)
+
+    distance = np.zeros((n, n))
+    for a in range(n):
+        for b in range(a + 1, n):
+            distance[a, b] = distance[b, a] = 1.0 - pairwise_identity(seqs[a], seqs[b], gap_open, gap_extend)
+
+    # Each group keeps the input indices of its members and their gapped rows
+    groups = [([k], [seq]) for k, seq in enumerate(seqs)]
+    while len(groups) > 1:
+        best = None
+        for a in range(len(groups)):
+            for b in range(a + 1, len(groups)):
+                mean_distance = distance[np.ix_(groups[a][0], groups[b][0])].mean()
+                if best is None or mean_distance < best[0]:
+                    best = (mean_distance, a, b)
+        _, a, b = best
+        members = groups[a][0] + groups[b][0]
+        rows = align_groups(groups[a][1], groups[b][1], gap_open, gap_extend)
+        groups = [group for k, group in enumerate(groups) if k not in (a, b)] + [(members, rows)]
+
+    members, rows = groups[0]
+    by_member = dict(zip(members, rows))
+    return [by_member[k] for k in range(n)]
+
+
+@profiling.profiled
+def align_fasta(fasta_path: str, out_path: str, gap_open: float = default_gap_open,
+                gap_extend: float = default_gap_extend) -> str:
+    """Aligns every sequence in a FASTA file and writes a Clustal-format alignment
+    that convert_to_pir.extract_gapped_seqs() can read. Returns out_path."""
+    records = list(SeqIO.parse(fasta_path, "fasta"))
+    if not records:
+        raise ValueError(f"No sequences found in '{fasta_path}'")
+
+    aligned = progressive_align([str(record.seq) for record in records], gap_open, gap_extend)
+    alignment = MultipleSeqAlignment(
+        SeqRecord(Seq(row), id=record.id, description="") for record, row in zip(records, aligned)
+    )
+    AlignIO.write(alignment, out_path, "clustal")
+    return out_path
+
+
+def align_hybrid_fastas(light_fasta: str, heavy_fasta: str, isotype_label: str, clustal_out_dir: str):
+    """Writes Fab_alignment_{isotype}_light/heavy.aln-clustal for one hybrid's FASTA files.
+    Returns the (light, heavy) alignment file names."""
+    light_clustal_fname = f"Fab_alignment_{isotype_label}_light.aln-clustal"
+    heavy_clustal_fname = f"Fab_alignment_{isotype_label}_heavy.aln-clustal"
+
+    align_fasta(light_fasta, os.path.join(clustal_out_dir, light_clustal_fname))
+    align_fasta(heavy_fasta, os.path.join(clustal_out_dir, heavy_clustal_fname))
+    print(f"Alignments written: {light_clustal_fname}, {heavy_clustal_fname}")
+
+    return (light_clustal_fname, heavy_clustal_fname)
@@ -1,70 +1,157 @@
 # Comparative modeling with multiple templates
 from modeller import *              # Load standard Modeller classes
 from modeller.automodel import *    # Load the AutoModel class
+import my_run_info
 
-log.verbose()    # request verbose output
+import os
+import time
+import pipeline_stages
+import parallel_models
+from model_checkpoint import checkpointed, plain_output, run_seed, checkpoint_file
+from early_stopping import make_until_converged
+from restraint_cache import with_restraint_cache, find_template_files
+from template_superposition import superposed_atom_dirs
+import results_store
+import convert_to_pir
+import profiling
 
 # space reserved here for defining custom parameters `class MyModel(AutoModel):`
 
-env = Environ()  # create a new MODELLER environment to build this model in
 
-# directories for input atom files
-env.io.atom_files_directory = ['.', '../atom_files']
+def main():
+    log.verbose()    # request verbose output
 
-a = AutoModel(env,
-    alnfile  = '../pir_files/pir-alignment-5dk3-monomer-with-AF-hinge-dimertest2.pir', # alignment filename NOTE: import this from other script
-    knowns   = ('IgG4ModellerHingeTemplate'),                          # codes of the templates
-    sequence = 'IgG4FullAbTarget',                             # code of the target (used by MODELLER to name files)
-    assess_methods=(assess.DOPE, assess.GA341)      # assessment methods
-    )           
-a.starting_model= 1                 # index of the first model
-a.ending_model  = 5                 # index of the last model
-                                    # (determines how many models to calculate)
+    # directories for input atom files
+    atom_files_directory = ['.', '../atom_files']
 
-import os
-os.chdir("../models")               # change output directory (this may need changing back to ../Scripts each run)
-a.set_output_model_format("MMCIF")  # request mmCIF rather than PDB outputs
-
-# NOTE a.name is internal and doesnt appear to influence final file naming. Look into `class MyModel(AutoModel)` for more ideas on how to set up custom rules
-from datetime import datetime
-timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-#a.name = f"VC_Hybrid_IgG4_Model_Fab_{timestamp}"
-
-a.initial_malign3d = True           # superpose the 3d structures before modelling
-a.make()                            # do the actual comparative modeling
-
-# Get a list of all successfully built models from a.outputs
-ok_models = [x for x in a.outputs if x['failure'] is None]
-
-# Rank the models by DOPE score
-key = 'DOPE score'
-ok_models.sort(key=lambda a: a[key])
-
-# Top Model
-top_model = ok_models[0]
-print("Top model: %s (DOPE score %.3f)" % (top_model['name'], top_model[key]))
-
-# Preserve the model output (a.output) with pickle
-import pickle
-this_temp_v = "IgG4"
-this_temp_c = "IgG4ModellerHingeTemplate"
-this_target = "IgG4FullAbTarget"
-pickle_counter = 0
-
-
-# Loop until file is written
-while True:
-    
-    # Set this run's pickle file name
-    this_run_pickle_filename = f"model_outputs_{this_temp_v}_{this_temp_c}_{this_target}{pickle_counter}.pkl"
-    
-    # Avoid overwriting if the name already exists using a counter
-    if not os.path.exists(this_run_pickle_filename):
-        break
-    print("File name already exists. Adding a suffix digit.")
-    pickle_counter =+ 1
-    
-
-# Write binary pickle file
-with open(this_run_pickle_filename, "wb") as f:
-    pickle.dump(a.outputs, f)
\ No newline at end of file
+    alnfile = os.path.abspath('../pir_files/pir-alignment-5dk3-monomer-with-AF-hinge-dimertest2.pir') # NOTE: import this from other script
+    knowns = ('IgG4ModellerHingeTemplate')
+    sequence = 'IgG4FullAbTarget'
+    atom_files_directory = [os.path.abspath(d) for d in atom_files_directory]
+
+    # with cache_superposition, templates are superposed once (and reused) instead of by initial_malign3d
+    superposed_dirs = None
+    if my_run_info.cache_superposition:
+        superposed_dirs = superposed_atom_dirs(alnfile, knowns, atom_files_directory)
+    if superposed_dirs is not None:
+        atom_files_directory = superposed_dirs
+
+    starting_model = 1                  # index of the first model
+    ending_model   = 5                  # index of the last model
+                                        # (determines how many models to calculate)
+
+    # Models are written to a directory named by the stage key (alignment contents, template atom files
+    # and settings), so re-running with unchanged inputs reuses the models instead of rebuilding them
+    template_files = find_template_files(knowns, atom_files_directory)
+    models_key = pipeline_stages.stage_key(
+        "models",
+        {"knowns": knowns, "sequence": sequence, "starting_model": starting_model,
+         "ending_model": ending_model, "assess_methods": ["DOPE", "GA341"], "format": "MMCIF",
+         "workers": my_run_info.model_workers, "seed": my_run_info.model_seed,
+         "adaptive": [my_run_info.adaptive_ensemble, my_run_info.dope_patience, my_run_info.dope_margin,
+                      my_run_info.adaptive_min_models, my_run_info.adaptive_batch_size,
+                      my_run_info.model_time_budget, my_run_info.model_cpu_budget]},
+        input_files=[alnfile] + template_files,
+    )
+    models_dir = os.path.abspath(f"../models/{sequence}_{pipeline_stages.short_key(models_key)}")
+    stage_cache_dir = os.path.abspath(my_run_info.stage_cache_dir)
+    results_db = os.path.abspath(my_run_info.results_db)
+    models_manifest = pipeline_stages.load_manifest("models", models_key, stage_cache_dir) if my_run_info.incremental_stages else None
+
+    # a run resuming from its checkpoint gets its own seed, so the missing models don't repeat
+    # the random state of the first ones (model_checkpoint.run_seed)
+    seed = my_run_info.model_seed
+    if my_run_info.checkpoint_models and my_run_info.model_workers <= 1 and models_manifest is None:
+        seed = run_seed(seed, alnfile, knowns, sequence, starting_model, ending_model,
+                        checkpoint_file(sequence, models_dir))
+    env = Environ(rand_seed=seed)       # create a new MODELLER environment to build this model in
+    env.io.atom_files_directory = atom_files_directory
+
+    # with cache_restraints, restraints from an earlier run on the same alignment and templates are reused
+    model_class = with_restraint_cache(AutoModel) if my_run_info.cache_restraints else AutoModel
+    # with checkpoint_models, every finished model is recorded so an interrupted run resumes where it stopped
+    if my_run_info.checkpoint_models:
+        model_class = checkpointed(model_class)
+    # every model build is timed, and recorded as a stage with profiling on (profiling.py)
+    model_class = profiling.with_profiling(model_class)
+    a = model_class(env,
+        alnfile  = alnfile,                 # alignment filename
+        knowns   = knowns,                  # codes of the templates
+        sequence = sequence,                # code of the target (used by MODELLER to name files)
+        assess_methods=(assess.DOPE, assess.GA341)      # assessment methods
+        )
+    a.starting_model = starting_model
+    a.ending_model   = ending_model
+    a.checkpoint_seed = my_run_info.model_seed
+    a.run_seed = seed
+
+    os.makedirs(models_dir, exist_ok=True)
+    os.chdir(models_dir)                # change output directory (this may need changing back to ../Scripts each run)
+    a.set_output_model_format("MMCIF")  # request mmCIF rather than PDB outputs
+
+    # NOTE a.name is internal and doesnt appear to influence final file naming. Look into `class MyModel(AutoModel)` for more ideas on how to set up custom rules
+
+    a.initial_malign3d = superposed_dirs is None  # superpose the 3d structures before modelling (unless done above)
+
+    if models_manifest is not None:
+        print(f"[models] up to date ({pipeline_stages.short_key(models_key)}), reusing {models_dir}")
+        a.outputs = models_manifest["model_outputs"]
+    else:
+        make_start = time.perf_counter()
+        with profiling.stage("make", sequence=sequence, workers=my_run_info.model_workers):
+            if my_run_info.model_workers > 1:
+                # split the model range across worker processes, each in its own subdirectory of models_dir
+                ensemble = dict(
+                    alnfile=alnfile, knowns=knowns, sequence=sequence, label=sequence,
+                    starting_model=a.starting_model, ending_model=a.ending_model,
+                    atom_files_directory=env.io.atom_files_directory, initial_malign3d=a.initial_malign3d,
+                )
+                if my_run_info.adaptive_ensemble:
+                    a.outputs = parallel_models.run_until_converged(ensemble, out_dir=models_dir)
+                else:
+                    jobs = parallel_models.ensemble_jobs(**ensemble, n_jobs=my_run_info.model_workers, out_dir=models_dir)
+                    a.outputs = parallel_models.run_parallel(jobs, my_run_info.model_workers).get(sequence, [])
+            elif my_run_info.adaptive_ensemble:
+                make_until_converged(a)     # build models until the best DOPE score stops improving
+            else:
+                a.make()                    # do the actual comparative modeling
+        make_elapsed = time.perf_counter() - make_start
+        pipeline_stages.record_stage(
+            "models", models_key,
+            {x['name']: os.path.join(models_dir, x['name']) for x in a.outputs if x['failure'] is None},
+            extra={"model_outputs": [plain_output(x) for x in a.outputs]},
+            cache_dir=stage_cache_dir,
+        )
+
+    # Get a list of all successfully built models from a.outputs
+    ok_models = [x for x in a.outputs if x['failure'] is None]
+
+    # Rank the models by DOPE score
+    key = 'DOPE score'
+    ok_models.sort(key=lambda a: a[key])
+
+    # Top Model
+    top_model = ok_models[0]
+    print("Top model: %s (DOPE score %.3f)" % (top_model['name'], top_model[key]))
+
+    # Store the model outputs (a.outputs) with their scores in the results database
+    this_temp_v = "IgG4"
+    this_temp_c = "IgG4ModellerHingeTemplate"
+    this_target = "IgG4FullAbTarget"
+    # isotype of the constant region template, named in the alignment (None if it isn't)
+    this_isotype = convert_to_pir.pir_isotype(alnfile)
+
+    if my_run_info.store_model_results and models_manifest is None:
+        run_id = results_store.record_run(
+            a.outputs, target=this_target, template_v=this_temp_v, template_c=this_temp_c, knowns=knowns,
+            isotype=this_isotype, alignment_path=alnfile, models_dir=models_dir, elapsed_s=make_elapsed,
+            db_path=results_db,
+        )
+        print(f"Model results stored as run {run_id}")
+
+    profiling.finish("build_models")    # writes the trace and summary if profiling is on
+
+
+# Guarded so worker processes started by parallel_models can import this file without building models
+if __name__ == "__main__":
+    main()
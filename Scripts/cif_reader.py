@@ -0,0 +1,244 @@
+import gzip
+import json
+import os
+import re
+
+import numpy as np
+
+from file_hashes import file_sha256
+
+# A quoted CIF value only ends at a quote followed by whitespace, e.g. "O5'" or 'N1"'
+_token_pattern = re.compile(r"""'(?:[^']|'(?=\S))*'|"(?:[^"]|"(?=\S))*"|\S+""")
+
+
+def open_cif(path: str):
+    """Opens a .cif or .cif.gz file for reading text."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path)
+
+
+def split_cif_line(line: str) -> list:
+    """Splits one line of a CIF loop into values, removing quotes."""
+    if "'" not in line and '"' not in line:
+        return line.split()
+    tokens = []
+    for token in _token_pattern.findall(line):
+        if len(token) > 1 and token[0] == token[-1] and token[0] in "'\"":
+            token = token[1:-1]
+        tokens.append(token)
+    return tokens
+
+
+def atom_site_loop(handle):
+    """Finds the _atom_site loop in an open CIF file.
+    Returns (field names, iterator over rows as lists of values). Rows are read lazily,
+    so callers can stop as soon as they have what they need. Returns ([], empty iterator)
+    if the file has no _atom_site loop."""
+    fields = []
+    in_loop = False
+    line = ""
+
+    for line in handle:
+        stripped = line.strip()
+        if stripped == "loop_":
+            in_loop = True
+            fields = []
+            continue
+        if in_loop and stripped.startswith("_"):
+            if stripped.startswith("_atom_site."):
+                fields.append(stripped.split()[0][len("_atom_site."):])
+                continue
+            if fields:
+                break
+            in_loop = False
+            continue
+        if fields:
+            break
+        in_loop = False
+
+    if not fields:
+        return [], iter(())
+
+    return fields, _loop_rows(handle, len(fields), line)
+
+
+def _loop_rows(handle, n_fields: int, first_line: str):
+    """Yields loop rows until the loop ends, joining rows that span several lines
+    (including ;-delimited text fields)."""
+    values = []
+    lines = _chain_first(first_line, handle)
+
+    for line in lines:
+        if line.startswith(";"):
+            # Multi-line text value
+            text = [line[1:].rstrip("\n")]
+            for text_line in lines:
+                if text_line.startswith(";"):
+                    break
+                text.append(text_line.rstrip("\n"))
+            values.append("\n".join(text))
+        else:
+            stripped = line.strip()
+            if not values and (not stripped or stripped.startswith(("#", "_", "loop_", "data_"))):
+                return
+            values.extend(split_cif_line(stripped))
+
+        while len(values) >= n_fields:
+            yield values[:n_fields]
+            values = values[n_fields:]
+
+
+def _chain_first(first_line: str, handle):
+    yield first_line
+    yield from handle
+
+
+def read_chain_order(cif_path: str) -> list:
+    """Returns chain IDs (auth_asym_id, as Biopython's MMCIFParser uses) in the order they first
+    appear in the first model. Only the _atom_site loop is read, and reading stops when the
+    first model ends."""
+    with open_cif(cif_path) as handle:
+        fields, rows = atom_site_loop(handle)
+        if not fields:
+            return []
+
+        chain_col = fields.index("auth_asym_id") if "auth_asym_id" in fields else fields.index("label_asym_id")
+        model_col = fields.index("pdbx_PDB_model_num") if "pdbx_PDB_model_num" in fields else None
+
+        chain_order = []
+        seen = set()
+        first_model = None
+        for row in rows:
+            if model_col is not None:
+                if first_model is None:
+                    first_model = row[model_col]
+                elif row[model_col] != first_model:
+                    break
+            if row[chain_col] not in seen:
+                seen.add(row[chain_col])
+                chain_order.append(row[chain_col])
+    return chain_order
+
+
+def _field(fields: list, *names):
+    """Index of the first of `names` present in the loop, or None."""
+    for name in names:
+        if name in fields:
+            return fields.index(name)
+    return None
+
+
+def read_atoms(cif_path: str) -> dict:
+    """Reads the atoms of the first model of a .cif file into NumPy arrays:
+    group ("ATOM"/"HETATM"), chain, resseq, icode, resname, atom, altloc (str arrays, "" for missing)
+    and coords (n x 3 float64). Author (auth_*) identifiers are used where present, as MODELLER does."""
+    with open_cif(cif_path) as handle:
+        fields, rows = atom_site_loop(handle)
+        if not fields:
+            raise ValueError(f"No _atom_site loop in '{cif_path}'")
+
+        columns = {
+            "group": _field(fields, "group_PDB"),
+            "chain": _field(fields, "auth_asym_id", "label_asym_id"),
+            "resseq": _field(fields, "auth_seq_id", "label_seq_id"),
+            "icode": _field(fields, "pdbx_PDB_ins_code"),
+            "resname": _field(fields, "auth_comp_id", "label_comp_id"),
+            "atom": _field(fields, "auth_atom_id", "label_atom_id"),
+            "altloc": _field(fields, "label_alt_id"),
+        }
+        xyz = [fields.index("Cartn_x"), fields.index("Cartn_y"), fields.index("Cartn_z")]
+        model_col = _field(fields, "pdbx_PDB_model_num")
+
+        values = {name: [] for name in columns}
+        coords = []
+        first_model = None
+        for row in rows:
+            if model_col is not None:
+                if first_model is None:
+                    first_model = row[model_col]
+                elif row[model_col] != first_model:
+                    break
+            for name, col in columns.items():
+                value = row[col] if col is not None else ""
+                values[name].append("" if value in ("?", ".") else value)
+            coords.append([row[i] for i in xyz])
+
+    atoms = {name: np.array(column, dtype=str) for name, column in values.items()}
+    atoms["coords"] = np.array(coords, dtype=np.float64).reshape(-1, 3)
+    return atoms
+
+
+def cached_chain_order(cif_path: str, cache_path: str) -> list:
+    """read_chain_order() with a json cache keyed by the file's sha256,
+    so renamed or copied templates are not read again and edited ones are."""
+    key = file_sha256(cif_path)
+
+    cache = {}
+    if os.path.isfile(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    if key in cache:
+        return cache[key]
+
+    chain_order = read_chain_order(cif_path)
+    if chain_order:
+        cache[key] = chain_order
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=1)
+        os.replace(tmp_path, cache_path)
+
+    return chain_order
+
+
+def write_transformed_cif(cif_path: str, out_path: str, rotation: np.ndarray, translation: np.ndarray):
+    """Copies a .cif file with every _atom_site coordinate moved by the rigid transform
+    (coords @ rotation.T + translation). Everything else in the file is kept as it is.
+    Expects one atom per line, as in PDB-issued mmCIF files."""
+    with open_cif(cif_path) as handle:
+        lines = handle.readlines()
+
+    fields = []
+    xyz = None
+    row_lines = []
+    in_loop = False
+    for n, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped == "loop_":
+            if xyz is not None:
+                break
+            in_loop = True
+            fields = []
+            continue
+        if in_loop and stripped.startswith("_atom_site."):
+            fields.append(stripped.split()[0][len("_atom_site."):])
+            continue
+        if in_loop and fields and xyz is None:
+            xyz = [fields.index("Cartn_x"), fields.index("Cartn_y"), fields.index("Cartn_z")]
+        if xyz is not None:
+            if not stripped or stripped.startswith(("#", "_", "loop_", "data_")):
+                break
+            row_lines.append(n)
+        elif in_loop and not stripped.startswith("_"):
+            in_loop = False
+
+    if xyz is None:
+        raise ValueError(f"No _atom_site loop in '{cif_path}'")
+
+    rows = [_token_pattern.findall(lines[n]) for n in row_lines]
+    if any(len(row) != len(fields) for row in rows):
+        raise ValueError(f"'{cif_path}' has _atom_site rows split over several lines")
+
+    coords = np.array([[row[i] for i in xyz] for row in rows], dtype=np.float64).reshape(-1, 3)
+    moved = coords @ rotation.T + translation
+    for n, row, new_xyz in zip(row_lines, rows, moved):
+        for i, value in zip(xyz, new_xyz):
+            row[i] = f"{value:.3f}"
+        lines[n] = " ".join(row) + "\n"
+
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.writelines(lines)
+    os.replace(tmp_path, out_path)
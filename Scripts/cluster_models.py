@@ -0,0 +1,174 @@
+# All-vs-all RMSD of an ensemble and k-medoids clustering, to see whether the models explore
+# different conformations (e.g. of the hinge) rather than only ranking them by DOPE.
+# The N x N matrix is filled in blocks of block_size x block_size model pairs, each superposed
+# in one vectorised pass, so memory stays bounded and there is no Python loop over pairs.
+#
+# Usage (from the Scripts directory):
+#   python cluster_models.py --alnfile ../pir_files/<alignment>.pir --region hinge --max-k 8
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import my_run_info
+from convert_to_pir import read_pir
+from evaluate_models import split_entries, residue_regions, find_models, load_models, backbone_atoms
+
+
+def pairwise_rmsd(coords: np.ndarray, block_size: int = 256, out: np.ndarray = None) -> np.ndarray:
+    """RMSD after optimal superposition between every pair of coordinate sets in coords (N x n x 3).
+    Returns a symmetric float32 N x N matrix; pass a np.memmap as `out` for ensembles too large for memory."""
+    n_models, n_atoms, _ = coords.shape
+    centred = coords - coords.mean(axis=1, keepdims=True)
+    norms = (centred ** 2).sum(axis=(1, 2))
+    if out is None:
+        out = np.zeros((n_models, n_models), dtype=np.float32)
+
+    for i in range(0, n_models, block_size):
+        block_i = centred[i:i + block_size]
+        for j in range(i, n_models, block_size):
+            block_j = centred[j:j + block_size]
+            # (block_i x block_j x 3 x 3) covariance matrices of every pair in the block, as one matrix product
+            a, b = len(block_i), len(block_j)
+            product = block_i.transpose(0, 2, 1).reshape(a * 3, n_atoms) @ block_j.transpose(1, 0, 2).reshape(n_atoms, b * 3)
+            covariance = product.reshape(a, 3, b, 3).transpose(0, 2, 1, 3)
+            # only the singular values are needed; a negative determinant means the best fit is a reflection
+            s = np.linalg.svd(covariance, compute_uv=False)
+            s[..., -1] *= np.sign(np.linalg.det(covariance))
+            squared = norms[i:i + block_size, None] + norms[None, j:j + block_size] - 2 * s.sum(axis=-1)
+            rmsd = np.sqrt(np.maximum(squared, 0.0) / n_atoms)
+
+            out[i:i + block_size, j:j + block_size] = rmsd
+            out[j:j + block_size, i:i + block_size] = rmsd.T
+    np.fill_diagonal(out, 0.0)
+    return out
+
+
+def k_medoids(distances: np.ndarray, k: int, max_iter: int = 100, seed: int = 0):
+    """Clusters by k-medoids (k-medoids++ start, then alternating assignment and medoid update).
+    Returns (medoid indices, cluster label of every item)."""
+    n = len(distances)
+    k = min(k, n)
+    rng = np.random.default_rng(seed)
+
+    medoids = [int(rng.integers(n))]
+    for _ in range(1, k):
+        nearest = distances[:, medoids].min(axis=1).astype(np.float64) ** 2
+        if nearest.sum() == 0:
+            break
+        medoids.append(int(rng.choice(n, p=nearest / nearest.sum())))
+    medoids = np.array(medoids)
+
+    for _ in range(max_iter):
+        labels = distances[:, medoids].argmin(axis=1)
+        new_medoids = medoids.copy()
+        for c in range(len(medoids)):
+            members = np.flatnonzero(labels == c)
+            if members.size:
+                new_medoids[c] = members[distances[np.ix_(members, members)].sum(axis=1).argmin()]
+        if np.array_equal(new_medoids, medoids):
+            break
+        medoids = new_medoids
+
+    return medoids, distances[:, medoids].argmin(axis=1)
+
+
+def silhouette(distances: np.ndarray, labels: np.ndarray) -> float:
+    """Mean silhouette width of a clustering (0 if there is only one cluster)."""
+    clusters = np.unique(labels)
+    if len(clusters) < 2:
+        return 0.0
+    # mean distance from every item to every cluster
+    mean_to = np.stack([distances[:, labels == c].mean(axis=1) for c in clusters], axis=1)
+    sizes = np.array([(labels == c).sum() for c in clusters])
+    own = np.searchsorted(clusters, labels)
+    rows = np.arange(len(labels))
+
+    # exclude the item itself from its own cluster's mean
+    own_size = sizes[own]
+    a = np.where(own_size > 1, mean_to[rows, own] * own_size / np.maximum(own_size - 1, 1), 0.0)
+    mean_to[rows, own] = np.inf
+    b = mean_to.min(axis=1)
+    width = np.where(own_size > 1, (b - a) / np.maximum(a, b), 0.0)
+    return float(width.mean())
+
+
+def cluster_ensemble(distances: np.ndarray, k: int = None, max_k: int = 8, seed: int = 0):
+    """k-medoids with a fixed k, or the k in 2..max_k with the best silhouette.
+    Returns (medoids, labels, k, silhouette)."""
+    candidates = [k] if k else range(2, min(max_k, len(distances) - 1) + 1)
+    best = None
+    for n_clusters in candidates:
+        medoids, labels = k_medoids(distances, n_clusters, seed=seed)
+        score = silhouette(distances, labels)
+        if best is None or score > best[3]:
+            best = (medoids, labels, n_clusters, score)
+    if best is None:
+        return np.array([0]), np.zeros(len(distances), dtype=np.int64), 1, 0.0
+    return best
+
+
+def summarise_clusters(distances: np.ndarray, medoids: np.ndarray, labels: np.ndarray, model_paths: list) -> pd.DataFrame:
+    """One row per cluster: its representative (medoid) model, size and spread."""
+    rows = []
+    for c, medoid in enumerate(medoids):
+        members = np.flatnonzero(labels == c)
+        rows.append({
+            "cluster": c,
+            "size": len(members),
+            "representative": model_paths[medoid],
+            "mean_rmsd_to_representative": float(distances[members, medoid].mean()),
+            "max_rmsd_to_representative": float(distances[members, medoid].max()),
+        })
+    return pd.DataFrame(rows).sort_values("size", ascending=False, ignore_index=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="All-vs-all RMSD and k-medoids clustering of a model ensemble.")
+    parser.add_argument("--alnfile", required=True, help=".pir alignment the models were built from")
+    parser.add_argument("--models-dir", default=my_run_info.models_out_dir)
+    parser.add_argument("--models", nargs="+", help="Model files (default: every model of the target in --models-dir)")
+    parser.add_argument("--region", help="Only compare this region (VL, CL, VH, CH1 or hinge), e.g. hinge")
+    parser.add_argument("--atoms", choices=["CA", "backbone"], default="CA")
+    parser.add_argument("--k", type=int, help="Number of clusters (default: best silhouette up to --max-k)")
+    parser.add_argument("--max-k", type=int, default=8)
+    parser.add_argument("--block-size", type=int, default=256, help="Models per block of the RMSD matrix")
+    parser.add_argument("--store", help="Coordinate store of the models (coord_store.py --models), instead of parsing each file")
+    parser.add_argument("--out-prefix", help="Prefix of the output files (default: in --models-dir)")
+    args = parser.parse_args(argv)
+
+    target, templates = split_entries(read_pir(args.alnfile))
+    model_paths = args.models or find_models(args.models_dir, target["code"])
+    coords, loaded = load_models(model_paths, sum(c.isalpha() for c in target["sequence"]), args.store, args.models_dir)
+    if len(loaded) < 2:
+        parser.error("need at least 2 models to cluster")
+
+    if args.region:
+        regions = residue_regions(target, templates)
+        if len(regions.get(args.region, ())) == 0:
+            parser.error(f"region {args.region} not found, available: {', '.join(name for name, r in regions.items() if len(r))}")
+        coords = coords[:, regions[args.region]]
+    atoms = [backbone_atoms.index("CA")] if args.atoms == "CA" else list(range(len(backbone_atoms)))
+    coords = coords[:, :, atoms].reshape(len(loaded), -1, 3)
+    coords = coords[:, ~np.isnan(coords).any(axis=(0, 2))]
+
+    distances = pairwise_rmsd(coords, args.block_size)
+    medoids, labels, k, score = cluster_ensemble(distances, args.k, args.max_k)
+    df_clusters = summarise_clusters(distances, medoids, labels, loaded)
+
+    prefix = args.out_prefix or os.path.join(
+        args.models_dir, f"clusters_{target['code']}{'_' + args.region if args.region else ''}"
+        )
+    np.save(f"{prefix}_rmsd.npy", distances)
+    pd.DataFrame({"model": loaded, "cluster": labels}).to_csv(f"{prefix}_members.csv", index=False)
+    df_clusters.to_csv(f"{prefix}_summary.csv", index=False)
+
+    print(f"{len(loaded)} models, {k} clusters (silhouette {score:.2f})")
+    print(df_clusters.to_string(index=False))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,7 +1,12 @@
 import pandas as pd
 import os
+import re
 from Bio.PDB.MMCIFParser import MMCIFParser
 from Bio import AlignIO
+from vcab_index import VCAbIndex
+import cif_reader
+import my_run_info
+import profiling
 
 def merge_df_for_pir(df_light, df_heavy):
     """# Combine heavy and light chain dataframes into one for .pir creation."""
@@ -26,7 +31,8 @@ def merge_df_for_pir(df_light, df_heavy):
     return df_combined
 
 
-def cif_parse(pdb: str, cif_fname: str, filepath: str):
+@profiling.profiled
+def cif_parse(pdb: str, cif_fname: str, filepath: str, cache_path: str = my_run_info.cif_chain_order_cache):
     """Parses .cif and determines correct chain order for MODELLER."""
     from Bio.PDB.MMCIFParser import MMCIFParser
     import os
@@ -34,7 +40,13 @@ def cif_parse(pdb: str, cif_fname: str, filepath: str):
     # Set full path
     full_cif_path = os.path.join(filepath, cif_fname)
 
-    # Initialise parser
+    # Fast path: read only the chain column of the first model's _atom_site loop (cached by file hash)
+    cif_chain_order = cif_reader.cached_chain_order(full_cif_path, cache_path)
+    if cif_chain_order:
+        print(cif_chain_order)
+        return cif_chain_order
+
+    # Fall back to a full Biopython parse for files the fast reader can't handle
     parser = MMCIFParser(QUIET=True)
 
     # Load structure
@@ -54,37 +66,21 @@ def cif_parse(pdb: str, cif_fname: str, filepath: str):
 def relevant_chains(df, v_cif_chain_order, c_cif_chain_order, v_template, c_template):
     """Extracts relevant chain info from dataframe"""
 
-    # Using iterrows for stable behaviour in pandas
-    for idx, row in df.iterrows():
-        if row["pdb"] == v_template:
-            l_chain_letter = row["Lchain"]
-            h_chain_letter = row["Hchain"]
-
-            v_relevant_chains = [chain_id for chain_id in v_cif_chain_order if chain_id in (h_chain_letter, l_chain_letter)]
-            print(v_relevant_chains)
-
-            if v_relevant_chains[0] == l_chain_letter:
-                # assign True/False to light_chain_is_first column
-                df.at[idx, "light_chain_is_first"] = True
-                df.at[idx, "start_point"] = int(row["L_chain_first_residue"])
-                df.at[idx, "start_letter"] = row["Lchain"]
-                df.at[idx, "end_point"] = int(row["H_chain_last_residue"])
-                df.at[idx, "end_letter"] = row["Hchain"]
-            else:
-                df.at[idx, "light_chain_is_first"] = False
-                df.at[idx, "start_point"] = int(row["H_chain_first_residue"])
-                df.at[idx, "start_letter"] = row["Hchain"]
-                df.at[idx, "end_point"] = int(row["L_chain_last_residue"])
-                df.at[idx, "end_letter"] = row["Lchain"]
+    # Look up the template rows by PDB code instead of scanning every row
+    index = VCAbIndex(df)
 
-        if row["pdb"] == c_template:
+    for template, cif_chain_order in ((v_template, v_cif_chain_order), (c_template, c_cif_chain_order)):
+        for pos in index.positions(template):
+            idx = df.index[pos]
+            row = df.loc[idx]
             l_chain_letter = row["Lchain"]
             h_chain_letter = row["Hchain"]
 
-            c_relevant_chains = [chain_id for chain_id in c_cif_chain_order if chain_id in (h_chain_letter, l_chain_letter)]
-            print(c_relevant_chains)
+            template_relevant_chains = [chain_id for chain_id in cif_chain_order if chain_id in (h_chain_letter, l_chain_letter)]
+            print(template_relevant_chains)
 
-            if c_relevant_chains[0] == l_chain_letter:
+            if template_relevant_chains[0] == l_chain_letter:
+                # assign True/False to light_chain_is_first column
                 df.at[idx, "light_chain_is_first"] = True
                 df.at[idx, "start_point"] = int(row["L_chain_first_residue"])
                 df.at[idx, "start_letter"] = row["Lchain"]
@@ -99,6 +95,7 @@ def relevant_chains(df, v_cif_chain_order, c_cif_chain_order, v_template, c_temp
     return df
 
 
+@profiling.profiled
 def extract_gapped_seqs(df, msa_filepath, light_clustal_fname, heavy_clustal_fname):
     """Parses .aln-clustal files with Bio.AlignIO and extracts the gapped sequences."""
     
@@ -114,16 +111,19 @@ def extract_gapped_seqs(df, msa_filepath, light_clustal_fname, heavy_clustal_fna
     light_seqs = load_gapped_seqs(light_clustal_fname)
     heavy_seqs = load_gapped_seqs(heavy_clustal_fname)
     
+    # Map every row to its gapped sequences in one pass
+    pdb = df["pdb"].str.lower()
+    light_gapped = pdb.map(light_seqs).fillna("").str.replace("\n", "")
+    heavy_gapped = pdb.map(heavy_seqs).fillna("").str.replace("\n", "")
+
     # Assign sequences to gapped_seq_1 and gapped_seq_2 if 
     # light_chain_is_first is True, otherwise 2 then 1
-    for idx, row in df.iterrows():
-        pdb = row["pdb"].lower()
-        if row["light_chain_is_first"] is True:
-            df.at[idx, "gapped_seq_1"] = light_seqs.get(pdb, "").replace("\n", "")
-            df.at[idx, "gapped_seq_2"] = heavy_seqs.get(pdb, "").replace("\n", "")
-        elif row["light_chain_is_first"] is False:
-            df.at[idx, "gapped_seq_1"] = heavy_seqs.get(pdb, "").replace("\n", "")
-            df.at[idx, "gapped_seq_2"] = light_seqs.get(pdb, "").replace("\n", "")
+    light_first = df["light_chain_is_first"].map(lambda value: value is True)
+    heavy_first = df["light_chain_is_first"].map(lambda value: value is False)
+    df.loc[light_first, "gapped_seq_1"] = light_gapped[light_first]
+    df.loc[light_first, "gapped_seq_2"] = heavy_gapped[light_first]
+    df.loc[heavy_first, "gapped_seq_1"] = heavy_gapped[heavy_first]
+    df.loc[heavy_first, "gapped_seq_2"] = light_gapped[heavy_first]
 
     # Handle Fab_hybrid row manually by finding the target row
     hybrid_idx = df[df["pdb"].str.lower() == "fab_hybrid"].index
@@ -134,6 +134,7 @@ def extract_gapped_seqs(df, msa_filepath, light_clustal_fname, heavy_clustal_fna
 
     return df
 
+@profiling.profiled
 def write_modeller_pir(
         df: pd.DataFrame, 
         out_path: str,
@@ -142,36 +143,82 @@ def write_modeller_pir(
         isotype_label: str
         ):
     """Writes a .pir file from a df containing gapped sequences"""
-    
-    with open(out_path, "w") as pir:
-        for _, row in df.iterrows():
-            if row["pdb"] == v_template:
-                
-                v_pir_header = (
-                    f">P1;{row['pdb']}\n"
-                    f"structureX:{row['pdb']}:{row["start_point"]}:{row["start_letter"]}:{row["end_point"]}:{row["end_letter"]}"
-                    f":variable_template:::\n"
-                )
-                v_gapped_sequence = (f"{row['gapped_seq_1']}/{row['gapped_seq_2']}*\n")
-
-            if row["pdb"] == c_template:
-
-                c_pir_header = (
-                    f">P1;{row['pdb']}\n"
-                    f"structureX:{row['pdb']}:{row["start_point"]}:{row["start_letter"]}:{row["end_point"]}:{row["end_letter"]}"
-                    f":constant_template_{isotype_label}:::\n"
-                )
-                c_gapped_sequence = (f"{row['gapped_seq_1']}/{row['gapped_seq_2']}*\n")
-
-            if row["template"] == "target":
-
-                target_pir_header = (
-                    f">P1;{row['pdb']}_{isotype_label}_target\n"
-                    f"sequence:{row['pdb']}_{isotype_label}_target::.::.:hybrid_{isotype_label}_target:::\n"
-                )
-                target_gapped_sequence = (f"{row['gapped_seq_1']}/{row['gapped_seq_2']}*")
 
+    index = VCAbIndex(df)
+    v_row = index.row(v_template)
+    c_row = index.row(c_template)
+    target_row = df[df["template"] == "target"].iloc[-1]
+
+    v_pir_header = (
+        f">P1;{v_row['pdb']}\n"
+        f"structureX:{v_row['pdb']}:{v_row['start_point']}:{v_row['start_letter']}:{v_row['end_point']}:{v_row['end_letter']}"
+        f":variable_template:::\n"
+    )
+    v_gapped_sequence = (f"{v_row['gapped_seq_1']}/{v_row['gapped_seq_2']}*\n")
+
+    c_pir_header = (
+        f">P1;{c_row['pdb']}\n"
+        f"structureX:{c_row['pdb']}:{c_row['start_point']}:{c_row['start_letter']}:{c_row['end_point']}:{c_row['end_letter']}"
+        f":constant_template_{isotype_label}:::\n"
+    )
+    c_gapped_sequence = (f"{c_row['gapped_seq_1']}/{c_row['gapped_seq_2']}*\n")
+
+    target_pir_header = (
+        f">P1;{target_row['pdb']}_{isotype_label}_target\n"
+        f"sequence:{target_row['pdb']}_{isotype_label}_target::.::.:hybrid_{isotype_label}_target:::\n"
+    )
+    target_gapped_sequence = (f"{target_row['gapped_seq_1']}/{target_row['gapped_seq_2']}*")
+
+    with open(out_path, "w") as pir:
         pir.write(v_pir_header + v_gapped_sequence)
         pir.write(c_pir_header + c_gapped_sequence)
         pir.write(target_pir_header + target_gapped_sequence)
 
+
+def read_pir(pir_path: str) -> list:
+    """Reads a MODELLER .pir alignment into a list of entries, each a dict with the
+    code, the header fields (split on ':') and the gapped sequence (without the final '*')."""
+    entries = []
+    with open(pir_path) as f:
+        lines = [line.rstrip("\n") for line in f]
+
+    i = 0
+    while i < len(lines):
+        if not lines[i].startswith(">P1;"):
+            i += 1
+            continue
+        code = lines[i][4:].strip()
+        header = lines[i + 1].split(":")
+        sequence = []
+        i += 2
+        while i < len(lines) and not lines[i].startswith(">P1;"):
+            sequence.append(lines[i].strip())
+            if lines[i].rstrip().endswith("*"):
+                break
+            i += 1
+        entries.append({
+            "code": code,
+            "type": header[0],
+            "header": header,
+            "sequence": "".join(sequence).rstrip("*"),
+        })
+        i += 1
+    return entries
+
+
+def pir_isotype(pir_path: str):
+    """Isotype of the constant region template of a .pir alignment, from the "constant_template_{isotype}"
+    field written by write_modeller_pir(), or else from an isotype in the entry codes or headers
+    (e.g. "IgG4ModellerHingeTemplate"). Returns None if no isotype is named."""
+    entries = read_pir(pir_path)
+    for entry in entries:
+        for field in entry["header"]:
+            if field.startswith("constant_template_"):
+                return field[len("constant_template_"):]
+    # templates first, then the target
+    for entry in sorted(entries, key=lambda entry: entry["type"] == "sequence"):
+        for text in [entry["code"]] + entry["header"]:
+            match = re.search(r"Ig(?:G[1-4]|A[12]|[AGMDE])", text)
+            if match:
+                return match.group(0)
+    return None
@@ -0,0 +1,386 @@
+# Compact, memory-mapped atom tables for templates and models.
+# Many structures (e.g. every template in atom_files, or every model of an ensemble) are parsed once
+# from mmCIF and written to a single binary file: a JSON header followed by flat arrays of float32
+# coordinates, per-atom name and residue indexes, per-residue numbering and atom offsets, and
+# per-chain residue offsets. Opening the file only maps it, and chains or residue ranges are
+# returned as views of the mapped coordinates without copying, e.g.
+#   store = CoordStore("../pipeline_cache/coords/templates.coords")
+#   store.coords("1n8z", chain="B", start=118, end=220)             # all atoms, a view
+#   store.coords("1n8z", chain="B", start=118, end=220, atom="CA")  # CA atoms only
+#   store.ensemble(atom="CA")                                       # models x CA atoms x 3
+#
+# Usage (from the Scripts directory):
+#   python coord_store.py --templates                      # every .cif in cif_dir
+#   python coord_store.py --models --sequence IgG4FullAbTarget
+#   python coord_store.py --info ../pipeline_cache/coords/templates.coords
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import cif_reader
+import my_run_info
+import pipeline_stages
+
+_magic = b"COORDST1"
+_alignment = 64  # byte alignment of every array in the file
+format_version = 1
+
+
+def _first_altloc(atoms: dict) -> np.ndarray:
+    """Mask of the atoms to keep: no alternate location, or the first one (A or 1)."""
+    return np.isin(atoms["altloc"], ["", "A", "1"])
+
+
+def _table(atoms: dict) -> dict:
+    """Turns read_atoms() output into residue and chain runs (in file order) for one structure."""
+    keep = _first_altloc(atoms)
+    chain = atoms["chain"][keep]
+    resseq = atoms["resseq"][keep]
+    icode = atoms["icode"][keep]
+
+    # A new residue starts wherever chain, number or insertion code changes
+    new_residue = np.ones(len(chain), dtype=bool)
+    new_residue[1:] = (chain[1:] != chain[:-1]) | (resseq[1:] != resseq[:-1]) | (icode[1:] != icode[:-1])
+    residue_starts = np.flatnonzero(new_residue)
+
+    residue_chain = chain[residue_starts]
+    new_chain = np.ones(len(residue_starts), dtype=bool)
+    new_chain[1:] = residue_chain[1:] != residue_chain[:-1]
+    chain_starts = np.flatnonzero(new_chain)
+
+    return {
+        "coords": atoms["coords"][keep].astype(np.float32),
+        "atom": atoms["atom"][keep],
+        "residue_starts": residue_starts,
+        "resseq": np.array([int(n) if n.lstrip("-").isdigit() else 0 for n in resseq[residue_starts]], dtype=np.int32),
+        "icode": np.char.encode(icode[residue_starts], "ascii").astype("S1"),
+        "resname": atoms["resname"][keep][residue_starts],
+        "hetero": atoms["group"][keep][residue_starts] == "HETATM",
+        "chain_starts": chain_starts,
+        "chain_ids": residue_chain[chain_starts].tolist(),
+    }
+
+
+def write_store(out_path: str, structures, key: str = None):
+    """Writes (name, read_atoms() dict) pairs to one coordinate store file.
+    `key` (the stage key of the files it was built from) is kept in the header."""
+    tables = [(name, _table(atoms)) for name, atoms in structures]
+    atom_names = sorted({name for _, table in tables for name in np.unique(table["atom"]).tolist()})
+    resnames = sorted({name for _, table in tables for name in np.unique(table["resname"]).tolist()})
+    atom_codes = {name: i for i, name in enumerate(atom_names)}
+    resname_codes = {name: i for i, name in enumerate(resnames)}
+
+    n_atoms = sum(len(table["coords"]) for _, table in tables)
+    n_residues = sum(len(table["resseq"]) for _, table in tables)
+    arrays = {
+        "xyz": np.empty((n_atoms, 3), dtype=np.float32),
+        "atom_name": np.empty(n_atoms, dtype=np.uint16),
+        "atom_residue": np.empty(n_atoms, dtype=np.int32),
+        "residue_resseq": np.empty(n_residues, dtype=np.int32),
+        "residue_icode": np.empty(n_residues, dtype="S1"),
+        "residue_resname": np.empty(n_residues, dtype=np.uint16),
+        "residue_hetero": np.empty(n_residues, dtype=np.bool_),
+        "residue_atom_offsets": np.empty(n_residues + 1, dtype=np.int64),
+        "chain_residue_offsets": [0],
+        "structure_chain_offsets": [0],
+    }
+    chain_ids = []
+
+    atom = 0
+    residue = 0
+    for _, table in tables:
+        n = len(table["coords"])
+        r = len(table["resseq"])
+        arrays["xyz"][atom:atom + n] = table["coords"]
+        arrays["atom_name"][atom:atom + n] = [atom_codes[name] for name in table["atom"]]
+        arrays["atom_residue"][atom:atom + n] = residue + np.repeat(np.arange(r), np.diff(np.append(table["residue_starts"], n)))
+        arrays["residue_resseq"][residue:residue + r] = table["resseq"]
+        arrays["residue_icode"][residue:residue + r] = table["icode"]
+        arrays["residue_resname"][residue:residue + r] = [resname_codes[name] for name in table["resname"]]
+        arrays["residue_hetero"][residue:residue + r] = table["hetero"]
+        arrays["residue_atom_offsets"][residue:residue + r] = atom + table["residue_starts"]
+        arrays["chain_residue_offsets"].extend((residue + table["chain_starts"][1:]).tolist() + [residue + r])
+        arrays["structure_chain_offsets"].append(arrays["structure_chain_offsets"][-1] + len(table["chain_ids"]))
+        chain_ids.extend(table["chain_ids"])
+        atom += n
+        residue += r
+    arrays["residue_atom_offsets"][n_residues] = n_atoms
+    arrays["chain_residue_offsets"] = np.array(arrays["chain_residue_offsets"], dtype=np.int64)
+    arrays["structure_chain_offsets"] = np.array(arrays["structure_chain_offsets"], dtype=np.int64)
+
+    header = {
+        "version": format_version,
+        "structures": [name for name, _ in tables],
+        "chain_ids": chain_ids,
+        "atom_names": atom_names,
+        "resnames": resnames,
+        "key": key,
+        "arrays": {},
+    }
+    # Array offsets depend on the header length, so lay them out after a generous header estimate
+    layout_start = len(json.dumps(header).encode()) + 128 * len(arrays) + 16
+    offset = -(-layout_start // _alignment) * _alignment
+    for name, array in arrays.items():
+        header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // _alignment) * _alignment
+    header_bytes = json.dumps(header).encode()
+    if len(_magic) + 8 + len(header_bytes) > layout_start:
+        raise RuntimeError("Coordinate store header is larger than the space reserved for it")
+
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_magic)
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(header["arrays"][name]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(offset)
+    os.replace(tmp_path, out_path)
+
+
+def read_header(path: str) -> dict:
+    """The JSON header of a coordinate store, or None if the file is missing or not a store."""
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        if f.read(len(_magic)) != _magic:
+            return None
+        header_length = int.from_bytes(f.read(8), "little")
+        return json.loads(f.read(header_length))
+
+
+class CoordStore:
+    """Read-only, memory-mapped view of a file written by write_store()."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._map = np.memmap(path, dtype=np.uint8, mode="r")
+        if bytes(self._map[:len(_magic)]) != _magic:
+            raise ValueError(f"'{path}' is not a coordinate store")
+        header_length = int.from_bytes(bytes(self._map[len(_magic):len(_magic) + 8]), "little")
+        header_start = len(_magic) + 8
+        self.header = json.loads(bytes(self._map[header_start:header_start + header_length]))
+        if self.header["version"] != format_version:
+            raise ValueError(f"'{path}' has coordinate store version {self.header['version']}, expected {format_version}")
+
+        for name, spec in self.header["arrays"].items():
+            dtype = np.dtype(spec["dtype"])
+            size = int(np.prod(spec["shape"])) * dtype.itemsize
+            array = self._map[spec["offset"]:spec["offset"] + size].view(dtype).reshape(spec["shape"])
+            setattr(self, name, array)
+
+        self.names = self.header["structures"]
+        self.chain_ids = np.array(self.header["chain_ids"])
+        self.atom_names = self.header["atom_names"]
+        self.resnames = self.header["resnames"]
+        self._index = {name: i for i, name in enumerate(self.names)}
+        # first atom of every structure, plus the end of the last one
+        self.structure_atom_offsets = self.residue_atom_offsets[self.chain_residue_offsets[self.structure_chain_offsets]]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def index(self, name: str) -> int:
+        try:
+            return self._index[name]
+        except KeyError:
+            raise KeyError(f"{name} is not in {self.path}") from None
+
+    def chains(self, name: str) -> list:
+        i = self.index(name)
+        return self.chain_ids[self.structure_chain_offsets[i]:self.structure_chain_offsets[i + 1]].tolist()
+
+    def residue_indices(self, name: str, chain: str = None, start: int = None, end: int = None) -> np.ndarray:
+        """Store-wide indices of the residues of a structure, optionally of one chain and a
+        residue number range (inclusive, author numbering)."""
+        i = self.index(name)
+        first_chain, last_chain = self.structure_chain_offsets[i], self.structure_chain_offsets[i + 1]
+        if chain is None:
+            residues = np.arange(self.chain_residue_offsets[first_chain], self.chain_residue_offsets[last_chain])
+        else:
+            runs = first_chain + np.flatnonzero(self.chain_ids[first_chain:last_chain] == chain)
+            if runs.size == 0:
+                raise KeyError(f"Chain {chain} is not in {name}")
+            residues = np.concatenate([np.arange(self.chain_residue_offsets[c], self.chain_residue_offsets[c + 1]) for c in runs])
+        if start is not None or end is not None:
+            numbers = self.residue_resseq[residues]
+            residues = residues[(numbers >= (start if start is not None else numbers.min()))
+                                & (numbers <= (end if end is not None else numbers.max()))]
+        return residues
+
+    def atom_indices(self, residues: np.ndarray, atom: str = None):
+        """Atoms of the residues: a slice if they are one contiguous block (so indexing gives a view),
+        otherwise an index array. With `atom` (e.g. "CA") only atoms of that name are selected."""
+        if atom is None and residues.size and residues[-1] - residues[0] + 1 == residues.size:
+            return slice(int(self.residue_atom_offsets[residues[0]]), int(self.residue_atom_offsets[residues[-1] + 1]))
+        starts = self.residue_atom_offsets[residues]
+        counts = self.residue_atom_offsets[residues + 1] - starts
+        atoms = np.repeat(starts - np.cumsum(np.append(0, counts[:-1])), counts) + np.arange(counts.sum())
+        if atom is not None:
+            if atom not in self.atom_names:
+                return atoms[:0]
+            atoms = atoms[self.atom_name[atoms] == self.atom_names.index(atom)]
+        return atoms
+
+    def coords(self, name: str, chain: str = None, start: int = None, end: int = None, atom: str = None) -> np.ndarray:
+        """float32 (atoms x 3) coordinates of a selection. Whole structures, chains and residue ranges
+        are views of the mapped file; selections by atom name are copies."""
+        return self.xyz[self.atom_indices(self.residue_indices(name, chain, start, end), atom)]
+
+    def atom_table(self, name: str, chain: str = None, start: int = None, end: int = None) -> dict:
+        """Chain, residue number, insertion code, residue name and atom name of every atom of a selection."""
+        atoms = self.atom_indices(self.residue_indices(name, chain, start, end))
+        residues = self.atom_residue[atoms]
+        chain_of_residue = np.searchsorted(self.chain_residue_offsets, residues, side="right") - 1
+        return {
+            "chain": self.chain_ids[chain_of_residue],
+            "resseq": np.asarray(self.residue_resseq[residues]),
+            "icode": np.char.decode(self.residue_icode[residues], "ascii"),
+            "resname": np.array(self.resnames)[self.residue_resname[residues]],
+            "atom": np.array(self.atom_names)[self.atom_name[atoms]],
+        }
+
+    def backbone(self, name: str, atoms=("N", "CA", "C", "O"), polymer_only: bool = True) -> np.ndarray:
+        """(residues x atoms x 3) float64 coordinates of the named atoms of every residue, in file order,
+        NaN where an atom is missing. Matches evaluate_models.backbone_coords() for the polymer residues."""
+        residues = self.residue_indices(name)
+        if polymer_only:
+            residues = residues[~self.residue_hetero[residues]]
+        out = np.full((len(residues), len(atoms), 3), np.nan)
+        if not residues.size:
+            return out
+        all_atoms = self.atom_indices(residues)
+        all_atoms = np.arange(all_atoms.start, all_atoms.stop) if isinstance(all_atoms, slice) else all_atoms
+        position = np.searchsorted(residues, self.atom_residue[all_atoms])
+        for a, atom_name in enumerate(atoms):
+            if atom_name not in self.atom_names:
+                continue
+            hits = all_atoms[self.atom_name[all_atoms] == self.atom_names.index(atom_name)]
+            rows = position[np.searchsorted(all_atoms, hits)]
+            # reversed so the first atom of a residue wins if a name repeats
+            out[rows[::-1], a] = self.xyz[hits[::-1]]
+        return out
+
+    def ensemble(self, names: list = None, chain: str = None, start: int = None, end: int = None,
+                 atom: str = None) -> np.ndarray:
+        """(structures x atoms x 3) coordinates of the same selection in every structure (default: all),
+        e.g. the models of one target. The structures must have the same atoms; the selection is
+        resolved once on the first structure and gathered from all of them in one indexing step."""
+        names = self.names if names is None else names
+        indices = np.array([self.index(name) for name in names])
+        first = self.structure_atom_offsets[indices]
+        sizes = self.structure_atom_offsets[indices + 1] - first
+        if np.any(sizes != sizes[0]):
+            raise ValueError("Structures in an ensemble must have the same number of atoms")
+
+        local = self.atom_indices(self.residue_indices(names[0], chain, start, end), atom)
+        local = np.arange(local.start, local.stop) if isinstance(local, slice) else local
+        local = local - first[0]
+        return self.xyz[first[:, None] + local[None, :]]
+
+    def summary(self) -> str:
+        return (f"{self.path}: {len(self.names)} structures, {len(self.chain_ids)} chains, "
+                f"{len(self.residue_resseq)} residues, {len(self.xyz)} atoms")
+
+
+def _read(path: str):
+    return cif_reader.read_atoms(path)
+
+
+def read_structures(paths: list, workers: int = 1) -> list:
+    """read_atoms() of every file, in a process pool if workers > 1."""
+    if workers <= 1 or len(paths) < 2:
+        return [cif_reader.read_atoms(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return list(pool.map(_read, paths, chunksize=max(1, len(paths) // (4 * workers))))
+
+
+def convert(paths: list, names: list, out_path: str, workers: int = 1) -> str:
+    """Writes the structure files to a coordinate store, unless a store of the same files and names
+    already exists at out_path (pipeline_stages keyed on the file contents, and the key is checked
+    against the store's header). Returns out_path."""
+    key = pipeline_stages.stage_key("coord_store", {"names": names, "version": format_version}, input_files=paths)
+    out_path = os.path.abspath(out_path)
+
+    def build():
+        write_store(out_path, zip(names, read_structures(paths, workers)), key=key)
+
+    manifest = pipeline_stages.load_manifest("coord_store", key)
+    if manifest is not None and manifest["outputs"].get("store") != out_path:
+        manifest = None
+    # other file sets can have been written to the same path since this one
+    header = read_header(out_path) if manifest is not None else None
+    if header is None or header.get("key") != key:
+        manifest = None
+    if not my_run_info.incremental_stages or manifest is None:
+        build()
+        pipeline_stages.record_stage("coord_store", key, {"store": out_path})
+    else:
+        print(f"[coord_store] {out_path} up to date ({pipeline_stages.short_key(key)}), skipping")
+    return out_path
+
+
+def template_files(cif_dir: str = my_run_info.cif_dir) -> list:
+    """Every .cif/.cif.gz template directly in cif_dir."""
+    return sorted(glob.glob(os.path.join(cif_dir, "*.cif")) + glob.glob(os.path.join(cif_dir, "*.cif.gz")))
+
+
+def template_name(path: str) -> str:
+    return os.path.basename(path).removesuffix(".gz").removesuffix(".cif")
+
+
+def model_name(path: str, models_dir: str = my_run_info.models_out_dir) -> str:
+    """Models are named by their path under models_dir, as several runs can write the same file name."""
+    return os.path.relpath(path, models_dir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert templates or models to a memory-mapped coordinate store.")
+    parser.add_argument("--templates", action="store_true", help="Convert every template in --cif-dir")
+    parser.add_argument("--models", action="store_true", help="Convert the models in --models-dir")
+    parser.add_argument("--sequence", help="Only the models of this target (default: every model)")
+    parser.add_argument("--cif-dir", default=my_run_info.cif_dir)
+    parser.add_argument("--models-dir", default=my_run_info.models_out_dir)
+    parser.add_argument("--out", help="Store file (default: in coord_store_dir)")
+    parser.add_argument("--workers", type=int, default=1, help="Processes parsing the mmCIF files")
+    parser.add_argument("--info", help="Print a summary of an existing store")
+    args = parser.parse_args(argv)
+
+    if args.info:
+        store = CoordStore(args.info)
+        print(store.summary())
+        return 0
+    if args.templates == args.models:
+        parser.error("give one of --templates or --models")
+
+    if args.templates:
+        paths = template_files(args.cif_dir)
+        names = [template_name(path) for path in paths]
+        out_path = args.out or os.path.join(my_run_info.coord_store_dir, "templates.coords")
+    else:
+        pattern = f"{glob.escape(args.sequence)}.B9999*.cif" if args.sequence else "*.B9999*.cif"
+        paths = sorted(glob.glob(os.path.join(args.models_dir, "**", pattern), recursive=True))
+        names = [model_name(path, args.models_dir) for path in paths]
+        out_path = args.out or os.path.join(my_run_info.coord_store_dir, f"models_{args.sequence or 'all'}.coords")
+    if not paths:
+        print("No structure files found")
+        return 1
+
+    convert(paths, names, out_path, args.workers)
+    print(CoordStore(out_path).summary())
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,293 @@
+# Finds disulfide bonds in the template structures, checks them against VCAb and patches the ones
+# MODELLER would miss. Cysteine SG atoms closer than disulfide_sg_cutoff are paired with a cell list:
+# every SG is put in a cubic cell of the cutoff's size, and only the 27 neighbouring cells are compared,
+# as whole arrays, so assemblies with hundreds of cysteines (IgM, IgA) need no loop over pairs. The pairs
+# are compared with VCAb's disulfide_bond annotation and mapped through the alignment to target residue
+# IDs (residue_numbering.py). Pairs whose residues are not both aligned to target cysteines are skipped.
+#
+# AutoModel already patches aligned template cysteines with SG atoms within 2.5 A (patch_ss_templates()),
+# so AutoDisulfideMixin only adds the rest: pairs VCAb annotates that are further apart in the template
+# (and, with a larger disulfide_sg_cutoff, pairs up to that distance). It prints the VCAb cross-check
+# for every template while the model is set up.
+#
+#   class MyModel(AutoDisulfideMixin, AutoModel): ...
+#
+# Usage (from the Scripts directory):
+#   python disulfide_detection.py --alnfile ../pir_files/<alignment>.pir           # pairs and target patches
+#   python disulfide_detection.py --alnfile ../pir_files/<alignment>.pir --vcab    # also cross-check VCAb
+
+import argparse
+import itertools
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+import cif_reader
+import my_run_info
+from convert_to_pir import read_pir
+from residue_numbering import NumberingMap
+from restraint_cache import find_template_files
+
+# SG-SG distance under which AutoModel.patch_ss_templates() patches an aligned template Cys pair itself
+modeller_ss_cutoff = 2.5
+
+
+def sg_atoms(atoms: dict):
+    """SG atoms of cysteines (first alternate location). Returns (coords n x 3, residue keys "chain:resseq+icode")."""
+    wanted = np.flatnonzero((atoms["atom"] == "SG") & (atoms["resname"] == "CYS")
+                            & np.isin(atoms["altloc"], ["", "A", "1"]))
+    keys = np.char.add(np.char.add(np.char.add(atoms["chain"][wanted], ":"), atoms["resseq"][wanted]),
+                       atoms["icode"][wanted])
+    # one SG per residue, in file order
+    _, first = np.unique(keys, return_index=True)
+    first = np.sort(first)
+    return atoms["coords"][wanted[first]], keys[first]
+
+
+def close_pairs(coords: np.ndarray, cutoff: float):
+    """Index pairs (i < j) of points within cutoff of each other, found with a cell list.
+    Returns (pairs n x 2, distances)."""
+    n = len(coords)
+    if n < 2:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0)
+
+    # cell of every point, padded by one cell on each side so neighbour keys never wrap
+    cells = np.floor((coords - coords.min(axis=0)) / cutoff).astype(np.int64) + 1
+    dims = cells.max(axis=0) + 2
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+
+    found = []
+    for dx, dy, dz in itertools.product((-1, 0, 1), repeat=3):
+        # queried in sorted order, which keeps searchsorted fast on large inputs
+        neighbour = sorted_keys + (dx * dims[1] + dy) * dims[2] + dz
+        lo = np.searchsorted(sorted_keys, neighbour, side="left")
+        counts = np.searchsorted(sorted_keys, neighbour, side="right") - lo
+        # every point paired with every point of the neighbouring cell
+        i = np.repeat(order, counts)
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        j = order[np.repeat(lo, counts) + within]
+        found.append(np.stack([i, j], axis=1)[i < j])
+
+    pairs = np.concatenate(found)
+    distances = np.linalg.norm(coords[pairs[:, 0]] - coords[pairs[:, 1]], axis=1)
+    close = np.flatnonzero(distances <= cutoff)
+    close = close[np.lexsort((pairs[close, 1], pairs[close, 0]))]
+    return pairs[close], distances[close]
+
+
+def structure_disulfides(atoms: dict, cutoff: float = my_run_info.disulfide_sg_cutoff) -> pd.DataFrame:
+    """Cys-Cys pairs of a structure with SG atoms within cutoff: residue_a, residue_b ("chain:number") and sg_distance."""
+    coords, keys = sg_atoms(atoms)
+    pairs, distances = close_pairs(coords, cutoff)
+    return pd.DataFrame({"residue_a": keys[pairs[:, 0]], "residue_b": keys[pairs[:, 1]], "sg_distance": distances})
+
+
+def parse_disulfide_bond(text, heavy_chain: str = None, light_chain: str = None) -> set:
+    """Parses a VCAb disulfide_bond annotation such as "H:22-H:92;H:220-L:214" into a set of
+    frozenset({"H:22", "H:92"}) pairs. Separators are read loosely (":", "_" or none between chain
+    and number; ";", "," or whitespace between bonds). The role letters H and L are replaced by the
+    row's heavy and light chain IDs when given."""
+    if not isinstance(text, str) or not text.strip():
+        return set()
+    roles = {"H": heavy_chain, "L": light_chain}
+    tokens = re.findall(r"([A-Za-z0-9])\s*[:_]?\s*(-?\d+)([A-Za-z]?)(?=[\s\-;,)\]]|$)", text)
+    residues = [f"{roles.get(chain) or chain}:{number}{icode}" for chain, number, icode in tokens]
+    return {frozenset(residues[i:i + 2]) for i in range(0, len(residues) - 1, 2)}
+
+
+def cross_check(found: pd.DataFrame, annotated: set, cysteines: set = None) -> pd.DataFrame:
+    """All pairs found in the structure or in the annotation, with a "source" column:
+    "both", "structure" (not annotated) or "annotation" (no SG pair within the cutoff).
+    Annotated pairs are only kept if both residues are in `cysteines` (the structure's Cys with an SG atom)."""
+    found_pairs = {frozenset(pair) for pair in zip(found["residue_a"], found["residue_b"])}
+    rows = found.assign(source=["both" if frozenset(pair) in annotated else "structure"
+                                for pair in zip(found["residue_a"], found["residue_b"])])
+    missing = [sorted(pair) for pair in annotated - found_pairs if len(pair) == 2]
+    if cysteines is not None:
+        not_cys = [pair for pair in missing if not set(pair) <= cysteines]
+        if not_cys:
+            print(f"Ignoring {len(not_cys)} annotated disulfides without two cysteine SG atoms: "
+                  + ", ".join("-".join(pair) for pair in not_cys))
+        missing = [pair for pair in missing if set(pair) <= cysteines]
+    if missing:
+        rows = pd.concat([rows, pd.DataFrame({
+            "residue_a": [pair[0] for pair in missing], "residue_b": [pair[1] for pair in missing],
+            "sg_distance": np.nan, "source": "annotation",
+        })], ignore_index=True)
+    return rows
+
+
+def target_disulfides(alnfile: str, knowns, atom_files_directory, sequence: str = None,
+                      vcab_index=None, cutoff: float = my_run_info.disulfide_sg_cutoff) -> pd.DataFrame:
+    """Disulfides of every template of the alignment, mapped to the target.
+    One row per template pair, with the target residue IDs (target_a/target_b, None where a residue
+    is not aligned to a target cysteine), whether AutoModel patches it itself ("modeller", SG atoms
+    within modeller_ss_cutoff) and, given a VCAbIndex, whether VCAb annotates the pair."""
+    knowns = [knowns] if isinstance(knowns, str) else list(knowns)
+    entries = read_pir(alnfile)
+    targets = [entry for entry in entries
+               if entry["type"] == "sequence" and (sequence is None or entry["code"] == sequence)]
+    if len(targets) != 1:
+        raise ValueError(f"{alnfile} needs one target entry")
+
+    tables = []
+    for code in knowns:
+        template = next((entry for entry in entries if entry["code"] == code), None)
+        files = find_template_files([code], atom_files_directory)
+        if template is None or not files or not files[0].endswith((".cif", ".cif.gz")):
+            print(f"Skipping {code}: not in the alignment or no .cif file")
+            continue
+        atoms = cif_reader.read_atoms(files[0])
+        found = structure_disulfides(atoms, cutoff)
+
+        if vcab_index is not None and code in vcab_index:
+            annotated = set()
+            for row in vcab_index.rows(code).itertuples():
+                annotated |= parse_disulfide_bond(row.disulfide_bond, row.Hchain, row.Lchain)
+            found = cross_check(found, annotated, set(sg_atoms(atoms)[1].tolist()))
+        else:
+            found = found.assign(source="structure")
+
+        numbering = NumberingMap.from_entries(targets[0], template, atoms)
+        mapped = [target_pair(numbering, a, b) for a, b in zip(found["residue_a"], found["residue_b"])]
+        tables.append(found.assign(
+            template=code,
+            target_a=[pair[0] if pair else None for pair in mapped],
+            target_b=[pair[1] if pair else None for pair in mapped],
+            modeller=(found["sg_distance"].to_numpy() <= modeller_ss_cutoff) & np.array([pair is not None for pair in mapped], dtype=bool),
+        ))
+    columns = ["template", "residue_a", "residue_b", "sg_distance", "source", "target_a", "target_b", "modeller"]
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(tables, ignore_index=True)[columns]
+
+
+def target_pair(numbering: NumberingMap, residue_a: str, residue_b: str):
+    """Target residue IDs of a template Cys pair, or None if either is not aligned to a target cysteine."""
+    try:
+        return numbering.patch_residues({"residues": [residue_a.split(":", 1), residue_b.split(":", 1)]})
+    except (KeyError, ValueError):
+        return None
+
+
+def _target_pairs(rows: pd.DataFrame) -> list:
+    pairs = {tuple(sorted(pair, key=lambda i: int(i.split(":")[0]))) for pair in zip(rows["target_a"], rows["target_b"])}
+    return sorted(pairs, key=lambda pair: int(pair[0].split(":")[0]))
+
+
+def modeller_pairs(table: pd.DataFrame) -> list:
+    """Distinct target residue ID pairs that AutoModel.patch_ss_templates() patches from the templates."""
+    return _target_pairs(table[table["modeller"].astype(bool)])
+
+
+def patch_pairs(table: pd.DataFrame) -> list:
+    """Distinct target residue ID pairs to patch in addition to patch_ss_templates(): mapped pairs
+    (annotated in VCAb, or found in a structure with a cutoff above modeller_ss_cutoff) that no
+    template gives MODELLER within modeller_ss_cutoff."""
+    covered = set(modeller_pairs(table))
+    return [pair for pair in _target_pairs(table[table["target_a"].notna()]) if pair not in covered]
+
+
+def cross_check_report(table: pd.DataFrame) -> str:
+    """Per template: how many pairs the structure and VCAb agree on, and the pairs only one of them has."""
+    lines = []
+    for template, rows in table.groupby("template", sort=False):
+        counts = rows["source"].value_counts()
+        lines.append(f"{template}: {len(rows)} disulfides, {counts.get('both', 0)} in structure and VCAb, "
+                     f"{counts.get('structure', 0)} in structure only, {counts.get('annotation', 0)} in VCAb only")
+        for row in rows[rows["source"] != "both"].itertuples():
+            where = "structure only" if row.source == "structure" else "VCAb only"
+            lines.append(f"  {row.residue_a} - {row.residue_b} ({where})")
+    return "\n".join(lines)
+
+
+_vcab_index = None
+# resolved on import, as the model scripts and parallel_models workers chdir to the models directory
+vcab_csv_path = os.path.abspath(my_run_info.VCAb_dir)
+vcab_cache_dir = os.path.abspath(my_run_info.VCAb_cache_dir)
+
+
+def load_vcab_index():
+    """The refined VCAb table as a VCAbIndex (read once per process), or None if it cannot be read."""
+    global _vcab_index
+    if _vcab_index is None:
+        import vcab_cache
+        from vcab_index import VCAbIndex
+
+        try:
+            _vcab_index = VCAbIndex(vcab_cache.load_refined_VCAb(vcab_csv_path, vcab_cache_dir,
+                                                                 use_cache=my_run_info.use_VCAb_cache))
+        except (OSError, ValueError) as e:
+            print(f"VCAb not read, disulfides are not cross-checked: {e}")
+            return None
+    return _vcab_index
+
+
+class AutoDisulfideMixin:
+    """Cross-checks the template disulfides with VCAb (disulfide_vcab_check) and adds DISU patches for
+    the ones AutoModel.patch_ss_templates() misses (see patch_pairs()), after any patches of the model
+    class itself. Pairs in `patched_pairs`, as recorded by NumberedRestraintsMixin, are skipped.
+    Turned off by my_run_info.auto_disulfides = False."""
+    auto_disulfides = my_run_info.auto_disulfides
+    disulfide_cutoff = my_run_info.disulfide_sg_cutoff
+    disulfide_vcab_check = my_run_info.disulfide_vcab_check
+
+    def disulfide_inputs(self) -> dict:
+        """Settings and VCAb version the added patches depend on (part of the restraint cache key)."""
+        inputs = {"auto": self.auto_disulfides, "cutoff": self.disulfide_cutoff, "vcab_check": self.disulfide_vcab_check}
+        if self.auto_disulfides and self.disulfide_vcab_check and os.path.isfile(vcab_csv_path):
+            import vcab_cache
+            inputs["vcab"] = vcab_cache.refined_VCAb_key(vcab_csv_path, vcab_cache_dir)
+        return inputs
+
+    def special_patches(self, aln):
+        super().special_patches(aln)
+        if not self.auto_disulfides:
+            return
+        vcab_index = load_vcab_index() if self.disulfide_vcab_check else None
+        table = target_disulfides(self.alnfile, self.knowns, self.env.io.atom_files_directory,
+                                  self.sequence, vcab_index, self.disulfide_cutoff)
+        if vcab_index is not None and len(table):
+            print(cross_check_report(table))
+        patched = getattr(self, "patched_pairs", set()) | {frozenset(pair) for pair in modeller_pairs(table)}
+        for residue_a, residue_b in patch_pairs(table):
+            if frozenset((residue_a, residue_b)) in patched:
+                continue
+            print(f"Disulfide patch {residue_a} - {residue_b}")
+            self.patch(residue_type="DISU", residues=(self.residues[residue_a], self.residues[residue_b]))
+            patched.add(frozenset((residue_a, residue_b)))
+        self.patched_pairs = patched
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find template disulfides and the target DISU patches they give.")
+    parser.add_argument("--alnfile", required=True)
+    parser.add_argument("--knowns", nargs="+", help="Template codes (default: every structure entry of the alignment)")
+    parser.add_argument("--sequence", help="Target code (default: the alignment's sequence entry)")
+    parser.add_argument("--atom-files", nargs="+", default=[".", my_run_info.cif_dir])
+    parser.add_argument("--cutoff", type=float, default=my_run_info.disulfide_sg_cutoff, help="SG-SG distance in angstroms")
+    parser.add_argument("--vcab", action="store_true", help="Cross-check the pairs with VCAb's disulfide_bond column")
+    args = parser.parse_args(argv)
+
+    knowns = args.knowns or [entry["code"] for entry in read_pir(args.alnfile) if entry["type"].startswith("structure")]
+    vcab_index = load_vcab_index() if args.vcab else None
+
+    table = target_disulfides(args.alnfile, knowns, args.atom_files, args.sequence, vcab_index, args.cutoff)
+    print(table.to_string(index=False))
+    if vcab_index is not None:
+        print(cross_check_report(table))
+    print("Patched by MODELLER (patch_ss_templates):")
+    for residue_a, residue_b in modeller_pairs(table):
+        print(f"  {residue_a} - {residue_b}")
+    print("Extra DISU patches (AutoDisulfideMixin):")
+    for residue_a, residue_b in patch_pairs(table):
+        print(f"  self.patch(residue_type='DISU', residues=(self.residues['{residue_a}'], self.residues['{residue_b}']))")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
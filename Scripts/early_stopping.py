@@ -0,0 +1,131 @@
+# Adaptive ensemble size: keep building models until the best DOPE score stops improving.
+# ConvergenceMonitor follows the DOPE scores as models finish and says when to stop:
+#   - the best score has not improved by more than dope_margin over the last dope_patience models, or
+#   - the wall-clock or CPU budget is used up, or
+#   - ending_model is reached (the upper limit).
+# Models are built in batches and the monitor is checked between them: serial runs call
+# AutoModel.make() once per batch with make_until_converged(), parallel runs hand each batch to
+# the worker processes with parallel_models.run_until_converged().
+
+import os
+import time
+
+import numpy as np
+
+import my_run_info
+
+
+def cpu_seconds() -> float:
+    """CPU time of this process and its finished child processes (children are not counted on Windows)."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class ConvergenceMonitor:
+    """Tracks DOPE scores of finished models and decides when the ensemble has converged."""
+
+    def __init__(self, patience: int = my_run_info.dope_patience, margin: float = my_run_info.dope_margin,
+                 min_models: int = my_run_info.adaptive_min_models, time_budget: float = my_run_info.model_time_budget,
+                 cpu_budget: float = my_run_info.model_cpu_budget):
+        self.patience = patience
+        self.margin = margin
+        self.min_models = min_models
+        self.time_budget = time_budget
+        self.cpu_budget = cpu_budget
+
+        self.start_time = time.perf_counter()
+        self.start_cpu = cpu_seconds()
+        self.scores = []
+        self.n_models = 0
+        self.best = None
+        self.reference = None  # best score when the patience count was last reset
+        self.since_improvement = 0
+
+    def add(self, output: dict):
+        """Adds one entry of a.outputs (failed models count towards patience but have no score)."""
+        self.n_models += 1
+        score = output.get("DOPE score") if output.get("failure") is None else None
+        if score is None:
+            self.since_improvement += 1
+            return
+
+        self.scores.append(score)
+        if self.best is None or score < self.best:
+            self.best = score
+        if self.reference is None or score < self.reference - self.margin:
+            self.reference = score
+            self.since_improvement = 0
+        else:
+            self.since_improvement += 1
+
+    def stop_reason(self):
+        """Returns why the ensemble should stop, or None to keep building."""
+        if self.n_models >= self.min_models and self.since_improvement >= self.patience:
+            return f"best DOPE score has not improved by more than {self.margin} in the last {self.since_improvement} models"
+        if self.time_budget is not None and time.perf_counter() - self.start_time >= self.time_budget:
+            return f"time budget of {self.time_budget} s used"
+        if self.cpu_budget is not None and cpu_seconds() - self.start_cpu >= self.cpu_budget:
+            return f"CPU budget of {self.cpu_budget} s used"
+        return None
+
+    def summary(self) -> dict:
+        """Best score and distribution of the DOPE scores so far."""
+        summary = {
+            "models": self.n_models,
+            "scored": len(self.scores),
+            "best": self.best,
+            "elapsed_s": time.perf_counter() - self.start_time,
+        }
+        if self.scores:
+            scores = np.asarray(self.scores)
+            summary.update(
+                mean=float(scores.mean()),
+                std=float(scores.std()),
+                p10=float(np.percentile(scores, 10)),
+                median=float(np.median(scores)),
+            )
+        return summary
+
+    def progress(self) -> str:
+        summary = self.summary()
+        if summary["best"] is None:
+            return f"{summary['models']} models, none scored yet"
+        return (f"{summary['models']} models, best DOPE {summary['best']:.3f}, median {summary['median']:.3f}, "
+                f"{self.since_improvement} since last improvement")
+
+
+def make_until_converged(a, monitor: ConvergenceMonitor = None, batch_size: int = None) -> list:
+    """Builds the models of `a` (an AutoModel) in batches of batch_size models, running a.make() on each
+    batch's starting_model..ending_model range, until the monitor says the ensemble has converged or
+    a.ending_model (the most models that will be built) is reached. Every make() runs to the end, so its
+    summary and any refinement it does after the models (e.g. LoopModel's loop models) happen for each batch.
+    Set cache_restraints so later batches read the restraints instead of deriving them again.
+    Sets a.outputs to the outputs of every batch (and the model range back to the full one) and returns it."""
+    if monitor is None:
+        monitor = ConvergenceMonitor()
+    if batch_size is None:
+        batch_size = my_run_info.adaptive_batch_size or 1
+    starting_model, ending_model = a.starting_model, a.ending_model
+
+    outputs = []
+    first = starting_model
+    try:
+        while first <= ending_model:
+            last = min(first + batch_size - 1, ending_model)
+            a.starting_model, a.ending_model = first, last
+            a.make()
+
+            for output in a.outputs:
+                monitor.add(output)
+            outputs.extend(a.outputs)
+            print(monitor.progress())
+
+            reason = monitor.stop_reason()
+            if reason:
+                print(f"Stopped after {monitor.n_models} models: {reason}")
+                break
+            first = last + 1
+    finally:
+        a.starting_model, a.ending_model = starting_model, ending_model
+        a.outputs = outputs
+    return outputs
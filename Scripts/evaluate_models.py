@@ -0,0 +1,275 @@
+# Scores the models of an ensemble against their templates.
+# CA and backbone (N, CA, C, O) RMSDs after optimal superposition are computed for the whole
+# model and for each region (VL, CL, VH, CH1, hinge). All models are stacked into one array and
+# superposed in a single batched Kabsch pass (superposition.batch_fit_rmsd).
+#
+# Usage (from the Scripts directory):
+#   python evaluate_models.py --alnfile ../pir_files/pir_alignment_IgG4_<key>.pir --models-dir ../models
+
+import argparse
+import glob
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+import cif_reader
+import coord_store
+import my_run_info
+from convert_to_pir import read_pir
+from restraint_cache import find_template_files
+from superposition import kabsch, apply_transform, batch_fit_rmsd
+from template_superposition import residue_keys, template_residue_keys, atom_coords, matched_ca, residue_positions
+
+backbone_atoms = ("N", "CA", "C", "O")
+
+
+def backbone_coords(atoms: dict, keys) -> np.ndarray:
+    """(residues x 4 x 3) N, CA, C, O coordinates of the residues in keys, NaN where an atom is missing."""
+    coords = np.full((len(keys), len(backbone_atoms), 3), np.nan)
+    for a, atom_name in enumerate(backbone_atoms):
+        for r, coord in enumerate(atom_coords(atoms, keys, atom_name)):
+            if coord is not None:
+                coords[r, a] = coord
+    return coords
+
+
+def model_residue_keys(atoms: dict) -> np.ndarray:
+    """Polymer residues of a model in file order (MODELLER writes them in alignment order)."""
+    keys = residue_keys(atoms)[atoms["group"] == "ATOM"]
+    _, first_atom = np.unique(keys, return_index=True)
+    return keys[np.sort(first_atom)]
+
+
+def split_entries(entries: list):
+    """Returns (target entry, template entries) of a .pir alignment."""
+    targets = [entry for entry in entries if entry["type"] == "sequence"]
+    templates = [entry for entry in entries if entry["type"].startswith("structure")]
+    if len(targets) != 1 or not templates:
+        raise ValueError("Alignment needs one target (sequence) entry and at least one template (structure) entry")
+    return targets[0], templates
+
+
+def residue_sources(target: dict, templates: list) -> tuple:
+    """For every target residue, the template it was taken from and the chain segment it belongs to.
+    In a hybrid (two templates) each chain switches from the V template to the C template at the
+    column that best splits target identity between them. Returns (source, segment, boundary) arrays
+    with boundary True at the first residue after each chain's VC switch."""
+    target_seq = target["sequence"]
+    n_residues = sum(c.isalpha() for c in target_seq)
+    source = np.zeros(n_residues, dtype=np.int64)
+    segment = np.zeros(n_residues, dtype=np.int64)
+    boundary = np.zeros(n_residues, dtype=bool)
+
+    residue = 0
+    column = 0
+    for s, chain_seq in enumerate(target_seq.split("/")):
+        columns = np.arange(column, column + len(chain_seq))
+        letters = np.array(list(chain_seq))
+        is_residue = np.char.isalpha(letters)
+        chain_residues = np.arange(residue, residue + is_residue.sum())
+        segment[chain_residues] = s
+
+        if len(templates) >= 2:
+            v_match = (np.array([templates[0]["sequence"][c] for c in columns]) == letters) & is_residue
+            c_match = (np.array([templates[1]["sequence"][c] for c in columns]) == letters) & is_residue
+            # identity to V before the split plus identity to C from the split onwards
+            split_score = np.concatenate(([0], np.cumsum(v_match))) + np.concatenate((np.cumsum(c_match[::-1])[::-1], [0]))
+            split = int(np.argmax(split_score))
+            residues_before = int(is_residue[:split].sum())
+            source[chain_residues[residues_before:]] = 1
+            if 0 < residues_before < len(chain_residues):
+                boundary[chain_residues[residues_before]] = True
+
+        residue += len(chain_residues)
+        column += len(chain_seq) + 1
+    return source, segment, boundary
+
+
+def chain_vc_switch(chain_seq: str, heavy: bool):
+    """Index of the first constant region residue of an ungapped chain found from its sequence:
+    after my_run_info.vh_boundary for heavy chains, after the last match of my_run_info.vl_boundary
+    for light chains. None if the motif is not found."""
+    if heavy:
+        if my_run_info.vh_boundary not in chain_seq:
+            return None
+        return chain_seq.index(my_run_info.vh_boundary) + len(my_run_info.vh_boundary)
+    matches = list(re.finditer(my_run_info.vl_boundary, chain_seq))
+    return matches[-1].end() if matches else None
+
+
+def residue_regions(target: dict, templates: list) -> dict:
+    """Returns {region: target residue indices} for VL, CL, VH, CH1 and hinge.
+    Heavy chains are those containing my_run_info.vh_boundary (or, failing that, the longest chain).
+    Each chain is split at its V/C template switch, or, with a single template, at the end of
+    my_run_info.vh_boundary (heavy) or my_run_info.vl_boundary (light). Regions that cannot be
+    found are reported and returned empty, so their RMSDs are NaN."""
+    source, segment, boundary = residue_sources(target, templates)
+    chains = target["sequence"].split("/")
+    ungapped = [chain.replace("-", "") for chain in chains]
+
+    heavy = [my_run_info.vh_boundary in seq for seq in ungapped]
+    if not any(heavy):
+        longest = max(len(seq) for seq in ungapped)
+        heavy = [len(seq) == longest and len(ungapped) > 1 for seq in ungapped]
+
+    regions = {"VL": [], "CL": [], "VH": [], "CH1": [], "hinge": []}
+    for s in range(len(chains)):
+        residues = np.flatnonzero(segment == s)
+        switch = np.flatnonzero(boundary[residues])
+        if switch.size:
+            split = int(switch[0])
+        else:
+            split = chain_vc_switch(ungapped[s], heavy[s])
+        if split is None:
+            print(f"Chain {s + 1} of {target['code']}: no {'VH' if heavy[s] else 'VL'} boundary found, "
+                  f"left out of the {'VH/CH1/hinge' if heavy[s] else 'VL/CL'} regions")
+            continue
+        if heavy[s]:
+            regions["VH"].extend(residues[:split])
+            regions["CH1"].extend(residues[split:split + my_run_info.ch1_length])
+            regions["hinge"].extend(residues[split + my_run_info.ch1_length:split + my_run_info.ch1_length + my_run_info.hinge_length])
+        else:
+            regions["VL"].extend(residues[:split])
+            regions["CL"].extend(residues[split:])
+
+    missing = [name for name, indices in regions.items() if not indices]
+    if missing:
+        print(f"Regions not found in {target['code']}: {', '.join(missing)} (RMSDs reported as NaN)")
+    return {name: np.array(indices, dtype=np.int64) for name, indices in regions.items()}
+
+
+def template_reference(target: dict, templates: list, atom_files_directory) -> np.ndarray:
+    """(target residues x 4 x 3) backbone coordinates each target residue should match: taken from the
+    template it came from, with the C template superposed onto the V template so the whole model
+    can be compared in one frame. NaN where the template has a gap or a missing atom."""
+    source, _, _ = residue_sources(target, templates)
+    target_positions = residue_positions(target["sequence"].replace("/", ""))
+    reference = np.full((len(source), len(backbone_atoms), 3), np.nan)
+
+    template_atoms = []
+    for k, template in enumerate(templates[:2]):
+        found = find_template_files([template["code"]], atom_files_directory)
+        if not found:
+            raise FileNotFoundError(f"No atom file for template {template['code']}")
+        atoms = cif_reader.read_atoms(found[0])
+        template_atoms.append(atoms)
+
+        sequence = template["sequence"].replace("/", "")
+        keys = template_residue_keys(atoms, template["header"][2], template["header"][3], sum(c.isalpha() for c in sequence))
+        coords = backbone_coords(atoms, keys)
+        if k == 1:
+            rotation, translation = kabsch(*matched_ca(templates[0], template, template_atoms[0], atoms))
+            coords = apply_transform(coords, rotation, translation)
+
+        for i, j in zip(target_positions, residue_positions(sequence)):
+            if i is not None and j is not None and source[i] == k:
+                reference[i] = coords[j]
+    return reference
+
+
+def load_models(model_paths: list, n_residues: int, store: str = None, models_dir: str = my_run_info.models_out_dir):
+    """Stacks the backbone coordinates of every model into one (models x residues x 4 x 3) array.
+    Models in the coordinate store `store` (coord_store.py) are read from it, others from their files.
+    Models whose residue count does not match the alignment are skipped. Returns (coords, paths)."""
+    coords = coord_store.CoordStore(store) if store else None
+    stacked = []
+    loaded = []
+    for path in model_paths:
+        name = coord_store.model_name(path, models_dir)
+        if coords is not None and name in coords:
+            model = coords.backbone(name, backbone_atoms)
+        else:
+            atoms = cif_reader.read_atoms(path)
+            model = backbone_coords(atoms, model_residue_keys(atoms))
+        if len(model) != n_residues:
+            print(f"Skipping {path}: {len(model)} residues, alignment target has {n_residues}")
+            continue
+        stacked.append(model)
+        loaded.append(path)
+    if not stacked:
+        return np.empty((0, n_residues, len(backbone_atoms), 3)), loaded
+    return np.stack(stacked), loaded
+
+
+def fit_rmsd(models: np.ndarray, reference: np.ndarray, residues=None, atoms=(0, 1, 2, 3)) -> np.ndarray:
+    """RMSD of every model to the reference after superposing the selected residues and atoms.
+    Atoms missing from the reference or from any model are left out. NaN if fewer than 3 remain."""
+    if residues is not None:
+        models = models[:, residues]
+        reference = reference[residues]
+    mobile = models[:, :, list(atoms)].reshape(len(models), -1, 3)
+    target = reference[:, list(atoms)].reshape(-1, 3)
+
+    present = ~np.isnan(target).any(axis=-1) & ~np.isnan(mobile).any(axis=(0, 2))
+    if present.sum() < 3:
+        return np.full(len(models), np.nan)
+    return batch_fit_rmsd(mobile[:, present], target[present])
+
+
+def evaluate(models: np.ndarray, reference: np.ndarray, regions: dict) -> dict:
+    """Overall and per-region CA and backbone RMSDs for every model, as {column name: values}."""
+    ca = (backbone_atoms.index("CA"),)
+    scores = {
+        "ca_rmsd": fit_rmsd(models, reference, atoms=ca),
+        "backbone_rmsd": fit_rmsd(models, reference),
+    }
+    for name, residues in regions.items():
+        scores[f"ca_rmsd_{name}"] = fit_rmsd(models, reference, residues, atoms=ca)
+        scores[f"backbone_rmsd_{name}"] = fit_rmsd(models, reference, residues)
+    return scores
+
+
+def find_models(models_dir: str, sequence: str) -> list:
+    """MODELLER model files ({sequence}.B9999NNNN.cif) anywhere under models_dir."""
+    pattern = os.path.join(models_dir, "**", f"{glob.escape(sequence)}.B9999*.cif")
+    return sorted(glob.glob(pattern, recursive=True))
+
+
+def evaluate_ensemble(alnfile: str, model_paths: list = None, models_dir: str = my_run_info.models_out_dir,
+                      atom_files_directory=(".", my_run_info.cif_dir), store: str = None) -> pd.DataFrame:
+    """Scores every model of the alignment's target. Returns one row per model."""
+    target, templates = split_entries(read_pir(alnfile))
+    if model_paths is None:
+        model_paths = find_models(models_dir, target["code"])
+    n_residues = sum(c.isalpha() for c in target["sequence"])
+
+    models, loaded = load_models(model_paths, n_residues, store, models_dir)
+    if not loaded:
+        print(f"No models of {target['code']} to evaluate")
+        return pd.DataFrame()
+
+    reference = template_reference(target, templates, atom_files_directory)
+    regions = residue_regions(target, templates)
+    df_scores = pd.DataFrame({"model": loaded, **evaluate(models, reference, regions)})
+    return df_scores.sort_values("backbone_rmsd", ignore_index=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score models against their templates by CA and backbone RMSD.")
+    parser.add_argument("--alnfile", required=True, help=".pir alignment the models were built from")
+    parser.add_argument("--models-dir", default=my_run_info.models_out_dir)
+    parser.add_argument("--models", nargs="+", help="Model files (default: every model of the target in --models-dir)")
+    parser.add_argument("--atom-files-dir", nargs="+", default=[".", my_run_info.cif_dir],
+                        help="Directories searched for the template files")
+    parser.add_argument("--store", help="Coordinate store of the models (coord_store.py --models), instead of parsing each file")
+    parser.add_argument("--out", help="csv file for the scores (default: next to the alignment's models)")
+    args = parser.parse_args(argv)
+
+    df_scores = evaluate_ensemble(args.alnfile, args.models, args.models_dir, args.atom_files_dir, args.store)
+    if df_scores.empty:
+        return 1
+
+    out_path = args.out or os.path.join(
+        args.models_dir, f"evaluation_{os.path.splitext(os.path.basename(args.alnfile))[0]}.csv"
+        )
+    df_scores.to_csv(out_path, index=False)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(df_scores.head(10).to_string(index=False))
+    print(f"Scores written to {out_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,10 @@
+import hashlib
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    """Returns the sha256 hex digest of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
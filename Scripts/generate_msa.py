@@ -0,0 +1,164 @@
+# Runs an external aligner (Clustal Omega by default) over the heavy and light FASTA files
+# of every hybrid at once. The command, concurrency limit and per-job timeout are set in my_run_info.py.
+#
+# Usage (from the Scripts directory), aligning every FASTA pair written with one timestamp:
+#   python generate_msa.py --timestamp 20250101_120000
+
+import argparse
+import asyncio
+import os
+import re
+import time
+
+import my_run_info
+import profiling
+
+
+def alignment_fname(isotype_label: str, chain: str) -> str:
+    """Name expected by convert_to_pir.extract_gapped_seqs(), e.g. Fab_alignment_IgG1_heavy.aln-clustal."""
+    return f"Fab_alignment_{isotype_label}_{chain}.aln-clustal"
+
+
+def make_jobs(hybrid_fastas: dict, clustal_out_dir: str = my_run_info.clustal_out_dir) -> list:
+    """Turns {isotype_label: (light_fasta, heavy_fasta)} into one job per chain."""
+    jobs = []
+    for isotype_label, (light_fasta, heavy_fasta) in hybrid_fastas.items():
+        for chain, fasta_path in (("light", light_fasta), ("heavy", heavy_fasta)):
+            jobs.append({
+                "label": isotype_label,
+                "chain": chain,
+                "input": fasta_path,
+                "output": os.path.join(clustal_out_dir, alignment_fname(isotype_label, chain)),
+            })
+    return jobs
+
+
+def build_command(input_path: str, output_path: str, command: list = None) -> list:
+    """Fills the {input}/{output} placeholders of the configured aligner command."""
+    if command is None:
+        command = my_run_info.msa_command
+    return [arg.format(input=input_path, output=output_path) for arg in command]
+
+
+async def _read_stream(stream, chunks: list):
+    while True:
+        chunk = await stream.read(4096)
+        if not chunk:
+            return
+        chunks.append(chunk)
+
+
+async def _run_job(job: dict, semaphore: asyncio.Semaphore, timeout: float, command: list) -> dict:
+    """Runs one aligner process, writing to a temporary file that is renamed on success
+    so a failed or timed-out job never leaves a partial alignment under the final name."""
+    tmp_output = f"{job['output']}.{os.getpid()}.tmp"
+    cmd = build_command(job["input"], tmp_output, command)
+    result = dict(job, command=cmd, returncode=None, stderr="", elapsed=0.0)
+
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+                )
+        except OSError as e:
+            result.update(status="error", stderr=str(e))
+            return result
+
+        # stderr is read as it is written, so a job killed on timeout still reports what it printed
+        stderr_chunks = []
+        reader = asyncio.ensure_future(_read_stream(proc.stderr, stderr_chunks))
+        try:
+            await asyncio.wait_for(proc.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            result["status"] = "timeout"
+        else:
+            result["returncode"] = proc.returncode
+            if proc.returncode == 0 and os.path.isfile(tmp_output):
+                os.replace(tmp_output, job["output"])
+                result["status"] = "ok"
+            else:
+                result["status"] = "failed"
+        try:
+            # children of the aligner can keep the pipe open after it exits
+            await asyncio.wait_for(reader, timeout=5)
+        except asyncio.TimeoutError:
+            pass
+        result.update(
+            stderr=b"".join(stderr_chunks).decode(errors="replace"),
+            elapsed=time.perf_counter() - start,
+        )
+
+    if os.path.exists(tmp_output):
+        os.remove(tmp_output)
+    return result
+
+
+async def _run_all(jobs: list, max_concurrent: int, timeout: float, command: list) -> list:
+    semaphore = asyncio.Semaphore(max_concurrent)
+    return await asyncio.gather(*(_run_job(job, semaphore, timeout, command) for job in jobs))
+
+
+def run_msa_jobs(jobs: list, max_concurrent: int = None, timeout: float = None, command: list = None) -> list:
+    """Runs all jobs with at most `max_concurrent` aligner processes at a time.
+    Returns one result dict per job with its status ("ok", "failed", "timeout" or "error"),
+    return code, captured stderr and elapsed seconds."""
+    if max_concurrent is None:
+        max_concurrent = my_run_info.msa_max_concurrent
+    if timeout is None:
+        timeout = my_run_info.msa_timeout
+
+    results = asyncio.run(_run_all(jobs, max_concurrent, timeout, command))
+
+    for result in results:
+        name = os.path.basename(result["output"])
+        print(f"{result['status']:<8} {name} ({result['elapsed']:.1f} s)")
+        if result["status"] != "ok" and result["stderr"]:
+            print(result["stderr"].strip())
+    return results
+
+
+@profiling.profiled(name="run_msa")
+def align_hybrids(hybrid_fastas: dict, clustal_out_dir: str = my_run_info.clustal_out_dir) -> list:
+    """Aligns the light and heavy FASTA files of every hybrid concurrently.
+    Takes {isotype_label: (light_fasta, heavy_fasta)}."""
+    os.makedirs(clustal_out_dir, exist_ok=True)
+    return run_msa_jobs(make_jobs(hybrid_fastas, clustal_out_dir))
+
+
+def find_hybrid_fastas(fasta_dir: str, timestamp: str) -> dict:
+    """Pairs {light,heavy}_chain_{label}_{timestamp}.fasta files written by prepare_sequences.write_fastas()."""
+    pattern = re.compile(rf"^(light|heavy)_chain_(.+)_{re.escape(timestamp)}\.fasta$")
+    found = {}
+    for fname in sorted(os.listdir(fasta_dir)):
+        match = pattern.match(fname)
+        if match:
+            chain, isotype_label = match.groups()
+            found.setdefault(isotype_label, {})[chain] = os.path.join(fasta_dir, fname)
+
+    return {
+        isotype_label: (paths["light"], paths["heavy"])
+        for isotype_label, paths in found.items()
+        if "light" in paths and "heavy" in paths
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Align the FASTA files of every hybrid with an external aligner.")
+    parser.add_argument("--timestamp", required=True, help="Timestamp suffix of the FASTA files to align")
+    parser.add_argument("--fasta-dir", default=my_run_info.fasta_out_dir)
+    parser.add_argument("--out-dir", default=my_run_info.clustal_out_dir)
+    args = parser.parse_args(argv)
+
+    hybrid_fastas = find_hybrid_fastas(args.fasta_dir, args.timestamp)
+    if not hybrid_fastas:
+        parser.error(f"no light/heavy FASTA pairs with timestamp {args.timestamp} in {args.fasta_dir}")
+
+    results = align_hybrids(hybrid_fastas, args.out_dir)
+    return 0 if all(result["status"] == "ok" for result in results) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
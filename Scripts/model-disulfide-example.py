@@ -1,14 +1,19 @@
 # Comparative modeling by the AutoModel class
 from modeller import *              # Load standard Modeller classes
 from modeller.automodel import *    # Load the AutoModel class
+from disulfide_detection import AutoDisulfideMixin
 
 # Redefine the special_patches routine to include the additional disulfides
-# (this routine is empty by default):
-class MyModel(AutoModel):
+# (this routine is empty by default). Disulfides of the templates are patched by
+# AutoModel itself; AutoDisulfideMixin adds those annotated in VCAb that it misses
+# (run disulfide_detection.py to list them):
+class MyModel(AutoDisulfideMixin, AutoModel):
     def special_patches(self, aln):
         # A disulfide between residues 8 and 45 in chain A:
         self.patch(residue_type='DISU', residues=(self.residues['8:A'],
                                                   self.residues['45:A']))
+        self.patched_pairs = {frozenset(('8:A', '45:A'))}
+        super().special_patches(aln)
 
 log.verbose()    # request verbose output
 env = Environ()  # create a new MODELLER environment to build this model in
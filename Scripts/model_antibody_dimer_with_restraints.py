@@ -1,14 +1,33 @@
 # Addition of restraints to the default ones
 from modeller import *
 from modeller.automodel import *    # Load the AutoModel class
+import os
+import my_run_info
+import parallel_models
+import profiling
+from model_checkpoint import CheckpointMixin, run_seed, checkpoint_file
+from early_stopping import make_until_converged
+from restraint_cache import RestraintCacheMixin
+from template_superposition import superposed_atom_dirs
+from residue_numbering import NumberedRestraintsMixin, distance, hinge_disulfides
+from disulfide_detection import AutoDisulfideMixin
 
-log.verbose()
-env = Environ()
+# CheckpointMixin records each finished model, so an interrupted run only rebuilds the missing ones.
+# RestraintCacheMixin reuses restraints while the alignment, templates and the methods below are unchanged
+# NumberedRestraintsMixin adds the restraint and patch specs below, written in the template's PDB/EU numbering
+# and mapped to the target's residue numbers through the alignment (residue_numbering.py)
+# AutoDisulfideMixin then patches template disulfides that VCAb annotates but MODELLER's patch_ss_templates() misses
+class MyModel(AutoDisulfideMixin, NumberedRestraintsMixin, CheckpointMixin, RestraintCacheMixin, AutoModel):
+    numbering_template = 'IgG4ModellerHingeTemplate'
 
-# directories for input atom files
-env.io.atom_files_directory = ['.', '../atom_files']
+    # Restrain the CA-CA distance of Pro 329 (first heavy chain) and Ser 298 (second heavy chain)
+    # to 5 angstroms (st. dev.=0.1), with a harmonic potential and X-Y distance group
+    restraint_specs = [
+        distance(('CA', 'B', 329), ('CA', 'D', 298), mean=5.0, stdev=0.1),
+    ]
+    # The IgG4 inter-heavy-chain hinge disulfides (Cys 226 and Cys 229) between heavy chains B and D
+    patch_specs = hinge_disulfides('IgG4', heavy_chains=('B', 'D'))
 
-class MyModel(AutoModel):
     def special_restraints(self, aln):
         rsr = self.restraints
         at = self.atoms
@@ -27,35 +46,76 @@ class MyModel(AutoModel):
 #       rsr.add(secondary_structure.Sheet(at['N:1:A'], at['O:9:A'],
 #                                         sheet_h_bonds=5))
 
-#       Restrain the specified CA-CA distance to 10 angstroms (st. dev.=0.1)
-#       Use a harmonic potential and X-Y distance group.
-        rsr.add(forms.Gaussian(group=physical.xy_distance,
-                               feature=features.Distance(at['CA:547:B'], # Pro 329 + 218 = 547
-                                                         at['CA:1178:G']), # Ser 298 +662 +218 = 516
-                               mean=5.0, stdev=0.1))
-    
-    def special_patches(self, aln):
-        # A disulfide between residues 444 and 1106 in chain B & D:
-        self.patch(residue_type='DISU', residues=(self.residues['444:B'],
-                                                  self.residues['1106:D']))
-        # A disulfide between residues 447 and 1109 in chain B & D:
-        self.patch(residue_type='DISU', residues=(self.residues['444:B'],
-                                                  self.residues['1109:D']))
-
-a = MyModel(env,
-    alnfile  = '../pir_files/pir-alignment-5dk3-monomer-with-AF-hinge-dimertest2.pir', # alignment filename NOTE: import this from other script
-    knowns   = ('IgG4ModellerHingeTemplate'),                          # codes of the templates
-    sequence = 'IgG4FullAbTarget',                             # code of the target (used by MODELLER to name files)
-    assess_methods=(assess.DOPE, assess.GA341)      # assessment methods
-    )              # code of the target
-a.starting_model= 1                 # index of the first model
-a.ending_model  = 5                 # index of the last model
-                                    # (determines how many models to calculate)
+#       Restraints declared in restraint_specs
+        self.add_restraint_specs()
 
-import os
-os.chdir("../models")               # change output directory (this may need changing back to ../Scripts each run)
-a.set_output_model_format("MMCIF")  # request mmCIF rather than PDB outputs
+def main():
+    log.verbose()
+
+    # directories for input atom files
+    atom_files_directory = ['.', '../atom_files']
+
+    alnfile = '../pir_files/pir-alignment-5dk3-monomer-with-AF-hinge-dimertest2.pir' # alignment filename NOTE: import this from other script
+    knowns = ('IgG4ModellerHingeTemplate')  # codes of the templates
+    sequence = 'IgG4FullAbTarget'           # code of the target (used by MODELLER to name files)
+    starting_model = 1                      # index of the first model
+    ending_model = 5                        # index of the last model
+                                            # (determines how many models to calculate)
+
+    # with cache_superposition, templates are superposed once (and reused) instead of by initial_malign3d
+    superposed_dirs = None
+    if my_run_info.cache_superposition:
+        superposed_dirs = superposed_atom_dirs(alnfile, knowns, atom_files_directory)
+    if superposed_dirs is not None:
+        atom_files_directory = superposed_dirs
+
+    if my_run_info.model_workers > 1:
+        # build the ensemble in worker processes, each with its own directory under ../models/{sequence}
+        ensemble = dict(
+            alnfile=alnfile, knowns=knowns, sequence=sequence, starting_model=starting_model, ending_model=ending_model,
+            model_class="model_antibody_dimer_with_restraints:MyModel", atom_files_directory=atom_files_directory,
+            initial_malign3d=superposed_dirs is None,
+        )
+        if my_run_info.adaptive_ensemble:
+            ranked = {sequence: parallel_models.run_until_converged(ensemble)}
+        else:
+            jobs = parallel_models.ensemble_jobs(**ensemble, n_jobs=my_run_info.model_workers)
+            ranked = parallel_models.run_parallel(jobs, my_run_info.model_workers)
+        parallel_models.write_summary(ranked, os.path.join(my_run_info.models_out_dir, f"{sequence}_summary.json"))
+        profiling.finish("model_antibody_dimer")
+        return
+
+    # a run resuming from its checkpoint gets its own seed, so the missing models don't repeat
+    # the random state of the first ones (model_checkpoint.run_seed)
+    seed = run_seed(my_run_info.model_seed, alnfile, knowns, sequence, starting_model, ending_model,
+                    checkpoint_file(sequence, "../models"))
+    env = Environ(rand_seed=seed)
+    env.io.atom_files_directory = atom_files_directory
+
+    a = profiling.with_profiling(MyModel)(env,
+        alnfile  = alnfile,
+        knowns   = knowns,
+        sequence = sequence,
+        assess_methods=(assess.DOPE, assess.GA341)      # assessment methods
+        )              # code of the target
+    a.starting_model= starting_model
+    a.ending_model  = ending_model
+    a.checkpoint_seed = my_run_info.model_seed
+    a.run_seed = seed
+
+    os.chdir("../models")               # change output directory (this may need changing back to ../Scripts each run)
+    a.set_output_model_format("MMCIF")  # request mmCIF rather than PDB outputs
+
+    a.initial_malign3d = superposed_dirs is None  # superpose the 3d structures before modelling (unless done above)
+
+    with profiling.stage("make", sequence=sequence):
+        if my_run_info.adaptive_ensemble:
+            make_until_converged(a)     # build models until the best DOPE score stops improving
+        else:
+            a.make()                    # do comparative modeling
+    profiling.finish("model_antibody_dimer")
 
-a.initial_malign3d = True           # superpose the 3d structures before modelling
 
-a.make()                            # do comparative modeling
+# Guarded so worker processes can import MyModel from this file without building models
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# Checkpointing for AutoModel runs, so an ensemble that dies part way can be resumed.
+# Every finished model is appended to a .jsonl file (file, size, scores, timing, seeds) as soon as it is written.
+# On restart, models whose record and file are both present are not rebuilt: their recorded
+# outputs are returned instead, so a.outputs is still complete when make() finishes.
+#
+# Skipped models draw no random numbers, so a resumed run started with the original seed would rebuild
+# its first missing model with the random state of the ensemble's first model (a copy of it).
+# Create the Environ of a run with run_seed() instead: a resumed run gets a seed derived from
+# checkpoint_seed and the first missing model. Its models differ from those an uninterrupted run
+# would have built, but no random state is used twice, and the same resume point gives the same models.
+#
+# Use it by putting CheckpointMixin before AutoModel:
+#   class MyModel(CheckpointMixin, AutoModel): ...
+# or wrap an existing class with checkpointed(AutoModel).
+
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+
+import pipeline_stages
+
+# MODELLER accepts random seeds between -50000 and -2
+_seed_min = -50000
+_seed_max = -2
+
+
+def derived_seed(*parts) -> int:
+    """Deterministic MODELLER random seed from any number of values."""
+    digest = hashlib.sha256(":".join(str(part) for part in parts).encode()).digest()
+    return _seed_max - int.from_bytes(digest[:4], "big") % (_seed_max - _seed_min + 1)
+
+
+def checkpoint_file(sequence: str, directory: str = ".") -> str:
+    """Default checkpoint path of a target, in the directory the models are written to."""
+    return os.path.abspath(os.path.join(directory, f"{sequence}.checkpoint.jsonl"))
+
+
+def ensemble_key(alnfile: str, knowns, sequence: str, seed: int) -> str:
+    """Checkpoints are only reused for the same alignment contents, templates, target and seed."""
+    knowns = [knowns] if isinstance(knowns, str) else list(knowns)
+    return pipeline_stages.stage_key(
+        "checkpoint",
+        {"knowns": knowns, "sequence": sequence, "seed": seed},
+        input_files=[alnfile],
+    )
+
+
+def plain_output(output: dict) -> dict:
+    """Copy of one a.outputs entry that can be pickled and written as json
+    (score tuples become lists, other MODELLER objects and exceptions become their text)."""
+    plain = {}
+    for key, value in output.items():
+        if value is None or isinstance(value, (str, int, float)):
+            plain[key] = value
+        elif isinstance(value, (list, tuple)) and all(isinstance(v, (int, float)) for v in value):
+            plain[key] = list(value)
+        else:
+            plain[key] = str(value)
+    return plain
+
+
+def read_checkpoint(path: str, ensemble_key: str) -> dict:
+    """Returns {model index: record} of the finished models recorded for this ensemble.
+    A model counts as finished only if it did not fail and its file is still there with the
+    recorded size. A line cut short by a crash is ignored."""
+    completed = {}
+    if not os.path.isfile(path):
+        return completed
+
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("ensemble_key") != ensemble_key or record["output"].get("failure") is not None:
+                continue
+            model_path = record["path"]
+            if os.path.isfile(model_path) and os.path.getsize(model_path) == record["size"]:
+                completed[record["num"]] = record
+    return completed
+
+
+def append_record(path: str, record: dict):
+    """Appends one model record and forces it to disk before the next model starts."""
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def run_seed(seed: int, alnfile: str, knowns, sequence: str, starting_model: int, ending_model: int,
+             checkpoint_path: str) -> int:
+    """Random seed for the Environ of a run over starting_model..ending_model whose ensemble seed
+    (checkpoint_seed) is `seed`: `seed` itself for a fresh run, or a seed derived from `seed` and the
+    first missing model if earlier models of the range are already in the checkpoint."""
+    completed = read_checkpoint(checkpoint_path, ensemble_key(alnfile, knowns, sequence, seed))
+    first_missing = next((num for num in range(starting_model, ending_model + 1) if num not in completed), None)
+    if first_missing is None or first_missing == starting_model:
+        return seed
+    seed_for_run = derived_seed(seed, first_missing)
+    print(f"Resuming at model {first_missing} with random seed {seed_for_run} (ensemble seed {seed})")
+    return seed_for_run
+
+
+class CheckpointMixin:
+    """Records each model as it finishes and skips models that were already built.
+    `checkpoint_seed` should be set to the ensemble's seed and `run_seed` to the rand_seed the
+    Environ was created with (from run_seed()), so both are recorded with the models."""
+    checkpoint_path = None  # default: {sequence}.checkpoint.jsonl in the output directory
+    checkpoint_seed = None
+    run_seed = None
+
+    def ensemble_key(self) -> str:
+        return ensemble_key(self.alnfile, self.knowns, self.sequence, self.checkpoint_seed)
+
+    def single_model(self, atmsel, num, *args, **kwargs):
+        path = os.path.abspath(self.checkpoint_path or checkpoint_file(self.sequence))
+        key = self.ensemble_key()
+
+        record = read_checkpoint(path, key).get(num)
+        if record is not None:
+            print(f"Model {num} already built ({record['output']['name']}), skipping")
+            return record["output"]
+
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        output = super().single_model(atmsel, num, *args, **kwargs)
+        # kept with the output, so a model restored on resume still reports when and how fast it was built
+        output.setdefault("elapsed_s", round(time.perf_counter() - start, 3))
+        output.setdefault("cpu_s", round(time.process_time() - cpu_start, 3))
+        output.setdefault("finished", datetime.now().isoformat(timespec="seconds"))
+        output.setdefault("run_seed", self.run_seed)
+
+        model_path = os.path.abspath(output["name"]) if output.get("name") else None
+        append_record(path, {
+            "ensemble_key": key,
+            "num": num,
+            "path": model_path,
+            "size": os.path.getsize(model_path) if model_path and os.path.isfile(model_path) else None,
+            "seed": self.checkpoint_seed,
+            "finished": output["finished"],
+            "output": plain_output(output),
+        })
+        return output
+
+
+def checkpointed(model_class):
+    """Returns a subclass of model_class (e.g. AutoModel) with CheckpointMixin added."""
+    if issubclass(model_class, CheckpointMixin):
+        return model_class
+    return type(f"Checkpointed{model_class.__name__}", (CheckpointMixin, model_class), {})
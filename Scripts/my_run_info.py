@@ -19,18 +19,38 @@ template_c_chain_light = "L"
 
 # VCAb variables
 VCAb_dir = "../VCAb_data/VCAb.csv"
+VCAb_cache_dir = "../VCAb_data/cache"  # refined VCAb table is cached here as Parquet
+use_VCAb_cache = True
+VCAb_chunksize = 20000  # rows per chunk when streaming VCAb.csv
 # insert a kappa/lambda light chain preference here
 
 # Expected final VH residues in VH-to-CH1 boundary
 vh_boundary = "LVTVSS"
+# Regular expression for the end of the VL (light chain FR4, e.g. kappa FGQGTKVEIK, lambda FGGGTKLTVL)
+vl_boundary = r"FG.GT.{5}"
+
+# Region lengths used by evaluate_models.py after the heavy chain VC boundary (light chains: VL ends at vl_boundary)
+ch1_length = 98  # EU 118-215
+hinge_length = 15  # EU 216-230 in IgG1 (IgG2/IgG4: 12, IgG3: 62)
 
 # Directories
 fasta_out_dir = "../fasta_sequences"
 clustal_out_dir = "../alignments"
 pir_out_dir = "../pir_files"
 cif_dir = "../atom_files"
+cif_chain_order_cache = "../atom_files/cache/chain_order.json"  # chain order per .cif, keyed by file hash
 models_out_dir = "../models"
 pickle_out_dir = "../pickles"
+results_db = "../models/results.sqlite"  # model names, scores and run details from build_models.py
+stage_cache_dir = "../pipeline_cache"  # manifests of finished, content-addressed pipeline stages
+restraint_cache_dir = "../pipeline_cache/restraints"  # MODELLER restraint files keyed by alignment and templates
+superposition_cache_dir = "../pipeline_cache/superposition"  # template transforms and superposed template files
+coord_store_dir = "../pipeline_cache/coords"  # memory-mapped coordinate stores of templates and models (coord_store.py)
+
+# External aligner used by generate_msa.py ({input}/{output} are filled in per job)
+msa_command = ["clustalo", "-i", "{input}", "-o", "{output}", "--outfmt=clustal", "--force"]
+msa_max_concurrent = 4  # aligner processes run at the same time
+msa_timeout = 600  # seconds before a single alignment job is killed
 
 # Output file names (will be suffixed with a timestamp) - change this
 FASTA_heavy_out_file = "IgA1_heavy_chain_out.fasta"
@@ -42,9 +62,46 @@ pir_combined_file = "alignment_IgA1_thegoal.pir"
 # Utility options
 append_timestamp_to_outputs = True
 auto_hybridise_template = True
-make_alignment_automatically = False  # if True, clustal is triggered automatically (not yet implemented)
+make_alignment_automatically = True  # if True, alignments are made automatically instead of pausing for clustal
+alignment_method = "builtin"  # "builtin" (align_sequences.py) or "external" (generate_msa.py runs msa_command)
 create_pir_file = True
-store_pickle_output = True
+store_model_results = True  # record every model and its scores in results_db
+incremental_stages = True  # skip pipeline stages whose outputs already exist for the same inputs
+model_workers = 1  # > 1 builds the models of an ensemble in parallel processes (parallel_models.py)
+checkpoint_models = True  # record each finished model so interrupted ensembles resume (model_checkpoint.py)
+model_seed = -8123  # MODELLER random seed (its default); a resumed run uses one derived from it (model_checkpoint.run_seed)
+cache_restraints = True  # reuse restraints for the same alignment, templates and restraint rules (restraint_cache.py)
+cache_superposition = True  # superpose templates once and reuse them instead of initial_malign3d (template_superposition.py)
+
+# Adaptive ensembles (early_stopping.py): ending_model becomes the upper limit and building stops
+# once the best DOPE score has not improved by more than dope_margin over dope_patience models
+adaptive_ensemble = False
+dope_patience = 10
+dope_margin = 10.0
+adaptive_min_models = 5  # never stop before this many models
+adaptive_batch_size = None  # models built between convergence checks (None: one per worker, or 1 when serial)
+model_time_budget = None  # seconds of wall-clock time, None for no limit
+model_cpu_budget = None  # seconds of CPU time, None for no limit
+
+# Template search (template_search.py): rank VCAb entries by k-mer similarity instead of typing PDB codes
+auto_select_templates = False  # if True, run_model_pipeline.py picks the templates below instead of prompting
+target_vh_seq = None  # target VH/VL sequences for the variable region template search
+target_vl_seq = None
+target_isotype = "IgG1"  # isotype of the constant region template
+template_kmer = 5  # k-mer length of the index (1-6)
+template_max_resolution = 3.0  # Angstrom, None for no limit
+template_methods = ["X-RAY DIFFRACTION"]  # experimental methods kept, None for all
+template_min_coverage = 0.9  # fraction of heavy and light chain residues with coordinates
+
+# Disulfide detection (disulfide_detection.py): DISU patches from the template structures
+auto_disulfides = True  # patch template disulfides MODELLER's patch_ss_templates() misses (AutoDisulfideMixin)
+disulfide_vcab_check = True  # cross-check template disulfides with VCAb's disulfide_bond column while modelling
+disulfide_sg_cutoff = 2.5  # Angstrom between SG atoms (S-S bonds are about 2.05)
+
+# Profiling (profiling.py): per-stage wall time, CPU time and peak memory, written as a Chrome trace
+profile_pipeline = False  # also turned on by PIPELINE_PROFILE=1 or --profile
+profile_memory = "rss"  # "rss" (per-stage peak resident memory on Linux, end-of-stage RSS elsewhere) or "tracemalloc" (also peak Python allocations, slower)
+profile_dir = "../pipeline_cache/profiles"
 
 # Use this in the pipeline to pull information from above
 from my_run_info import models_out_dir, template_v, template_c, target_name
\ No newline at end of file
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+
+
+class ZippedChain:
+    """Residues of one chain zipped with their PDB numbering.
+
+    Both attributes are slices (views) of the flat arrays in RaggedNumbering,
+    and iterating yields (residue, number) pairs like the old list of tuples."""
+
+    __slots__ = ("residues", "numbers")
+
+    def __init__(self, residues: np.ndarray, numbers: np.ndarray):
+        self.residues = residues
+        self.numbers = numbers
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __iter__(self):
+        return zip(self.residues.tobytes().decode("ascii"), self.numbers.tolist())
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return ZippedChain(self.residues[item], self.numbers[item])
+        return (self.residues[item].decode("ascii"), int(self.numbers[item]))
+
+    def sequence(self) -> str:
+        """Returns the one-letter residue string."""
+        return self.residues.tobytes().decode("ascii")
+
+    def boundary_index(self, boundary: int) -> int:
+        """Returns the index of the first residue numbered `boundary`."""
+        hits = np.flatnonzero(self.numbers == boundary)
+        if hits.size == 0:
+            raise ValueError(f"VC boundary residue {boundary} not found in chain numbering")
+        return int(hits[0])
+
+
+def find_boundary_index(zipped, boundary: int) -> int:
+    """Returns the index of the VC boundary residue in a ZippedChain or a list of (residue, number) tuples."""
+    if isinstance(zipped, ZippedChain):
+        return zipped.boundary_index(boundary)
+    return next(i for i, (_, num) in enumerate(zipped) if num == boundary)
+
+
+class RaggedNumbering:
+    """PDB numbering and coordinate residues of one chain type for every row of a VCAb table.
+
+    All rows share one flat int64 `values` array (and one flat residue array), with
+    `offsets[i]:offsets[i + 1]` marking row i. VC boundary indices for all rows are
+    found in a single vectorised pass."""
+
+    def __init__(self, values, offsets, residues, residue_offsets, boundaries, valid=None):
+        self.values = values
+        self.offsets = offsets
+        self.residues = residues
+        self.residue_offsets = residue_offsets
+        self.boundaries = boundaries
+        # Rows whose numbering could not be parsed (e.g. insertion codes) are kept empty and marked invalid
+        self.valid = np.ones(len(offsets) - 1, dtype=bool) if valid is None else valid
+        self._boundary_indices = None
+
+    @classmethod
+    def from_table(cls, df: pd.DataFrame, chain: str = "H") -> "RaggedNumbering":
+        """Parses the `{chain}_PDB_numbering` strings, `{chain}_coordinate_seq` and
+        `pdb_{chain}_VC_Boundary` columns of a refined VCAb table ("H" or "L")."""
+        numbering = df[f"{chain}_PDB_numbering"].fillna("").astype(str).str.replace(r"\s+", "", regex=True)
+        sequences = df[f"{chain}_coordinate_seq"].fillna("").astype(str)
+
+        # Rows that are not plain comma-separated integers are left out, so one bad row
+        # doesn't stop the rest of the table from being parsed
+        valid = (numbering.str.fullmatch(r"-?\d+(,-?\d+)*") | (numbering == "")).to_numpy(dtype=bool)
+        if not valid.all():
+            print(f"{(~valid).sum()} rows with unparsable {chain}_PDB_numbering marked invalid")
+            numbering = numbering.where(valid, "")
+
+        # Number of residues per row from the number of separators
+        counts = np.where(numbering.str.len() > 0, numbering.str.count(",") + 1, 0).astype(np.int64)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        # Split every numbering string with one join/split and one int conversion
+        non_empty = [text for text in numbering if text]
+        if non_empty:
+            values = np.array(",".join(non_empty).split(","), dtype=np.int64)
+        else:
+            values = np.zeros(0, dtype=np.int64)
+
+        residue_counts = sequences.str.len().to_numpy(dtype=np.int64)
+        residue_offsets = np.zeros(len(residue_counts) + 1, dtype=np.int64)
+        np.cumsum(residue_counts, out=residue_offsets[1:])
+        residues = np.frombuffer("".join(sequences).encode("ascii"), dtype="S1")
+
+        boundaries = pd.to_numeric(df[f"pdb_{chain}_VC_Boundary"], errors="coerce").fillna(np.iinfo(np.int64).min)
+        boundaries = boundaries.to_numpy(dtype=np.int64)
+
+        return cls(values, offsets, residues, residue_offsets, boundaries, valid)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self) -> np.ndarray:
+        """Returns the number of (residue, number) pairs per row, truncated like zip()."""
+        return np.minimum(np.diff(self.offsets), np.diff(self.residue_offsets))
+
+    def chain(self, i: int) -> ZippedChain:
+        """Returns row i as a ZippedChain of array views."""
+        if not self.valid[i]:
+            raise ValueError(f"Row {i} has PDB numbering that could not be parsed as integers")
+        length = min(self.offsets[i + 1] - self.offsets[i], self.residue_offsets[i + 1] - self.residue_offsets[i])
+        return ZippedChain(
+            self.residues[self.residue_offsets[i]:self.residue_offsets[i] + length],
+            self.values[self.offsets[i]:self.offsets[i] + length],
+        )
+
+    def boundary_indices(self) -> np.ndarray:
+        """Returns, for every row, the index of the first residue numbered as its VC boundary (-1 if absent).
+        PDB numbering is not always increasing, so this is an exact-match search over the flat
+        array rather than a per-row binary search."""
+        if self._boundary_indices is None:
+            lengths = self.lengths()
+            row_ids = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+            hits = np.flatnonzero(self.values == self.boundaries[row_ids])
+
+            # Keep the first hit per row (hits are sorted by flat position)
+            hit_rows, first = np.unique(row_ids[hits], return_index=True)
+            indices = np.full(len(self), -1, dtype=np.int64)
+            indices[hit_rows] = hits[first] - self.offsets[hit_rows]
+            indices[indices >= lengths] = -1
+            self._boundary_indices = indices
+        return self._boundary_indices
+
+    def split_points(self):
+        """Returns (starts, splits, ends) as flat residue positions for every row.
+        Variable regions are residues[starts:splits], constant regions residues[splits:ends]."""
+        starts = self.residue_offsets[:-1]
+        ends = starts + self.lengths()
+        boundary_indices = self.boundary_indices()
+        splits = np.where(boundary_indices >= 0, starts + boundary_indices + 1, ends)
+        return (starts, splits, ends)
+
+    def variable_region(self, i: int) -> ZippedChain:
+        """Returns row i up to and including its VC boundary residue."""
+        return self.chain(i)[:self._split_index(i)]
+
+    def constant_region(self, i: int) -> ZippedChain:
+        """Returns row i after its VC boundary residue."""
+        return self.chain(i)[self._split_index(i):]
+
+    def _split_index(self, i: int) -> int:
+        boundary_index = self.boundary_indices()[i]
+        if boundary_index < 0:
+            raise ValueError(f"VC boundary residue {self.boundaries[i]} not found in row {i} numbering")
+        return int(boundary_index) + 1
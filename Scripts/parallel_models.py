@@ -0,0 +1,273 @@
+# Builds MODELLER ensembles in parallel on the local machine.
+# The model index range of each ensemble (one per alignment/isotype) is split into jobs,
+# and the jobs run in a process pool. Every job has its own output directory and a random
+# seed derived from its label and first model index, so re-running gives the same models.
+# The outputs of all jobs are merged and ranked by DOPE score. With checkpoint_models set,
+# re-running after a crash only builds the models each job had not finished (model_checkpoint.py).
+# With --adaptive, models are built in batches until the best DOPE score converges (early_stopping.py).
+#
+# Usage (from the Scripts directory):
+#   python parallel_models.py --alnfile ../pir_files/x.pir --knowns IgG4ModellerHingeTemplate \
+#       --sequence IgG4FullAbTarget --models 1 50 --workers 16
+#   python parallel_models.py --config ensembles.json   # a list of ensembles with the same keys
+#
+# A custom AutoModel subclass is given as "module:Class", e.g.
+#   --model-class model_antibody_dimer_with_restraints:MyModel
+
+import argparse
+import importlib
+import json
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import model_checkpoint
+import my_run_info
+import profiling
+import restraint_cache
+import template_superposition
+
+def job_seed(label: str, first_model: int) -> int:
+    """Deterministic MODELLER random seed for the job starting at `first_model`."""
+    return model_checkpoint.derived_seed(label, first_model)
+
+
+def split_range(starting_model: int, ending_model: int, n_jobs: int) -> list:
+    """Splits starting_model..ending_model (inclusive) into at most n_jobs contiguous (start, end) ranges
+    whose sizes differ by at most one."""
+    n_models = ending_model - starting_model + 1
+    n_jobs = max(1, min(n_jobs, n_models))
+    size, extra = divmod(n_models, n_jobs)
+
+    ranges = []
+    start = starting_model
+    for i in range(n_jobs):
+        end = start + size - 1 + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end + 1
+    return ranges
+
+
+def ensemble_jobs(alnfile: str, knowns, sequence: str, starting_model: int, ending_model: int,
+                  n_jobs: int = my_run_info.model_workers, label: str = None,
+                  out_dir: str = my_run_info.models_out_dir, model_class: str = None,
+                  atom_files_directory=("../atom_files",), initial_malign3d: bool = True) -> list:
+    """Returns one job dict per chunk of the model range of one alignment.
+    Paths are made absolute here because every worker changes into its own directory."""
+    if label is None:
+        label = sequence
+    if isinstance(knowns, str):
+        knowns = [knowns]
+    if initial_malign3d and my_run_info.cache_superposition:
+        superposed_dirs = template_superposition.superposed_atom_dirs(alnfile, knowns, atom_files_directory)
+        if superposed_dirs is not None:
+            atom_files_directory, initial_malign3d = superposed_dirs, False
+
+    jobs = []
+    for start, end in split_range(starting_model, ending_model, n_jobs):
+        jobs.append({
+            "label": label,
+            "alnfile": os.path.abspath(alnfile),
+            "knowns": list(knowns),
+            "sequence": sequence,
+            "starting_model": start,
+            "ending_model": end,
+            "seed": job_seed(label, start),
+            "out_dir": os.path.abspath(os.path.join(out_dir, label, f"models_{start:04d}-{end:04d}")),
+            "model_class": model_class,
+            "atom_files_directory": [os.path.abspath(d) for d in atom_files_directory],
+            "initial_malign3d": initial_malign3d,
+        })
+    return jobs
+
+
+def load_model_class(model_class: str = None):
+    """Imports "module:Class", or returns AutoModel if no class is given."""
+    if not model_class:
+        from modeller.automodel import AutoModel
+        return AutoModel
+    module_name, class_name = model_class.split(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def run_job(job: dict) -> list:
+    """Builds the models of one job in its own directory (runs in a worker process).
+    Returns the job's outputs with absolute model paths and the job's label, seed and run seed
+    (the Environ's seed, which differs from the job seed if the job resumed from its checkpoint) added."""
+    from modeller import Environ, log
+    from modeller.automodel import assess
+
+    model_class = load_model_class(job["model_class"])
+    if my_run_info.cache_restraints:
+        model_class = restraint_cache.with_restraint_cache(model_class)
+    if my_run_info.checkpoint_models:
+        model_class = model_checkpoint.checkpointed(model_class)
+    model_class = profiling.with_profiling(model_class)
+
+    os.makedirs(job["out_dir"], exist_ok=True)
+    os.chdir(job["out_dir"])
+    log.minimal()
+
+    seed = job["seed"]
+    if my_run_info.checkpoint_models:
+        # a resumed job gets its own seed, so it doesn't rebuild its missing models with the random state of the first ones
+        seed = model_checkpoint.run_seed(job["seed"], job["alnfile"], job["knowns"], job["sequence"],
+                                         job["starting_model"], job["ending_model"],
+                                         model_checkpoint.checkpoint_file(job["sequence"]))
+    env = Environ(rand_seed=seed)
+    env.io.atom_files_directory = ["."] + job["atom_files_directory"]
+
+    a = model_class(env,
+        alnfile=job["alnfile"],
+        knowns=job["knowns"],
+        sequence=job["sequence"],
+        assess_methods=(assess.DOPE, assess.GA341)
+        )
+    a.starting_model = job["starting_model"]
+    a.ending_model = job["ending_model"]
+    a.set_output_model_format("MMCIF")
+    a.initial_malign3d = job["initial_malign3d"]
+    a.checkpoint_seed = job["seed"]
+    a.run_seed = seed
+    try:
+        with profiling.stage("make", label=job["label"], models=f"{job['starting_model']}-{job['ending_model']}"):
+            a.make()
+    finally:
+        profiling.flush_worker(job["label"])
+
+    outputs = []
+    for num, output in enumerate(a.outputs, start=job["starting_model"]):
+        output = model_checkpoint.plain_output(output)
+        output.setdefault("num", num)
+        if output.get("name"):
+            output["name"] = os.path.join(job["out_dir"], output["name"])
+        output.update(label=job["label"], seed=job["seed"])
+        output.setdefault("run_seed", seed)
+        outputs.append(output)
+    return outputs
+
+
+def rank_outputs(outputs: list, key: str = "DOPE score") -> list:
+    """Sorts outputs best first: successful models by score, then failed ones."""
+    return sorted(outputs, key=lambda x: (x.get("failure") is not None, x.get(key) if x.get(key) is not None else math.inf))
+
+
+def run_parallel(jobs: list, max_workers: int = my_run_info.model_workers) -> dict:
+    """Runs all jobs in a process pool and returns {label: ranked outputs}.
+    A job that crashes is reported and its models are missing from the result."""
+    merged = {}
+    # spawn gives every worker a fresh MODELLER state instead of a forked copy of the parent's
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as pool:
+        futures = {pool.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                outputs = future.result()
+            except Exception as e:
+                print(f"{job['label']} models {job['starting_model']}-{job['ending_model']} failed: {e}")
+                continue
+            print(f"{job['label']} models {job['starting_model']}-{job['ending_model']} done")
+            merged.setdefault(job["label"], []).extend(outputs)
+
+    return {label: rank_outputs(outputs) for label, outputs in merged.items()}
+
+
+def run_until_converged(ensemble: dict, monitor=None, batch_size: int = None,
+                        max_workers: int = my_run_info.model_workers, out_dir: str = my_run_info.models_out_dir) -> list:
+    """Builds one ensemble in batches of batch_size models (default: one per worker) until the
+    early_stopping.ConvergenceMonitor says it has converged or ending_model is reached.
+    Takes the keyword arguments of ensemble_jobs(). Returns the ranked outputs of every batch."""
+    import early_stopping
+
+    if monitor is None:
+        monitor = early_stopping.ConvergenceMonitor()
+    if batch_size is None:
+        batch_size = my_run_info.adaptive_batch_size or max_workers
+    label = ensemble.get("label") or ensemble["sequence"]
+
+    outputs = []
+    first = ensemble["starting_model"]
+    while first <= ensemble["ending_model"]:
+        last = min(first + batch_size - 1, ensemble["ending_model"])
+        jobs = ensemble_jobs(**dict(ensemble, starting_model=first, ending_model=last, label=label),
+                             n_jobs=max_workers, out_dir=out_dir)
+        batch = run_parallel(jobs, max_workers).get(label, [])
+
+        # models are added in index order so the stopping point does not depend on which worker finished first
+        for output in sorted(batch, key=lambda x: x["num"]):
+            monitor.add(output)
+        outputs.extend(batch)
+        print(f"{label}: {monitor.progress()}")
+
+        reason = monitor.stop_reason()
+        if reason:
+            print(f"{label}: stopped after {monitor.n_models} models: {reason}")
+            break
+        first = last + 1
+
+    return rank_outputs(outputs)
+
+
+def write_summary(ranked: dict, path: str):
+    """Writes the merged, ranked outputs of every ensemble to one json file."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(ranked, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build MODELLER ensembles in parallel.")
+    parser.add_argument("--config", help="json list of ensembles (keys as the options below)")
+    parser.add_argument("--alnfile")
+    parser.add_argument("--knowns", nargs="+")
+    parser.add_argument("--sequence")
+    parser.add_argument("--label", help="Name of the ensemble's output directory (default: the sequence code)")
+    parser.add_argument("--models", nargs=2, type=int, metavar=("START", "END"), default=(1, 5))
+    parser.add_argument("--model-class", help='AutoModel subclass as "module:Class"')
+    parser.add_argument("--workers", type=int, default=my_run_info.model_workers)
+    parser.add_argument("--out-dir", default=my_run_info.models_out_dir)
+    parser.add_argument("--adaptive", action="store_true", default=my_run_info.adaptive_ensemble,
+                        help="Build in batches until the best DOPE score converges (END is the upper limit)")
+    parser.add_argument("--profile", action="store_true", help="Record a timeline of every stage and model build (profiling.py)")
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        profiling.enable()
+
+    if args.config:
+        with open(args.config) as f:
+            ensembles = json.load(f)
+    elif args.alnfile and args.knowns and args.sequence:
+        ensembles = [{
+            "alnfile": args.alnfile, "knowns": args.knowns, "sequence": args.sequence, "label": args.label,
+            "starting_model": args.models[0], "ending_model": args.models[1], "model_class": args.model_class,
+        }]
+    else:
+        parser.error("give --config or --alnfile, --knowns and --sequence")
+
+    if args.adaptive:
+        ranked = {}
+        for ensemble in ensembles:
+            label = ensemble.get("label") or ensemble["sequence"]
+            ranked[label] = run_until_converged(ensemble, max_workers=args.workers, out_dir=args.out_dir)
+    else:
+        jobs = []
+        for ensemble in ensembles:
+            jobs.extend(ensemble_jobs(n_jobs=args.workers, out_dir=args.out_dir, **ensemble))
+        ranked = run_parallel(jobs, args.workers)
+    write_summary(ranked, os.path.join(args.out_dir, "parallel_models_summary.json"))
+
+    for label, outputs in ranked.items():
+        ok_models = [x for x in outputs if x.get("failure") is None]
+        if ok_models:
+            print(f"{label}: top model {ok_models[0]['name']} (DOPE score {ok_models[0]['DOPE score']:.3f})")
+        else:
+            print(f"{label}: no models were built")
+    profiling.finish("parallel_models")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
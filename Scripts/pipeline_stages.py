@@ -0,0 +1,95 @@
+# Content-addressed stage bookkeeping for the pipeline:
+#   VCAb refine -> sequences -> FASTA -> alignment -> .pir -> models
+# Each stage output is named by a hash of everything it was built from (input file contents,
+# parameters and the keys of upstream stages). A stage whose outputs already exist for the
+# same key is skipped. Timestamped names are kept as aliases that point at the hashed files.
+
+import hashlib
+import json
+import os
+import shutil
+
+import my_run_info
+import profiling
+from file_hashes import file_sha256
+
+# Length of the key prefix used in file names
+short_key_length = 12
+
+
+def stage_key(stage: str, params: dict = None, input_files=(), upstream_keys=()) -> str:
+    """Returns the sha256 key of a stage from its name, parameters, input file contents and upstream keys."""
+    payload = {
+        "stage": stage,
+        "params": params or {},
+        "inputs": [file_sha256(path) for path in input_files],
+        "upstream": list(upstream_keys),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def short_key(key: str) -> str:
+    return key[:short_key_length]
+
+
+def manifest_path(stage: str, key: str, cache_dir: str = my_run_info.stage_cache_dir) -> str:
+    return os.path.join(cache_dir, f"{stage}_{short_key(key)}.json")
+
+
+def load_manifest(stage: str, key: str, cache_dir: str = my_run_info.stage_cache_dir):
+    """Returns the manifest of a finished stage, or None if the stage has not run
+    for this key or any of its recorded outputs has since been removed."""
+    path = manifest_path(stage, key, cache_dir)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get("key") != key:
+        return None
+    if not all(os.path.exists(output) for output in manifest["outputs"].values()):
+        return None
+    return manifest
+
+
+def record_stage(stage: str, key: str, outputs: dict, extra: dict = None,
+                 cache_dir: str = my_run_info.stage_cache_dir) -> dict:
+    """Writes the manifest marking a stage as done for this key."""
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = {"stage": stage, "key": key, "outputs": outputs}
+    if extra:
+        manifest.update(extra)
+
+    path = manifest_path(stage, key, cache_dir)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+    return manifest
+
+
+def run_stage(stage: str, key: str, outputs: dict, build, cache_dir: str = my_run_info.stage_cache_dir) -> bool:
+    """Runs build() unless the stage already finished for this key.
+    `outputs` maps output names to the (key-named) paths build() writes.
+    Returns True if the stage was skipped."""
+    if my_run_info.incremental_stages and load_manifest(stage, key, cache_dir) is not None:
+        print(f"[{stage}] up to date ({short_key(key)}), skipping")
+        return True
+
+    with profiling.stage(f"stage:{stage}", key=short_key(key)):
+        build()
+    missing = [path for path in outputs.values() if not os.path.exists(path)]
+    if missing:
+        raise RuntimeError(f"Stage '{stage}' did not write: {', '.join(missing)}")
+    record_stage(stage, key, outputs, cache_dir=cache_dir)
+    return False
+
+
+def alias(target_path: str, alias_path: str):
+    """Points a human-readable (e.g. timestamped) name at a key-named output.
+    Uses a relative symlink where possible and a copy otherwise (e.g. on Windows without symlink rights)."""
+    if os.path.lexists(alias_path):
+        os.remove(alias_path)
+    try:
+        os.symlink(os.path.relpath(target_path, os.path.dirname(alias_path) or "."), alias_path)
+    except OSError:
+        shutil.copyfile(target_path, alias_path)
@@ -1,13 +1,56 @@
 import pandas as pd
 import my_run_info
 import os
+import profiling
+from vcab_index import as_index
+from numbering_arrays import find_boundary_index
 
 
+# Columns kept by refine_VCAb() (especially the "_clean" ones)
+columns_to_keep = [
+    "pdb","Hchain", "Lchain", "H_seq", "L_seq", "H_coordinate_seq", "L_coordinate_seq", 
+    "H_PDB_numbering", "L_PDB_numbering", "pdb_H_VC_Boundary", "pdb_L_VC_Boundary", 
+    "title", "release_date","method", "resolution", "carbohydrate", "HC_species", 
+    "H_isotype_clean", "L_isotype_clean", "HC_coordinate_seq", 
+    "LC_coordinate_seq", "HV_seq", "LV_seq","disulfide_bond"
+]
+
+# Low-cardinality columns stored as pandas categories
+categorical_columns = ["method", "HC_species", "H_isotype_clean", "L_isotype_clean"]
+
+
+@profiling.profiled
 def load_VCAb():
     """Load the raw VCAb.csv database (from my_run_info.py) into a pandas DataFrame."""
     return pd.read_csv(my_run_info.VCAb_dir)
 
 
+@profiling.profiled
+def load_VCAb_chunked(csv_path: str = my_run_info.VCAb_dir, chunksize: int = my_run_info.VCAb_chunksize) -> pd.DataFrame:
+    """Load VCAb.csv in chunks, reading only the columns refine_VCAb() needs and 
+    filtering each chunk as it is read. Peak memory follows the refined table, not the raw csv.
+    Returns the same rows and columns as refine_VCAb(load_VCAb())."""
+
+    # The raw columns behind columns_to_keep ("_clean" columns are derived from Htype/Ltype)
+    raw_columns = [col for col in columns_to_keep if not col.endswith("_clean")] + ["Htype", "Ltype"]
+
+    # Repeated labels are read straight into categories
+    raw_categories = {col: "category" for col in ["method", "HC_species", "Htype", "Ltype"]}
+
+    refined_chunks = []
+    for chunk in pd.read_csv(csv_path, usecols=raw_columns, dtype=raw_categories, chunksize=chunksize):
+        refined_chunks.append(refine_VCAb(chunk))
+
+    df_refined = pd.concat(refined_chunks, ignore_index=True)
+
+    # Chunks carry their own category sets, so restore one shared set after joining
+    for col in categorical_columns:
+        df_refined[col] = df_refined[col].astype("category").cat.remove_unused_categories()
+
+    return df_refined
+
+
+@profiling.profiled
 def refine_VCAb(df):
     """Clean and reduce the VCAb DataFrame to important and clean columns only.
     By default, only keeps entries containing kappa light chains 
@@ -20,52 +63,40 @@ def refine_VCAb(df):
     df["L_isotype_clean"] = df["Ltype"].str.extract(r"^(\w+)")
 
     # Keep just the key columns (especially the "_clean" ones)
-    columns_to_keep = [
-        "pdb","Hchain", "Lchain", "H_seq", "L_seq", "H_coordinate_seq", "L_coordinate_seq", 
-        "H_PDB_numbering", "L_PDB_numbering", "pdb_H_VC_Boundary", "pdb_L_VC_Boundary", 
-        "title", "release_date","method", "resolution", "carbohydrate", "HC_species", 
-        "H_isotype_clean", "L_isotype_clean", "HC_coordinate_seq", 
-        "LC_coordinate_seq", "HV_seq", "LV_seq","disulfide_bond"
-    ]
     df_keep = df[columns_to_keep]
 
     # Filter down to rows of interest with conditions. Using wrapped conditions with & 
     # `[(cond_1) & (cond_2) & ...etc]`.
     df_refined_entries = df_keep[
         (df_keep["HC_species"] == "homo_sapiens") & 
-        (df_keep["L_isotype_clean"].str.contains("kappa", case=False))
+        (df_keep["L_isotype_clean"].str.contains("kappa", case=False, na=False))
     ]
     return df_refined_entries
 
 
 # Can be called separately for each template
-def zip_template_cif(df: pd.DataFrame, pdb_code: str):
-    """Takes in a filtered DataFrame and PDB code. Zips residues with PDB coordinates to their respective PDB numbering, 
-    only residues appearing in the x-ray structure are included. Outputs a list of tuples for residues and their numbering."""
+@profiling.profiled
+def zip_template_cif(df, pdb_code: str):
+    """Takes in a filtered DataFrame (or a VCAbIndex built from one) and PDB code. Zips residues with PDB coordinates 
+    to their respective PDB numbering, only residues appearing in the x-ray structure are included. 
+    Outputs ZippedChain objects, which iterate as (residue, number) tuples."""
     
-    # Using iterrows for stable behaviour in pandas
-    for idx, row in df.iterrows():
-
-        if row["pdb"] == pdb_code:
-            
-            # Parse .cif Heavy Chain 
-            heavy_cif_residue_list = list(row["H_coordinate_seq"])
-            heavy_cif_numbering_list = list(map(int, row["H_PDB_numbering"].split(",")))
-            heavy_cif_VC_boundary = int(row["pdb_H_VC_Boundary"])
-        
-            # Parse .cif Light Chain
-            light_cif_residue_list = list(row["L_coordinate_seq"])
-            light_cif_numbering_list = list(map(int, row["L_PDB_numbering"].split(",")))
-            light_cif_VC_boundary = int(row["pdb_L_VC_Boundary"])
-
-            # Create heavy/light chain zips
-            heavy_zip = (list(zip(heavy_cif_residue_list, heavy_cif_numbering_list)))
-            light_zip = (list(zip(light_cif_residue_list, light_cif_numbering_list)))
-            
-            print(f"Zipped light chain length: {len(light_zip)}")
-            print(f"Zipped heavy chain length: {len(heavy_zip)}")
-            print(f"Light chain VC boundary {light_cif_VC_boundary}th residue")
-            print(f"Heavy chain VC boundary {heavy_cif_VC_boundary}th residue")
+    # O(1) lookup of the template row by PDB code
+    index = as_index(df)
+    row_position = index.positions(pdb_code)[0]
+    row = index.df.iloc[row_position]
+
+    heavy_cif_VC_boundary = int(row["pdb_H_VC_Boundary"])
+    light_cif_VC_boundary = int(row["pdb_L_VC_Boundary"])
+
+    # Create heavy/light chain zips as slices of the numbering arrays parsed once for the whole table
+    heavy_zip = index.numbering("H").chain(row_position)
+    light_zip = index.numbering("L").chain(row_position)
+    
+    print(f"Zipped light chain length: {len(light_zip)}")
+    print(f"Zipped heavy chain length: {len(heavy_zip)}")
+    print(f"Light chain VC boundary {light_cif_VC_boundary}th residue")
+    print(f"Heavy chain VC boundary {heavy_cif_VC_boundary}th residue")
 
     return (light_zip, heavy_zip, light_cif_VC_boundary, heavy_cif_VC_boundary)
 
@@ -73,14 +104,9 @@ def zip_template_cif(df: pd.DataFrame, pdb_code: str):
 def get_constant_region(light_zip, heavy_zip, light_boundary, heavy_boundary):
     """Extracts the tuple after the Variable-Constant boundary within a heavy/light chain zip."""
 
-    # Expression format: `(return this for (item1, item2) in iterable if condition)`
-    # expression - what we want to return
-    # for ... in ... - the loop part
-    # if ... - optional condition
-
     # Find index of the boundary tuple in each chain
-    light_boundary_index = next(i for i, (_, num) in enumerate(light_zip) if num == light_boundary)
-    heavy_boundary_index = next(i for i, (_, num) in enumerate(heavy_zip) if num == heavy_boundary)
+    light_boundary_index = find_boundary_index(light_zip, light_boundary)
+    heavy_boundary_index = find_boundary_index(heavy_zip, heavy_boundary)
 
     #print(f"Light Boundary tuple index: {light_boundary_index}")
     #print(f"Heavy Boundary tuple index: {heavy_boundary_index}")
@@ -96,8 +122,8 @@ def get_variable_region(light_zip, heavy_zip, light_boundary, heavy_boundary):
     """Extracts the tuple before the Variable-Constant boundary within a heavy/light chain zip."""
 
     # Find index of the boundary tuple in each chain
-    light_boundary_index = next(i for i, (_, num) in enumerate(light_zip) if num == light_boundary)
-    heavy_boundary_index = next(i for i, (_, num) in enumerate(heavy_zip) if num == heavy_boundary)
+    light_boundary_index = find_boundary_index(light_zip, light_boundary)
+    heavy_boundary_index = find_boundary_index(heavy_zip, heavy_boundary)
 
     #print(f"Light Boundary tuple index: {light_boundary_index}")
     #print(f"Heavy Boundary tuple index: {heavy_boundary_index}")
@@ -132,6 +158,13 @@ def make_recombinant_seqs(vl_zip, vh_zip, cl_zip, ch_zip):
     return (recombinant_seq_light, recombinant_seq_heavy)
 
 
+def first_and_last_numbers(numbering: pd.Series):
+    """Returns the first and last residue numbers of each comma-separated PDB numbering string."""
+    first_residue_nos = numbering.str.extract(r"^\s*(-?\d+)")[0].astype(int)
+    last_residue_nos = numbering.str.extract(r"(-?\d+)\s*$")[0].astype(int)
+    return (first_residue_nos, last_residue_nos)
+
+
 def make_df_heavies(df_filtered: pd.DataFrame, recombinant_seq_heavy) -> pd.DataFrame:
     """Creates a new dataframe for heavy chain metadata from an already-filtered dataframe."""
 
@@ -147,16 +180,8 @@ def make_df_heavies(df_filtered: pd.DataFrame, recombinant_seq_heavy) -> pd.Data
     # Clean Hchain to keep only first character
     df_heavies["Hchain"] = df_heavies["Hchain"].str[0]
     
-    first_residue_nos = []
-    last_residue_nos = []
-
-    # Using iterrows for stable behaviour in pandas
-    for idx, row in df_filtered.iterrows():
-
-        # Split the string of numbering to a list and extract start/end values
-        residue_numbering_list = list(map(int, row["H_PDB_numbering"].split(",")))
-        last_residue_nos.append(residue_numbering_list[-1])
-        first_residue_nos.append(residue_numbering_list[0])
+    # Extract start/end values from the string of numbering for every row at once
+    first_residue_nos, last_residue_nos = first_and_last_numbers(df_filtered["H_PDB_numbering"])
     
     #Add new columns to new df
     df_heavies["H_chain_first_residue"] = first_residue_nos
@@ -197,16 +222,8 @@ def make_df_lights(df_filtered: pd.DataFrame, recombinant_seq_light) -> pd.DataF
     # Clean Hchain to keep only first character
     df_lights["Lchain"] = df_lights["Lchain"].str[0]
     
-    first_residue_nos = []
-    last_residue_nos = []
-
-    # Using iterrows for stable behaviour in pandas
-    for idx, row in df_filtered.iterrows():
-
-        # Split the string of numbering to a list and extract start/end values
-        residue_numbering_list = list(map(int, row["L_PDB_numbering"].split(",")))
-        last_residue_nos.append(residue_numbering_list[-1])
-        first_residue_nos.append(residue_numbering_list[0])
+    # Extract start/end values from the string of numbering for every row at once
+    first_residue_nos, last_residue_nos = first_and_last_numbers(df_filtered["L_PDB_numbering"])
     
     #Add new columns to new df
     df_lights["L_chain_first_residue"] = first_residue_nos
@@ -232,11 +249,14 @@ def make_df_lights(df_filtered: pd.DataFrame, recombinant_seq_light) -> pd.DataF
     return df_lights
 
 
-def write_fastas(df_l, df_h, fasta_out_dir, df_filtered, timestamp):
-    """Write 2 fasta files for light and heavy chains."""
+@profiling.profiled
+def write_fastas(df_l, df_h, fasta_out_dir, df_filtered, timestamp, isotype=None):
+    """Write 2 fasta files for light and heavy chains.
+    Returns the (light, heavy) file paths, or None if writing failed."""
         
-    # Create isotype label to add to the filename
-    isotype = str(df_filtered.query("template == 'c_template'")["H_isotype_clean"].iloc[0])
+    # Create isotype label to add to the filename (unless one is given)
+    if isotype is None:
+        isotype = str(df_filtered.query("template == 'c_template'")["H_isotype_clean"].iloc[0])
 
     try:
         # ===Light FASTA===
@@ -249,7 +269,7 @@ def write_fastas(df_l, df_h, fasta_out_dir, df_filtered, timestamp):
                 if pd.isna(row["Lchain"]):
                     chain = ""
                 else:
-                    chain = f"Chain {row["Lchain"]}|"
+                    chain = f"Chain {row['Lchain']}|"
 
                 header = (
                     f'>{row["pdb"]}|{chain}Light_Chain_Fab_{row["H_isotype_clean"]} {row["template"]}|'
@@ -269,7 +289,7 @@ def write_fastas(df_l, df_h, fasta_out_dir, df_filtered, timestamp):
                 if pd.isna(row["Hchain"]):
                     chain = ""
                 else:
-                    chain = f"Chain {row["Hchain"]}|"
+                    chain = f"Chain {row['Hchain']}|"
 
                 header = (
                     f'>{row["pdb"]}|{chain}Heavy_Chain_Fab_{row["H_isotype_clean"]} {row["template"]}|'
@@ -281,4 +301,7 @@ def write_fastas(df_l, df_h, fasta_out_dir, df_filtered, timestamp):
 
     except Exception as e:
         print(f"Error whilst writing FASTA file: {e}")
+        return None
+
+    return (stamped_l_file, stamped_h_file)
 
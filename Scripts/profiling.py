@@ -0,0 +1,296 @@
+# Stage-level profiling of the pipeline.
+# With profiling on, every stage records its wall time, CPU time and memory: the peak resident set
+# size (RSS) during the stage, which includes allocations made by C code such as MODELLER, the RSS at
+# its end and how much it grew, plus the peak of Python allocations within the stage with
+# profile_memory = "tracemalloc". The per-stage peak needs Linux: the kernel's RSS high-water mark
+# (VmHWM) is reset by writing 5 to /proc/self/clear_refs when a stage starts. Elsewhere only the
+# process-wide high-water mark is kept, as process_peak_rss_mb. At the end of a run a Chrome trace
+# (open it in chrome://tracing or https://ui.perfetto.dev) and a summary table are written to profile_dir.
+# With profiling off, stage() returns a shared no-op context and profiled functions are called directly.
+#
+# Profiling is turned on by profile_pipeline in my_run_info.py, by PIPELINE_PROFILE=1 in the
+# environment, or by --profile on run_batch_pipeline.py and parallel_models.py. Worker processes
+# inherit the setting and write their own events, which finish() merges into the run's trace.
+#
+#   with profiling.stage("align", label="IgG4"): ...
+#   @profiling.profiled
+#   def refine_VCAb(df): ...
+
+import functools
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import nullcontext
+from datetime import datetime
+
+import my_run_info
+
+try:
+    import resource  # not on Windows
+except ImportError:
+    resource = None
+
+_env_flag = "PIPELINE_PROFILE"
+_env_run = "PIPELINE_PROFILE_RUN"
+_env_dir = "PIPELINE_PROFILE_DIR"
+_noop = nullcontext()
+
+_enabled = False
+_events = []
+_stack = []  # running tracemalloc peaks of the open stages
+_rss_stack = []  # running RSS peaks (MB) of the open stages
+_hwm_resettable = None  # whether /proc/self/clear_refs can reset VmHWM (checked on first use)
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def enable(run_id: str = None):
+    """Turns profiling on for this process and for worker processes started after this call."""
+    global _enabled
+    _enabled = True
+    os.environ[_env_flag] = "1"
+    os.environ.setdefault(_env_run, run_id or datetime.now().strftime("%Y%m%d_%H%M%S"))
+    # resolved now, as the model scripts and workers change directory
+    os.environ.setdefault(_env_dir, os.path.abspath(my_run_info.profile_dir))
+    if my_run_info.profile_memory == "tracemalloc" and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def run_id() -> str:
+    return os.environ.setdefault(_env_run, datetime.now().strftime("%Y%m%d_%H%M%S"))
+
+
+def run_dir() -> str:
+    """Directory of this run's trace files."""
+    return os.path.join(os.environ.get(_env_dir, os.path.abspath(my_run_info.profile_dir)), run_id())
+
+
+def _rss_mb() -> float:
+    """Current resident set size of this process, in MB (None where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def _hwm_mb() -> float:
+    """RSS high-water mark of this process since it was last reset (VmHWM), in MB (None without /proc)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _reset_hwm() -> bool:
+    """Resets VmHWM to the current RSS. Returns False where that is not possible (not Linux, or not permitted)."""
+    global _hwm_resettable
+    if _hwm_resettable is False:
+        return False
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        _hwm_resettable = _hwm_mb() is not None
+    except OSError:
+        _hwm_resettable = False
+    return _hwm_resettable
+
+
+def _peak_rss_mb() -> float:
+    """High-water mark of the resident set size of this process so far (not of one stage), in MB
+    (None where unavailable)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class _Stage:
+    __slots__ = ("name", "args", "start_ns", "start_epoch_us", "cpu_start", "rss_start")
+
+    def __init__(self, name: str, args: dict):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        if tracemalloc.is_tracing():
+            # keep the enclosing stage's peak before resetting it for this one
+            if _stack:
+                _stack[-1] = max(_stack[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            _stack.append(0)
+        if _hwm_resettable is not False:
+            # keep the enclosing stage's peak before resetting the high-water mark for this one
+            peak = _hwm_mb()
+            if _rss_stack and peak is not None:
+                _rss_stack[-1] = max(_rss_stack[-1], peak)
+            if _reset_hwm():
+                _rss_stack.append(0.0)
+        self.rss_start = _rss_mb()
+        self.cpu_start = time.process_time()
+        self.start_epoch_us = time.time_ns() / 1000  # comparable between processes
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end_ns = time.perf_counter_ns()
+        args = dict(self.args, cpu_s=round(time.process_time() - self.cpu_start, 6))
+        if tracemalloc.is_tracing():
+            peak = max(_stack.pop(), tracemalloc.get_traced_memory()[1])
+            if _stack:
+                _stack[-1] = max(_stack[-1], peak)
+            args["peak_traced_mb"] = round(peak / (1024 * 1024), 3)
+        rss = _rss_mb()
+        if rss is not None:
+            args["rss_mb"] = round(rss, 1)
+            if self.rss_start is not None:
+                args["rss_growth_mb"] = round(rss - self.rss_start, 1)
+        if _hwm_resettable and _rss_stack:
+            peak = max(_rss_stack.pop(), _hwm_mb() or 0.0)
+            if _rss_stack:
+                _rss_stack[-1] = max(_rss_stack[-1], peak)
+            args["peak_rss_mb"] = round(peak, 1)
+        else:
+            process_peak = _peak_rss_mb()
+            if process_peak is not None:
+                args["process_peak_rss_mb"] = round(process_peak, 1)
+        if exc[0] is not None:
+            args["error"] = exc[0].__name__
+        _events.append({
+            "name": self.name, "ph": "X", "pid": os.getpid(), "tid": 0,
+            "ts": self.start_epoch_us, "dur": (end_ns - self.start_ns) / 1000, "args": args,
+        })
+        return False
+
+
+def stage(name: str, **args):
+    """Context manager timing one stage. Keyword arguments are stored with the event."""
+    if not _enabled:
+        return _noop
+    return _Stage(name, args)
+
+
+def profiled(func=None, *, name: str = None):
+    """Decorator running a function inside stage(name or the function's name)."""
+    if func is None:
+        return functools.partial(profiled, name=name)
+    stage_name = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        with _Stage(stage_name, {}):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class ProfiledModelMixin:
+    """Times every model build of an AutoModel, with profiling on or off: the wall and CPU seconds
+    and the finish time are added to the model's output as elapsed_s, cpu_s and finished (kept if
+    the output already has them, e.g. a model restored from a checkpoint). With profiling on, each
+    build is also recorded as a "single_model" stage."""
+
+    def single_model(self, atmsel, num, *args, **kwargs):
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        with stage("single_model", sequence=self.sequence, num=num):
+            output = super().single_model(atmsel, num, *args, **kwargs)
+        if isinstance(output, dict):
+            output.setdefault("elapsed_s", round(time.perf_counter() - start, 3))
+            output.setdefault("cpu_s", round(time.process_time() - cpu_start, 3))
+            output.setdefault("finished", datetime.now().isoformat(timespec="seconds"))
+        return output
+
+
+def with_profiling(model_class):
+    """Returns a subclass of model_class with ProfiledModelMixin added, so every model is timed."""
+    if issubclass(model_class, ProfiledModelMixin):
+        return model_class
+    return type(f"Profiled{model_class.__name__}", (ProfiledModelMixin, model_class), {})
+
+
+def flush_worker(label: str):
+    """Writes the events of a worker process so far to the run's directory and clears them."""
+    if not _enabled or not _events:
+        return
+    out_dir = run_dir()
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"worker_{os.getpid()}_{label}_{time.perf_counter_ns()}.json")
+    with open(path, "w") as f:
+        json.dump(_events, f)
+    _events.clear()
+
+
+def summarise(events: list) -> list:
+    """One row per stage name: calls, total and mean wall time, total CPU time and, over all calls,
+    the largest peak RSS, RSS at the end of the stage, RSS growth during it and peak of traced allocations."""
+    rows = {}
+    for event in events:
+        row = rows.setdefault(event["name"], {"stage": event["name"], "calls": 0, "wall_s": 0.0, "cpu_s": 0.0,
+                                              "peak_rss_mb": None, "rss_mb": None, "rss_growth_mb": None,
+                                              "peak_traced_mb": None})
+        row["calls"] += 1
+        row["wall_s"] += event["dur"] / 1e6
+        row["cpu_s"] += event["args"].get("cpu_s", 0.0)
+        for name in ("peak_rss_mb", "rss_mb", "rss_growth_mb", "peak_traced_mb"):
+            value = event["args"].get(name)
+            if value is not None:
+                row[name] = value if row[name] is None else max(row[name], value)
+    for row in rows.values():
+        row["mean_s"] = row["wall_s"] / row["calls"]
+    return sorted(rows.values(), key=lambda row: row["wall_s"], reverse=True)
+
+
+def format_summary(rows: list) -> str:
+    def mb(value):
+        return f"{value:.1f}" if value is not None else "-"
+
+    lines = [f"{'stage':<28} {'calls':>6} {'wall s':>10} {'mean s':>10} {'cpu s':>10} {'peak MB':>9} {'RSS MB':>9} "
+             f"{'+RSS MB':>9} {'traced MB':>10}"]
+    for row in rows:
+        lines.append(f"{row['stage']:<28} {row['calls']:>6} {row['wall_s']:>10.3f} {row['mean_s']:>10.3f} {row['cpu_s']:>10.3f} "
+                     f"{mb(row['peak_rss_mb']):>9} {mb(row['rss_mb']):>9} {mb(row['rss_growth_mb']):>9} "
+                     f"{mb(row['peak_traced_mb']):>10}")
+    return "\n".join(lines)
+
+
+def finish(label: str = "pipeline"):
+    """Merges this process's events with those written by workers, writes the Chrome trace
+    ({label}_{run}.trace.json) and summary ({label}_{run}.summary.json), and prints the summary.
+    Returns the trace path, or None if profiling is off."""
+    if not _enabled:
+        return None
+    out_dir = run_dir()
+    events = list(_events)
+    for path in sorted(glob.glob(os.path.join(out_dir, "worker_*.json"))):
+        with open(path) as f:
+            events.extend(json.load(f))
+
+    rows = summarise(events)
+    os.makedirs(out_dir, exist_ok=True)
+    trace_path = os.path.join(out_dir, f"{label}_{run_id()}.trace.json")
+    with open(trace_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                   "otherData": {"label": label, "run": run_id(), "memory": my_run_info.profile_memory}}, f)
+    with open(os.path.join(out_dir, f"{label}_{run_id()}.summary.json"), "w") as f:
+        json.dump(rows, f, indent=1)
+
+    print(format_summary(rows))
+    print(f"Profile trace written to {trace_path}")
+    return trace_path
+
+
+if my_run_info.profile_pipeline or os.environ.get(_env_flag) == "1":
+    enable()
@@ -0,0 +1,243 @@
+# Maps template residue numbers (PDB/EU numbering, per chain) to the residue IDs MODELLER gives the target.
+# MODELLER numbers the target residues 1..N consecutively over all chains, and names the chains A, B, C, ...
+# in the order of the '/'-separated segments of the .pir target sequence. Instead of working out offsets by
+# hand ("Pro 329 + 218 = 547"), the map is built once from the alignment and the template's .cif file as
+# lookup arrays, and restraints and patches are declared in template numbering, e.g.
+#   numbering = NumberingMap.from_alignment("../pir_files/x.pir", "IgG4ModellerHingeTemplate")
+#   numbering.residue_id("B", 226)               # "444:B"
+#   numbering.model_numbers("B", [226, 229])     # array([444, 447])
+#   patch_specs = hinge_disulfides("IgG4", heavy_chains=("B", "D"))
+#
+# Usage (from the Scripts directory), to check the residues before building models:
+#   python residue_numbering.py --alnfile ../pir_files/x.pir --template IgG4ModellerHingeTemplate \
+#       --isotypes IgG1 IgG2 IgG4 --heavy-chains B D
+
+import argparse
+import string
+
+import numpy as np
+
+import cif_reader
+from convert_to_pir import read_pir
+from restraint_cache import find_template_files
+from template_superposition import template_residue_keys
+
+# Inter-heavy-chain disulfides of the hinge (EU numbering): the cysteine at each position in the
+# first heavy chain is bonded to the same cysteine in the second. Add isotypes here as they are modelled.
+hinge_cysteines = {
+    "IgG1": [226, 229],
+    "IgG2": [219, 220, 226, 229],
+    "IgG4": [226, 229],
+}
+
+
+def disulfide(chain_a: str, number_a, chain_b: str, number_b) -> dict:
+    """A DISU patch between two template residues; numbers are ints or strings with an insertion code ("100A")."""
+    return {"type": "disulfide", "residues": [[chain_a, str(number_a)], [chain_b, str(number_b)]]}
+
+
+def distance(atom_a, atom_b, mean: float, stdev: float, group: str = "xy_distance") -> dict:
+    """A Gaussian distance restraint between two template atoms given as (atom, chain, number)."""
+    return {"type": "distance", "atoms": [[str(x) for x in atom_a], [str(x) for x in atom_b]],
+            "mean": mean, "stdev": stdev, "group": group}
+
+
+def hinge_disulfides(isotype: str, heavy_chains=("B", "D")) -> list:
+    """DISU patch specs for the inter-heavy-chain hinge disulfides of an isotype."""
+    if isotype not in hinge_cysteines:
+        raise KeyError(f"No hinge disulfides defined for {isotype}, add them to hinge_cysteines")
+    first, second = heavy_chains
+    return [disulfide(first, number, second, number) for number in hinge_cysteines[isotype]]
+
+
+def split_number(number) -> tuple:
+    """"100A" -> (100, "A"), 226 -> (226, "")."""
+    text = str(number).strip()
+    icode = text.lstrip("-0123456789")
+    return int(text[:len(text) - len(icode)]), icode
+
+
+def model_chain_ids(n_segments: int) -> list:
+    """Chain IDs MODELLER gives the target's chain segments."""
+    return list((string.ascii_uppercase + string.ascii_lowercase + string.digits)[:n_segments])
+
+
+class NumberingMap:
+    """Template residue (chain, PDB number, insertion code) -> target residue number and chain.
+
+    For every template chain, `lookup[chain][number - first[chain]]` is the target residue number
+    (-1 where the template residue is not aligned to a target residue). Residues with insertion
+    codes are kept in `inserted`."""
+
+    def __init__(self, template_chains, template_numbers, template_icodes, model_numbers, model_chains, model_residues):
+        self.model_chains = model_chains          # chain ID of every target residue (index = number - 1)
+        self.model_residues = model_residues      # one-letter code of every target residue
+        self.lookup = {}
+        self.first = {}
+        self.inserted = {}
+        plain = template_icodes == ""
+        for chain in np.unique(template_chains).tolist():
+            in_chain = (template_chains == chain) & plain
+            numbers = template_numbers[in_chain]
+            if numbers.size == 0:
+                continue
+            self.first[chain] = int(numbers.min())
+            table = np.full(int(numbers.max()) - self.first[chain] + 1, -1, dtype=np.int64)
+            table[numbers - self.first[chain]] = model_numbers[in_chain]
+            self.lookup[chain] = table
+        for chain, number, icode, model_number in zip(
+                template_chains[~plain], template_numbers[~plain], template_icodes[~plain], model_numbers[~plain]):
+            self.inserted[(str(chain), int(number), str(icode))] = int(model_number)
+
+    @classmethod
+    def from_entries(cls, target: dict, template: dict, atoms: dict) -> "NumberingMap":
+        """Builds the map from the target and template entries of a .pir alignment (convert_to_pir.read_pir)
+        and the template's atoms (cif_reader.read_atoms)."""
+        target_seq = np.frombuffer(target["sequence"].encode(), dtype="S1")
+        template_seq = np.frombuffer(template["sequence"].encode(), dtype="S1")
+        if len(target_seq) != len(template_seq):
+            raise ValueError(f"{target['code']} and {template['code']} have different alignment lengths")
+
+        target_residue = np.char.isalpha(target_seq)
+        template_residue = np.char.isalpha(template_seq)
+        target_index = np.cumsum(target_residue) - 1
+        template_index = np.cumsum(template_residue) - 1
+        segment = np.cumsum(target_seq == b"/")
+
+        header = template["header"]
+        keys = template_residue_keys(atoms, header[2], header[3], int(template_residue.sum()))
+        chains, numbers = np.char.partition(keys.astype(str), ":")[:, [0, 2]].T
+        icodes = np.char.lstrip(numbers, "-0123456789")
+        numbers = np.array([int(n[:len(n) - len(i)]) for n, i in zip(numbers, icodes)], dtype=np.int64)
+
+        aligned = target_residue & template_residue
+        chain_ids = np.array(model_chain_ids(int(segment[-1]) + 1))
+        return cls(
+            chains[template_index[aligned]],
+            numbers[template_index[aligned]],
+            icodes[template_index[aligned]],
+            target_index[aligned] + 1,
+            chain_ids[segment[target_residue]],
+            target_seq[target_residue].astype(str),
+        )
+
+    @classmethod
+    def from_alignment(cls, alnfile: str, template_code: str, atom_files_directory=(".", "../atom_files"),
+                       target_code: str = None) -> "NumberingMap":
+        """Builds the map from a .pir alignment and the template's .cif file."""
+        entries = read_pir(alnfile)
+        targets = [entry for entry in entries
+                   if entry["type"] == "sequence" and (target_code is None or entry["code"] == target_code)]
+        templates = [entry for entry in entries if entry["code"] == template_code]
+        if len(targets) != 1 or not templates:
+            raise ValueError(f"{alnfile} needs one target entry and a {template_code} entry")
+        files = find_template_files([template_code], atom_files_directory)
+        if not files or not files[0].endswith((".cif", ".cif.gz")):
+            raise FileNotFoundError(f"No .cif file for {template_code} in {', '.join(atom_files_directory)}")
+        return cls.from_entries(targets[0], templates[0], cif_reader.read_atoms(files[0]))
+
+    def model_numbers(self, chain: str, numbers, icode: str = "") -> np.ndarray:
+        """Target residue numbers of template residues of one chain (-1 where not aligned)."""
+        numbers = np.asarray(numbers, dtype=np.int64)
+        out = np.full(numbers.shape, -1, dtype=np.int64)
+        if icode:
+            return np.array([self.inserted.get((chain, int(n), icode), -1) for n in numbers.ravel()]).reshape(numbers.shape)
+        if chain not in self.lookup:
+            return out
+        index = numbers - self.first[chain]
+        valid = (index >= 0) & (index < len(self.lookup[chain]))
+        out[valid] = self.lookup[chain][index[valid]]
+        return out
+
+    def residue_id(self, chain: str, number) -> str:
+        """MODELLER residue ID ("444:B") of a template residue (number may carry an insertion code, "100A")."""
+        resseq, icode = split_number(number)
+        model_number = int(self.model_numbers(chain, [resseq], icode)[0])
+        if model_number < 0:
+            raise KeyError(f"Template residue {chain}:{number} is not aligned to a target residue")
+        return f"{model_number}:{self.model_chains[model_number - 1]}"
+
+    def residue_type(self, residue_id: str) -> str:
+        """One-letter code of a target residue ID."""
+        return self.model_residues[int(residue_id.split(":")[0]) - 1]
+
+    def patch_residues(self, spec: dict) -> list:
+        """Target residue IDs of a disulfide spec, checking both are cysteines in the target."""
+        ids = [self.residue_id(chain, number) for chain, number in spec["residues"]]
+        not_cys = [f"{i} ({self.residue_type(i)})" for i in ids if self.residue_type(i) != "C"]
+        if not_cys:
+            raise ValueError(f"Disulfide {spec['residues']} maps to non-cysteine target residues: {', '.join(not_cys)}")
+        return ids
+
+
+class NumberedRestraintsMixin:
+    """special_restraints()/special_patches() from declarative specs in template numbering.
+    `restraint_specs` and `patch_specs` are lists of distance() and disulfide() specs, mapped through
+    the alignment to `numbering_template` (default: the first template)."""
+    restraint_specs = []
+    patch_specs = []
+    numbering_template = None
+
+    def numbering(self) -> NumberingMap:
+        if getattr(self, "_numbering", None) is None:
+            knowns = [self.knowns] if isinstance(self.knowns, str) else list(self.knowns)
+            self._numbering = NumberingMap.from_alignment(
+                self.alnfile, self.numbering_template or knowns[0], self.env.io.atom_files_directory, self.sequence
+            )
+        return self._numbering
+
+    def add_restraint_specs(self):
+        from modeller import forms, features, physical
+
+        numbering = self.numbering()
+        for spec in self.restraint_specs:
+            if spec["type"] != "distance":
+                raise ValueError(f"Unknown restraint spec type {spec['type']}")
+            (atom_a, chain_a, number_a), (atom_b, chain_b, number_b) = spec["atoms"]
+            self.restraints.add(forms.Gaussian(
+                group=getattr(physical, spec["group"]),
+                feature=features.Distance(self.atoms[f"{atom_a}:{numbering.residue_id(chain_a, number_a)}"],
+                                          self.atoms[f"{atom_b}:{numbering.residue_id(chain_b, number_b)}"]),
+                mean=spec["mean"], stdev=spec["stdev"]))
+
+    def add_patch_specs(self):
+        numbering = self.numbering()
+        self.patched_pairs = getattr(self, "patched_pairs", set())
+        for spec in self.patch_specs:
+            if spec["type"] != "disulfide":
+                raise ValueError(f"Unknown patch spec type {spec['type']}")
+            residue_a, residue_b = numbering.patch_residues(spec)
+            self.patched_pairs.add(frozenset((residue_a, residue_b)))
+            self.patch(residue_type="DISU", residues=(self.residues[residue_a], self.residues[residue_b]))
+
+    def special_restraints(self, aln):
+        self.add_restraint_specs()
+
+    def special_patches(self, aln):
+        self.add_patch_specs()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show the target residues that template-numbered patches map to.")
+    parser.add_argument("--alnfile", required=True)
+    parser.add_argument("--template", required=True, help="Template code whose numbering the specs use")
+    parser.add_argument("--isotypes", nargs="+", default=sorted(hinge_cysteines))
+    parser.add_argument("--heavy-chains", nargs=2, default=["B", "D"], help="The two heavy chains of the template")
+    parser.add_argument("--atom-files", nargs="+", default=[".", "../atom_files"])
+    args = parser.parse_args(argv)
+
+    numbering = NumberingMap.from_alignment(args.alnfile, args.template, args.atom_files)
+    for isotype in args.isotypes:
+        print(f"{isotype}:")
+        for spec in hinge_disulfides(isotype, args.heavy_chains):
+            (chain_a, number_a), (chain_b, number_b) = spec["residues"]
+            try:
+                residue_a, residue_b = numbering.patch_residues(spec)
+                print(f"  DISU {chain_a}:{number_a} - {chain_b}:{number_b} -> '{residue_a}' - '{residue_b}'")
+            except (KeyError, ValueError) as e:
+                print(f"  DISU {chain_a}:{number_a} - {chain_b}:{number_b}: {e}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,99 @@
+# Cache for the homology restraints AutoModel builds in mkhomcsr().
+# Restraints only depend on the alignment, the template structures and the restraint/patch rules,
+# not on the random seed, so a new seed, ensemble or resumed run can read them back instead of
+# deriving them again. The cache key covers the alignment contents, the template atom files,
+# the source of special_restraints()/special_patches(), any restraint/patch specs and the MODELLER version.
+#
+# Use it by putting RestraintCacheMixin before AutoModel (after any other mixins):
+#   class MyModel(CheckpointMixin, RestraintCacheMixin, AutoModel): ...
+# or wrap an existing class with with_restraint_cache(AutoModel).
+
+import inspect
+import os
+
+import my_run_info
+import pipeline_stages
+
+# Names MODELLER tries for a template code's atom file
+_atom_file_patterns = ("{code}", "{code}.atm", "{code}.pdb", "{code}.cif", "pdb{code}.ent",
+                       "{code}.pdb.gz", "{code}.cif.gz", "pdb{code}.ent.gz")
+
+
+def find_template_files(knowns, atom_files_directory) -> list:
+    """Returns the atom files MODELLER would read for the template codes, searching the directories in order."""
+    if isinstance(knowns, str):
+        knowns = [knowns]
+
+    found = []
+    for code in knowns:
+        for directory in atom_files_directory:
+            matches = [
+                os.path.join(directory, pattern.format(code=code)) for pattern in _atom_file_patterns
+                if os.path.isfile(os.path.join(directory, pattern.format(code=code)))
+            ]
+            if matches:
+                found.append(matches[0])
+                break
+    return found
+
+
+def _method_source(model_class, name: str) -> str:
+    method = getattr(model_class, name, None)
+    if method is None:
+        return ""
+    try:
+        return inspect.getsource(method)
+    except (OSError, TypeError):
+        return method.__qualname__
+
+
+class RestraintCacheMixin:
+    """Loads restraints from restraint_cache_dir when the same alignment, templates and rules were
+    used before, and stores them there otherwise."""
+    restraint_cache_dir = os.path.abspath(my_run_info.restraint_cache_dir)  # resolved before scripts chdir to ../models
+
+    def restraint_key(self) -> str:
+        import modeller
+
+        knowns = [self.knowns] if isinstance(self.knowns, str) else list(self.knowns)
+        model_class = type(self)
+        return pipeline_stages.stage_key(
+            "restraints",
+            {
+                "knowns": knowns,
+                "sequence": self.sequence,
+                "special_restraints": _method_source(model_class, "special_restraints"),
+                "special_patches": _method_source(model_class, "special_patches"),
+                "restraint_specs": getattr(self, "restraint_specs", None),
+                "patch_specs": getattr(self, "patch_specs", None),
+                "disulfides": self.disulfide_inputs() if hasattr(self, "disulfide_inputs") else None,
+                "spline_on_site": getattr(self, "spline_on_site", None),
+                "modeller": modeller.info.version,
+            },
+            input_files=[self.alnfile] + find_template_files(knowns, self.env.io.atom_files_directory),
+        )
+
+    def mkhomcsr(self, *args, **kwargs):
+        cache_dir = os.path.abspath(self.restraint_cache_dir)
+        key = self.restraint_key()
+        cache_path = os.path.join(cache_dir, f"{self.sequence}_{pipeline_stages.short_key(key)}.rsr")
+
+        if os.path.isfile(cache_path):
+            print(f"Reading cached restraints {cache_path}")
+            self.restraints.clear()
+            self.restraints.append(file=cache_path)
+            return
+
+        super().mkhomcsr(*args, **kwargs)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        self.restraints.write(file=tmp_path)
+        os.replace(tmp_path, cache_path)
+
+
+def with_restraint_cache(model_class):
+    """Returns a subclass of model_class (e.g. AutoModel) with RestraintCacheMixin added."""
+    if issubclass(model_class, RestraintCacheMixin):
+        return model_class
+    return type(f"RestraintCached{model_class.__name__}", (RestraintCacheMixin, model_class), {})
@@ -0,0 +1,195 @@
+# SQLite store for model-building results, replacing the per-run pickle files of a.outputs.
+# One row per MODELLER run (templates, isotype, alignment hash, timing) and one row per model
+# (name, scores, failure state, build time and finish time). Several build processes can write to the same database.
+#
+# Usage (from the Scripts directory):
+#   python results_store.py --top 5                 # best 5 models by DOPE for every isotype
+#   python results_store.py --top 5 --isotype IgG4
+#   python results_store.py --import-pickle ../pickles/model_outputs_IgG4_....pkl --isotype IgG4
+
+import argparse
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+import my_run_info
+from file_hashes import file_sha256
+
+_schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created TEXT NOT NULL,
+    target TEXT,
+    template_v TEXT,
+    template_c TEXT,
+    knowns TEXT,
+    isotype TEXT,
+    alignment_path TEXT,
+    alignment_sha256 TEXT,
+    models_dir TEXT,
+    elapsed_s REAL
+);
+CREATE TABLE IF NOT EXISTS models (
+    model_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    name TEXT,
+    isotype TEXT,
+    dope REAL,
+    ga341 REAL,
+    molpdf REAL,
+    failure TEXT,
+    elapsed_s REAL,
+    cpu_s REAL,
+    finished TEXT
+);
+CREATE INDEX IF NOT EXISTS models_isotype_dope ON models (isotype, dope);
+CREATE INDEX IF NOT EXISTS models_run ON models (run_id);
+CREATE INDEX IF NOT EXISTS runs_alignment ON runs (alignment_sha256);
+"""
+
+
+def connect(db_path: str = my_run_info.results_db) -> sqlite3.Connection:
+    """Opens (and creates if needed) the results database.
+    WAL mode lets readers work while a build process writes, and the busy timeout
+    makes concurrent writers wait for each other instead of failing."""
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.executescript(_schema)
+    _migrate(conn)
+    return conn
+
+
+# Columns added to existing databases by connect(): {table: [(column, type), ...]}
+_added_columns = {
+    "models": [("elapsed_s", "REAL"), ("cpu_s", "REAL"), ("finished", "TEXT")],
+}
+
+
+def _migrate(conn: sqlite3.Connection):
+    """Adds the columns that databases created by older versions are missing."""
+    for table, columns in _added_columns.items():
+        existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for column, column_type in columns:
+            if column not in existing:
+                try:
+                    with conn:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+                except sqlite3.OperationalError as e:
+                    # another process added it first
+                    if "duplicate column" not in str(e):
+                        raise
+
+
+def _score(value):
+    """MODELLER stores GA341 as a tuple whose first item is the score."""
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    return None if value is None else float(value)
+
+
+def model_rows(outputs: list) -> list:
+    """Turns AutoModel.outputs into (name, dope, ga341, molpdf, failure, elapsed_s, cpu_s, finished) tuples.
+    The timings are added to each output by profiling.with_profiling() and model_checkpoint."""
+    return [
+        (
+            output.get("name"),
+            _score(output.get("DOPE score")),
+            _score(output.get("GA341 score")),
+            _score(output.get("molpdf")),
+            None if output.get("failure") is None else str(output["failure"]),
+            _score(output.get("elapsed_s")),
+            _score(output.get("cpu_s")),
+            output.get("finished"),
+        )
+        for output in outputs
+    ]
+
+
+def record_run(outputs: list, target: str, template_v: str = None, template_c: str = None, knowns=(),
+               isotype: str = None, alignment_path: str = None, models_dir: str = None, elapsed_s: float = None,
+               db_path: str = my_run_info.results_db) -> int:
+    """Stores one MODELLER run and all of its models in a single transaction. Returns the run id."""
+    if isinstance(knowns, str):
+        knowns = [knowns]
+    alignment_hash = file_sha256(alignment_path) if alignment_path and os.path.isfile(alignment_path) else None
+
+    conn = connect(db_path)
+    try:
+        with conn:
+            run_id = conn.execute(
+                "INSERT INTO runs (created, target, template_v, template_c, knowns, isotype, alignment_path,"
+                " alignment_sha256, models_dir, elapsed_s) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (datetime.now().isoformat(timespec="seconds"), target, template_v, template_c,
+                 json.dumps(list(knowns)), isotype, alignment_path, alignment_hash, models_dir, elapsed_s),
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO models (run_id, name, isotype, dope, ga341, molpdf, failure, elapsed_s, cpu_s, finished)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, name, isotype, *row) for name, *row in model_rows(outputs)],
+            )
+    finally:
+        conn.close()
+    return run_id
+
+
+def top_models(n: int = 5, isotype: str = None, db_path: str = my_run_info.results_db) -> list:
+    """Returns the n successful models with the lowest DOPE score per isotype
+    (or for one isotype), joined with their run's templates and output directory."""
+    query = """
+        SELECT * FROM (
+            SELECT m.isotype, m.name, m.dope, m.ga341, m.molpdf, m.elapsed_s, m.finished, r.run_id, r.target, r.template_v,
+                   r.template_c, r.models_dir, r.created,
+                   ROW_NUMBER() OVER (PARTITION BY m.isotype ORDER BY m.dope) AS rank
+            FROM models m JOIN runs r ON r.run_id = m.run_id
+            WHERE m.failure IS NULL AND m.dope IS NOT NULL {isotype_filter}
+        ) WHERE rank <= ? ORDER BY isotype, rank
+    """
+    params = []
+    isotype_filter = ""
+    if isotype is not None:
+        isotype_filter = "AND m.isotype = ?"
+        params.append(isotype)
+    params.append(n)
+
+    conn = connect(db_path)
+    try:
+        return [dict(row) for row in conn.execute(query.format(isotype_filter=isotype_filter), params)]
+    finally:
+        conn.close()
+
+
+def import_pickle(pickle_path: str, isotype: str = None, target: str = None,
+                  db_path: str = my_run_info.results_db) -> int:
+    """Adds the a.outputs list saved by older versions of build_models.py to the database.
+    Only import pickles you created yourself, as unpickling can run arbitrary code."""
+    import pickle
+    with open(pickle_path, "rb") as f:
+        outputs = pickle.load(f)
+    return record_run(outputs, target=target or os.path.basename(pickle_path), isotype=isotype, db_path=db_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query or fill the model results database.")
+    parser.add_argument("--db", default=my_run_info.results_db)
+    parser.add_argument("--top", type=int, default=5, help="Models per isotype to list (lowest DOPE first)")
+    parser.add_argument("--isotype", help="Only list (or tag imported pickles with) this isotype")
+    parser.add_argument("--import-pickle", nargs="+", metavar="PKL", help="Pickled a.outputs files to import")
+    args = parser.parse_args(argv)
+
+    for pickle_path in args.import_pickle or []:
+        run_id = import_pickle(pickle_path, isotype=args.isotype, db_path=args.db)
+        print(f"Imported {pickle_path} as run {run_id}")
+
+    for row in top_models(args.top, args.isotype, args.db):
+        built = "" if row["elapsed_s"] is None else f", {row['elapsed_s']:.1f} s"
+        print(f"{row['isotype'] or '-':<10} {row['rank']:>3}  {row['name']:<40} DOPE {row['dope']:.3f}"
+              f"  ({row['template_v']}/{row['template_c']}, run {row['run_id']}{built})")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
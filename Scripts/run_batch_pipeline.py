@@ -0,0 +1,379 @@
+# This script runs the sequence preparation, FASTA, alignment and .pir stages for many isotype
+# hybrids in one go, without prompts. The VCAb table and the V template are loaded once and shared.
+# Stage outputs are content-addressed (see pipeline_stages.py), so re-runs only redo what changed.
+#
+# Usage (from the Scripts directory):
+#   python run_batch_pipeline.py --v-template 1n8z --c-templates 3m8o 5dk3
+#   python run_batch_pipeline.py --config batch_config_example.json
+
+import argparse
+import json
+import os
+from datetime import datetime
+
+import my_run_info
+import prepare_sequences
+import convert_to_pir
+import vcab_cache
+import align_sequences
+import generate_msa
+import pipeline_stages
+import profiling
+from vcab_index import VCAbIndex
+
+# Same layout as run_model_pipeline.py
+required_dirs = [
+    "VCAb_data",
+    "fasta_sequences",
+    "alignments",
+    "pir_files",
+    "atom_files",
+    "models",
+    "pickles"
+]
+
+
+def load_batch_config(config_path: str) -> dict:
+    """Reads a batch config file, e.g.
+    {"v_template": "1n8z", "c_templates": ["3m8o", "5dk3"], "write_pir": true}
+    Missing templates can be given on the command line, main() checks them after merging."""
+    with open(config_path) as f:
+        config = json.load(f)
+
+    if not isinstance(config, dict):
+        raise ValueError(f"Batch config '{config_path}' must be a JSON object")
+    return config
+
+
+def prepare_v_template(vcab_index: VCAbIndex, v_template: str) -> dict:
+    """Parses the variable region template once so every hybrid can reuse it."""
+    vl_zip, vh_zip = prepare_sequences.get_variable_region(
+        *prepare_sequences.zip_template_cif(vcab_index, v_template)
+        )
+    v_cif_chain_order = convert_to_pir.cif_parse(v_template, f"{v_template}.cif", my_run_info.cif_dir)
+
+    return {"pdb": v_template, "vl_zip": vl_zip, "vh_zip": vh_zip, "cif_chain_order": v_cif_chain_order}
+
+
+def prepare_hybrid(vcab_index: VCAbIndex, v_parts: dict, c_template: str, hybrid_label: str,
+                   timestamp: str, refine_key: str) -> dict:
+    """Runs sequence preparation and the FASTA stage for one hybrid.
+    FASTA files are named by the stage key and skipped if they already exist;
+    the timestamped names are aliases. Returns a dict with the hybrid's chain tables and FASTA paths."""
+    v_template = v_parts["pdb"]
+
+    # Template rows for this hybrid, annotated as in run_model_pipeline.py
+    df_matches = vcab_index.rows([v_template, c_template]).copy()
+    df_matches.insert(loc=1, column="template", value=None)
+    df_matches.loc[df_matches["pdb"] == v_template, "template"] = "v_template"
+    df_matches.loc[df_matches["pdb"] == c_template, "template"] = "c_template"
+
+    cl_zip, ch_zip = prepare_sequences.get_constant_region(
+        *prepare_sequences.zip_template_cif(vcab_index, c_template)
+        )
+    recombinant_seq_light, recombinant_seq_heavy = prepare_sequences.make_recombinant_seqs(
+        v_parts["vl_zip"], v_parts["vh_zip"], cl_zip, ch_zip
+        )
+
+    df_heavy = prepare_sequences.make_df_heavies(df_matches, recombinant_seq_heavy)
+    df_light = prepare_sequences.make_df_lights(df_matches, recombinant_seq_light)
+
+    fasta_paths = fasta_stage(df_light, df_heavy, df_matches, hybrid_label, timestamp,
+                              params={"v_template": v_template, "c_template": c_template},
+                              upstream_keys=[refine_key])
+
+    return {
+        "c_template": c_template,
+        "label": hybrid_label,
+        "refine_key": refine_key,
+        "df_light": df_light,
+        "df_heavy": df_heavy,
+        "light_fasta": fasta_paths[0],
+        "heavy_fasta": fasta_paths[1],
+    }
+
+
+def fasta_stage(df_light, df_heavy, df_matches, hybrid_label: str, timestamp: str, params: dict, upstream_keys):
+    """Writes light/heavy FASTA files named by their stage key (unless they exist already)
+    and points the timestamped names at them. Returns the (light, heavy) keyed paths."""
+    key = pipeline_stages.stage_key("fasta", dict(params, label=hybrid_label), upstream_keys=upstream_keys)
+    k = pipeline_stages.short_key(key)
+
+    keyed_paths = {
+        chain: os.path.join(my_run_info.fasta_out_dir, f"{chain}_chain_{hybrid_label}_{k}.fasta")
+        for chain in ("light", "heavy")
+    }
+
+    def build():
+        if prepare_sequences.write_fastas(
+                df_light, df_heavy, my_run_info.fasta_out_dir, df_matches, k, isotype=hybrid_label) is None:
+            raise RuntimeError(f"FASTA files for {hybrid_label} could not be written")
+
+    pipeline_stages.run_stage("fasta", key, keyed_paths, build)
+
+    for chain, path in keyed_paths.items():
+        pipeline_stages.alias(path, os.path.join(my_run_info.fasta_out_dir, f"{chain}_chain_{hybrid_label}_{timestamp}.fasta"))
+
+    return (keyed_paths["light"], keyed_paths["heavy"])
+
+
+def alignment_params() -> dict:
+    """Aligner settings that change the alignment output, part of the alignment stage key."""
+    if my_run_info.alignment_method == "external":
+        return {"method": "external", "command": my_run_info.msa_command}
+    return {
+        "method": "builtin",
+        "gap_open": align_sequences.default_gap_open,
+        "gap_extend": align_sequences.default_gap_extend,
+    }
+
+
+def align_hybrids(hybrids: list):
+    """Alignment stage for every prepared hybrid, with the built-in aligner or, if
+    my_run_info.alignment_method is "external", with concurrent aligner processes.
+    Alignments are named by their stage key and hybrids with existing alignments are skipped.
+    Sets hybrid["alignment_fnames"] to the (light, heavy) file names to build the .pir from,
+    and hybrid["error"] for hybrids whose alignment failed."""
+    pending = []
+    for hybrid in hybrids:
+        key = pipeline_stages.stage_key(
+            "alignment", alignment_params(), input_files=[hybrid["light_fasta"], hybrid["heavy_fasta"]]
+            )
+        keyed_label = f"{hybrid['label']}_{pipeline_stages.short_key(key)}"
+        hybrid["alignment_key"] = key
+        hybrid["alignment_fnames"] = (
+            generate_msa.alignment_fname(keyed_label, "light"),
+            generate_msa.alignment_fname(keyed_label, "heavy"),
+        )
+        outputs = alignment_outputs(hybrid)
+
+        if my_run_info.incremental_stages and pipeline_stages.load_manifest("alignment", key) is not None:
+            print(f"[alignment] {hybrid['label']} up to date ({pipeline_stages.short_key(key)}), skipping")
+        else:
+            pending.append((hybrid, keyed_label, outputs))
+
+    if my_run_info.alignment_method == "external":
+        msa_results = generate_msa.align_hybrids(
+            {keyed_label: (hybrid["light_fasta"], hybrid["heavy_fasta"]) for hybrid, keyed_label, _ in pending},
+            my_run_info.clustal_out_dir
+            )
+        for hybrid, keyed_label, _ in pending:
+            failed = [f"{result['chain']} {result['status']}" for result in msa_results
+                      if result["label"] == keyed_label and result["status"] != "ok"]
+            if failed:
+                hybrid["error"] = f"alignment failed ({', '.join(failed)})"
+    else:
+        for hybrid, keyed_label, _ in pending:
+            try:
+                align_sequences.align_hybrid_fastas(
+                    hybrid["light_fasta"], hybrid["heavy_fasta"], keyed_label, my_run_info.clustal_out_dir
+                    )
+            except Exception as e:
+                print(f"Alignment for {hybrid['label']} failed: {e}")
+                hybrid["error"] = f"alignment failed ({e})"
+
+    for hybrid, _, outputs in pending:
+        if all(os.path.isfile(path) for path in outputs.values()):
+            pipeline_stages.record_stage("alignment", hybrid["alignment_key"], outputs)
+        elif "error" not in hybrid:
+            hybrid["error"] = "alignment files not written"
+
+    # Keep the predictable Fab_alignment_{isotype}_{chain} names pointing at the latest alignment
+    for hybrid in hybrids:
+        for chain, path in alignment_outputs(hybrid).items():
+            if os.path.isfile(path):
+                pipeline_stages.alias(
+                    path, os.path.join(my_run_info.clustal_out_dir, generate_msa.alignment_fname(hybrid["label"], chain))
+                    )
+
+
+def alignment_outputs(hybrid: dict) -> dict:
+    light_fname, heavy_fname = hybrid["alignment_fnames"]
+    return {
+        "light": os.path.join(my_run_info.clustal_out_dir, light_fname),
+        "heavy": os.path.join(my_run_info.clustal_out_dir, heavy_fname),
+    }
+
+
+def write_hybrid_pir(hybrid: dict, v_parts: dict, timestamp: str):
+    """.pir stage for a prepared hybrid, run if both of its alignment files exist.
+    The .pir is named by its stage key (alignments, template .cif files, template codes and the upstream
+    refine and alignment keys, as the residue numbers come from the VCAb rows) and the timestamped name is an alias. Returns the keyed .pir path, or None if the alignments are missing."""
+    v_template = v_parts["pdb"]
+    c_template = hybrid["c_template"]
+    hybrid_label = hybrid["label"]
+
+    # Hand-made alignments use the predictable names
+    light_clustal_fname, heavy_clustal_fname = hybrid.get("alignment_fnames", (
+        generate_msa.alignment_fname(hybrid_label, "light"),
+        generate_msa.alignment_fname(hybrid_label, "heavy"),
+    ))
+    clustal_paths = [os.path.join(my_run_info.clustal_out_dir, fname) for fname in (light_clustal_fname, heavy_clustal_fname)]
+    missing = [path for path in clustal_paths if not os.path.isfile(path)]
+    if missing:
+        print(f"Skipping .pir for {hybrid_label}, alignment files not found: {', '.join(missing)}")
+        return None
+
+    key = pipeline_stages.stage_key(
+        "pir",
+        {"v_template": v_template, "c_template": c_template, "label": hybrid_label},
+        input_files=clustal_paths + [
+            os.path.join(my_run_info.cif_dir, f"{v_template}.cif"),
+            os.path.join(my_run_info.cif_dir, f"{c_template}.cif"),
+        ],
+        # Hand-made alignments have no alignment stage key, their contents are hashed above
+        upstream_keys=[hybrid["refine_key"]] + ([hybrid["alignment_key"]] if "alignment_key" in hybrid else []),
+    )
+    pir_path = os.path.join(my_run_info.pir_out_dir, f"pir_alignment_{hybrid_label}_{pipeline_stages.short_key(key)}.pir")
+
+    def build():
+        write_pir_file(hybrid, v_parts, light_clustal_fname, heavy_clustal_fname, pir_path)
+
+    pipeline_stages.run_stage("pir", key, {"pir": pir_path}, build)
+    pipeline_stages.alias(pir_path, os.path.join(my_run_info.pir_out_dir, f"pir_alignment_{hybrid_label}_{timestamp}.pir"))
+    return pir_path
+
+
+def write_pir_file(hybrid: dict, v_parts: dict, light_clustal_fname: str, heavy_clustal_fname: str, pir_path: str):
+    """Builds the combined chain table for a hybrid and writes its .pir file."""
+    v_template = v_parts["pdb"]
+    c_template = hybrid["c_template"]
+
+    df_combined = convert_to_pir.merge_df_for_pir(hybrid["df_light"], hybrid["df_heavy"])
+    c_cif_chain_order = convert_to_pir.cif_parse(c_template, f"{c_template}.cif", my_run_info.cif_dir)
+    df_combined_populated = convert_to_pir.relevant_chains(
+        df_combined,
+        v_parts["cif_chain_order"],
+        c_cif_chain_order,
+        v_template,
+        c_template
+    )
+    df_for_pir = convert_to_pir.extract_gapped_seqs(
+        df_combined_populated,
+        my_run_info.clustal_out_dir,
+        light_clustal_fname=light_clustal_fname,
+        heavy_clustal_fname=heavy_clustal_fname
+    )
+
+    convert_to_pir.write_modeller_pir(df_for_pir, pir_path, v_template, c_template, hybrid["label"])
+
+
+def hybrid_labels(vcab_index: VCAbIndex, c_templates: list) -> dict:
+    """Labels each C template by its isotype. Isotypes used by more than one
+    template get the PDB code appended so their files don't overwrite each other."""
+    isotypes = {c_template: str(vcab_index.row(c_template)["H_isotype_clean"]) for c_template in c_templates}
+    labels = {}
+    for c_template, isotype in isotypes.items():
+        if list(isotypes.values()).count(isotype) > 1:
+            labels[c_template] = f"{isotype}_{c_template}"
+        else:
+            labels[c_template] = isotype
+    return labels
+
+
+def run_batch(v_template: str, c_templates: list, write_pir: bool = True, timestamp: str = None) -> dict:
+    """Builds every V/C hybrid from one shared VCAb table and V template.
+    Returns {c_template: outputs dict}, with failed hybrids recorded under "error"."""
+    if timestamp is None:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    # Load and index VCAb once for the whole batch
+    df_refined = vcab_cache.load_refined_VCAb(use_cache=my_run_info.use_VCAb_cache)
+    vcab_index = VCAbIndex(df_refined)
+    refine_key = vcab_cache.refined_VCAb_key()
+    print(f"Rows, columns: {df_refined.shape}")
+
+    v_parts = prepare_v_template(vcab_index, v_template)
+
+    results = {}
+    for c_template in c_templates:
+        if c_template not in vcab_index:
+            print(f"Skipping {c_template}: not a human kappa entry in the refined VCAb table")
+            results[c_template] = {"error": "not in refined VCAb table"}
+    c_templates = [c_template for c_template in c_templates if c_template not in results]
+    labels = hybrid_labels(vcab_index, c_templates)
+
+    # Sequences and FASTA files for every hybrid
+    hybrids = []
+    for c_template in c_templates:
+        print(f"=== {v_template} + {c_template} ({labels[c_template]}) ===")
+        try:
+            with profiling.stage("prepare_hybrid", label=labels[c_template]):
+                hybrid = prepare_hybrid(vcab_index, v_parts, c_template, labels[c_template], timestamp, refine_key)
+        except Exception as e:
+            # One bad template shouldn't stop the rest of the batch
+            print(f"Hybrid {v_template} + {c_template} failed: {e}")
+            results[c_template] = {"error": str(e)}
+            continue
+        hybrids.append(hybrid)
+        results[c_template] = {"light_fasta": hybrid["light_fasta"], "heavy_fasta": hybrid["heavy_fasta"]}
+
+    if write_pir:
+        # Alignments for all hybrids at once, then one .pir per hybrid
+        if my_run_info.make_alignment_automatically:
+            align_hybrids(hybrids)
+
+        for hybrid in hybrids:
+            outputs = results[hybrid["c_template"]]
+            if "error" in hybrid:
+                outputs["error"] = hybrid["error"]
+                continue
+            try:
+                pir_path = write_hybrid_pir(hybrid, v_parts, timestamp)
+            except Exception as e:
+                print(f"Writing .pir for {hybrid['label']} failed: {e}")
+                outputs["error"] = str(e)
+                continue
+            if pir_path is None:
+                outputs["error"] = "alignment files not found, .pir skipped"
+            else:
+                outputs["pir"] = pir_path
+
+    # Summary
+    for c_template, outputs in results.items():
+        if "error" in outputs:
+            status = f"failed ({outputs['error']})"
+        else:
+            status = ", ".join(os.path.basename(p) for p in outputs.values())
+        print(f"{labels.get(c_template, '-'):<12} {c_template}: {status}")
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prepare sequences, FASTA and .pir files for several isotype hybrids.")
+    parser.add_argument("--config", help="JSON file with 'v_template', 'c_templates' and optional 'write_pir'")
+    parser.add_argument("--v-template", help="PDB code of the variable region template (e.g. 1n8z)")
+    parser.add_argument("--c-templates", nargs="+", help="PDB codes of the constant region templates")
+    parser.add_argument("--no-pir", action="store_true", help="Stop after writing FASTA files")
+    parser.add_argument("--profile", action="store_true", help="Record a timeline of every stage (profiling.py)")
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        profiling.enable()
+
+    if args.config:
+        try:
+            config = load_batch_config(args.config)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    else:
+        config = {}
+    v_template = (args.v_template or config.get("v_template", "")).lower()
+    c_templates = [code.lower() for code in (args.c_templates or config.get("c_templates", []))]
+    write_pir = config.get("write_pir", True) and not args.no_pir
+
+    if not v_template or not c_templates:
+        parser.error("give --v-template and --c-templates, in a --config file or on the command line")
+
+    project_root = os.path.abspath(os.path.join(os.getcwd(), ".."))
+    for dir_name in required_dirs:
+        os.makedirs(os.path.join(project_root, dir_name), exist_ok=True)
+
+    results = run_batch(v_template, c_templates, write_pir)
+    profiling.finish("run_batch_pipeline")
+    return 1 if any("error" in outputs for outputs in results.values()) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -37,12 +37,14 @@ def prompt_for_existing_file(prompt, suffix=".cif", search_dir="../VCAb_data"):
         print(f"File '{file_path}' not found. Please try again.")
 
 # Define the templates of interest
-v_template = prompt_for_existing_file(
-    "Enter PDB code for variable region template (e.g., 1n8z): "
-    )
-c_template = prompt_for_existing_file(
-    "Enter PDB code for Fab constant region template (e.g., 3m8o): "
-    )
+# (with auto_select_templates they are picked from VCAb by template_search.py once the table is loaded)
+if not my_run_info.auto_select_templates:
+    v_template = prompt_for_existing_file(
+        "Enter PDB code for variable region template (e.g., 1n8z): "
+        )
+    c_template = prompt_for_existing_file(
+        "Enter PDB code for Fab constant region template (e.g., 3m8o): "
+        )
 #c_Fc_template = prompt_for_existing_file(
 #    "Enter PDB code for Fc constant region template (e.g., XXXX): "
 #    ) # Potentially deactivate unless my_run_info states True
@@ -64,22 +66,40 @@ def ask_user(question: str) -> bool:
 
 # === Sequence Preparation ===
 import prepare_sequences
+import vcab_cache
 
-# Load VCAb into dataframe
-df_raw = prepare_sequences.load_VCAb()
-
-# Refine & filter VCAb dataframe
-df_refined = prepare_sequences.refine_VCAb(df_raw)
+# Load, refine & filter VCAb into a dataframe (reused from the Parquet cache if VCAb.csv is unchanged)
+df_refined = vcab_cache.load_refined_VCAb(use_cache=my_run_info.use_VCAb_cache)
 
 # Visualise the filtered VCAb dataframe
 print(f"Rows, columns: {df_refined.shape}")
 df_refined.head(5)
 
+# Index the refined table by PDB code, isotype and species once for the whole run
+from vcab_index import VCAbIndex
+vcab_index = VCAbIndex(df_refined)
+
+if my_run_info.auto_select_templates:
+    import template_search
+
+    # Rank templates with the k-mer index (saved next to the VCAb cache) and take the best with a .cif file
+    template_index = template_search.load_index(df_refined)
+    v_candidates = template_index.variable_templates(my_run_info.target_vh_seq, my_run_info.target_vl_seq)
+    c_candidates = template_index.constant_templates(my_run_info.target_isotype)
+    print(f"Variable region template candidates:\n{v_candidates.to_string(index=False)}")
+    print(f"Constant region template candidates ({my_run_info.target_isotype}):\n{c_candidates.to_string(index=False)}")
+
+    v_template = template_search.first_with_structure(v_candidates)
+    c_template = template_search.first_with_structure(c_candidates)
+    if v_template is None:
+        v_template = prompt_for_existing_file("No candidate .cif found, enter PDB code for variable region template: ")
+    if c_template is None:
+        c_template = prompt_for_existing_file("No candidate .cif found, enter PDB code for Fab constant region template: ")
+    print(f"Selected templates: V {v_template}, C {c_template}")
+
 # Filter only rows where matching user-entered pdb is True and create a copy of the dataframe. 
 # NOTE: `df_matches` is an independant copy of `df_refined`. Use df_matches from this point on
-df_matches = df_refined[
-    df_refined["pdb"].isin([v_template, c_template])
-].copy()
+df_matches = vcab_index.rows([v_template, c_template]).copy()
 
 # Add a 'template' annotation column
 df_matches.insert(loc=1, column="template", value=None)
@@ -90,10 +110,8 @@ df_matches
 
 # Extract Immunoglobulin isotype label and store as variable
 # NOTE: add this to the write FASTA function
-for idx, row in df_matches.iterrows():
-    if row["pdb"] == c_template:
-        isotype_label = str(row["H_isotype_clean"])
-        
+isotype_label = str(vcab_index.row(c_template)["H_isotype_clean"])
+
 print(f"Constant region template is {isotype_label}.")
 
 # Do you wish to create FASTA files?
@@ -105,10 +123,10 @@ print(f"Constant region template is {isotype_label}.")
 
 # Uses * to unpack the tuple from zip function
 cl_zip, ch_zip = prepare_sequences.get_constant_region(
-    *prepare_sequences.zip_template_cif(df_matches, c_template)
+    *prepare_sequences.zip_template_cif(vcab_index, c_template)
     )
 vl_zip, vh_zip = prepare_sequences.get_variable_region(
-    *prepare_sequences.zip_template_cif(df_matches, v_template)
+    *prepare_sequences.zip_template_cif(vcab_index, v_template)
     )
 
 # Make recombinant antibody Fab region sequences
@@ -121,13 +139,26 @@ df_light = prepare_sequences.make_df_lights(df_matches, recombinant_seq_light)
 df_light
 df_heavy
 
+# FASTA, alignment and .pir outputs are named by their stage key (pipeline_stages.py), with the same
+# stage functions as run_batch_pipeline.py, so a re-run with unchanged inputs skips them.
+# The timestamped file names are aliases of the keyed files.
+import convert_to_pir
+import run_batch_pipeline
+
+refine_key = vcab_cache.refined_VCAb_key()
+
 if ask_user("Do you wish to write new FASTA files?"):
     # Write 1 heavy and 1 light fasta file for submission to clustal aligner
-    prepare_sequences.write_fastas(df_light, df_heavy, 
-                                my_run_info.fasta_out_dir, 
-                                df_matches,
-                                timestamp
-                                )
+    try:
+        light_fasta_path, heavy_fasta_path = run_batch_pipeline.fasta_stage(
+            df_light, df_heavy, df_matches, isotype_label, timestamp,
+            params={"v_template": v_template, "c_template": c_template},
+            upstream_keys=[refine_key]
+            )
+    except RuntimeError as e:
+        # write_fastas has printed the error
+        print(f"Exiting... {e}")
+        exit(1)
 else:
     light_fasta_input = prompt_for_existing_file(
         prompt="Enter existing FASTA filename for LIGHT chains: ",
@@ -139,62 +170,57 @@ else:
         suffix= ".fasta",
         search_dir= my_run_info.fasta_out_dir)
 
+    light_fasta_path = os.path.join(my_run_info.fasta_out_dir, f"{light_fasta_input}.fasta")
+    heavy_fasta_path = os.path.join(my_run_info.fasta_out_dir, f"{heavy_fasta_input}.fasta")
+
+hybrid = {
+    "c_template": c_template,
+    "label": isotype_label,
+    "refine_key": refine_key,
+    "df_light": df_light,
+    "df_heavy": df_heavy,
+    "light_fasta": light_fasta_path,
+    "heavy_fasta": heavy_fasta_path,
+}
 
 
 # === Clustal Alignment ===
-# NOTE: Not currently set up
 
-proceed_clustal = input("""Pause here:
-    1. Create heavy and light alignment files with clustal 
-    2. Rename files appropriately
-    3. Press 'y' to continue: """)
-if proceed_clustal.lower() != 'y':
-    print("Exiting... Please run again when ready.")
-    exit()
+if my_run_info.make_alignment_automatically:
+    # Built-in aligner, or the configured external one (clustalo) if alignment_method is "external".
+    # Alignments are keyed by the FASTA contents and aliased to Fab_alignment_{isotype}_{chain}.aln-clustal
+    run_batch_pipeline.align_hybrids([hybrid])
+else:
+    proceed_clustal = input("""Pause here:
+        1. Create heavy and light alignment files with clustal 
+        2. Rename files appropriately
+        3. Press 'y' to continue: """)
+    if proceed_clustal.lower() != 'y':
+        print("Exiting... Please run again when ready.")
+        exit()
 
 # === .pir File Creation ===
 
 if ask_user("Do you wish to write new .pir file from clustal alignments?"):
-    
-    import convert_to_pir
-
-    # Combine the light and heavy information into one table for .pir
-    df_combined = convert_to_pir.merge_df_for_pir(df_light, df_heavy)
 
     # Determine the order that chains appear in the cif file
-    v_cif_chain_order = convert_to_pir.cif_parse(v_template, f"{v_template}.cif", my_run_info.cif_dir)
-    c_cif_chain_order = convert_to_pir.cif_parse(c_template, f"{c_template}.cif", my_run_info.cif_dir)
-
-    # Extract relevant chain info and add to table
-    df_combined_populated = convert_to_pir.relevant_chains(
-        df_combined, 
-        v_cif_chain_order, 
-        c_cif_chain_order, 
-        v_template, 
-        c_template
-    )
-
-    # Parses .aln-clustal files with Bio.AlignIO and extracts the gapped sequences.
-    df_for_pir = convert_to_pir.extract_gapped_seqs(
-        df_combined_populated,
-        my_run_info.clustal_out_dir,
-        light_clustal_fname=f"Fab_alignment_{isotype_label}_light.aln-clustal", # replace this with automation
-        heavy_clustal_fname=f"Fab_alignment_{isotype_label}_heavy.aln-clustal" # replace this with automation
-    )
-
-    # Write .pir file populated to the standard required by MODELLER
+    v_parts = {
+        "pdb": v_template,
+        "vl_zip": vl_zip,
+        "vh_zip": vh_zip,
+        "cif_chain_order": convert_to_pir.cif_parse(v_template, f"{v_template}.cif", my_run_info.cif_dir),
+    }
+
+    # Parses the .aln-clustal files and writes the .pir file to the standard required by MODELLER
     # The allowed format:
     #   >P1;3m8o
     #   structure:pdb_file:.:.:.:.::::
     #   seq1---/seq2---*
-
-    convert_to_pir.write_modeller_pir(
-        df_for_pir, 
-        f"../pir_files/pir_alignment_{isotype_label}_{timestamp}.pir",
-        v_template,
-        c_template,
-        isotype_label
-        )
+    pir_path = run_batch_pipeline.write_hybrid_pir(hybrid, v_parts, timestamp)
+    if pir_path is None:
+        print("Exiting... Please create the alignment files and run again.")
+        exit()
+    print(f".pir file: {pir_path} (alias pir_alignment_{isotype_label}_{timestamp}.pir)")
 else:
     
     pir_input = prompt_for_existing_file(
@@ -203,4 +229,6 @@ else:
         search_dir= my_run_info.pir_out_dir
         )
 
-
+# Write the stage timeline and summary (only if profile_pipeline or PIPELINE_PROFILE=1 is set)
+import profiling
+profiling.finish("run_model_pipeline")
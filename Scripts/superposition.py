@@ -0,0 +1,59 @@
+import numpy as np
+
+
+def kabsch(mobile: np.ndarray, reference: np.ndarray):
+    """Least-squares rigid superposition of `mobile` onto `reference` (both n x 3, matched rows).
+    Returns (rotation, translation) so that mobile @ rotation.T + translation fits reference."""
+    if mobile.shape != reference.shape or mobile.shape[0] < 3:
+        raise ValueError("Superposition needs at least 3 matched coordinates of the same shape")
+
+    mobile_centre = mobile.mean(axis=0)
+    reference_centre = reference.mean(axis=0)
+    covariance = (mobile - mobile_centre).T @ (reference - reference_centre)
+
+    u, _, vt = np.linalg.svd(covariance)
+    # Flip the last axis if needed so the result is a rotation, not a reflection
+    d = np.sign(np.linalg.det(vt.T @ u.T))
+    rotation = vt.T @ np.diag([1.0, 1.0, d]) @ u.T
+    translation = reference_centre - mobile_centre @ rotation.T
+    return rotation, translation
+
+
+def apply_transform(coords: np.ndarray, rotation: np.ndarray, translation: np.ndarray) -> np.ndarray:
+    return coords @ rotation.T + translation
+
+
+def rmsd(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.sqrt(((a - b) ** 2).sum(axis=-1).mean()))
+
+
+def batch_kabsch(mobile: np.ndarray, reference: np.ndarray):
+    """kabsch() for a stack of coordinate sets in one pass.
+    mobile is (batch x n x 3); reference is (n x 3), shared by all, or (batch x n x 3).
+    Returns rotations (batch x 3 x 3) and translations (batch x 3)."""
+    mobile_centre = mobile.mean(axis=-2, keepdims=True)
+    reference_centre = reference.mean(axis=-2, keepdims=True)
+    covariance = np.einsum("...ni,...nj->...ij", mobile - mobile_centre, reference - reference_centre)
+
+    u, _, vt = np.linalg.svd(covariance)
+    d = np.sign(np.linalg.det(np.swapaxes(vt, -1, -2) @ np.swapaxes(u, -1, -2)))
+    flip = np.ones(u.shape[:-1])
+    flip[..., -1] = d
+    rotations = np.swapaxes(vt, -1, -2) @ (flip[..., :, None] * np.swapaxes(u, -1, -2))
+    translations = reference_centre[..., 0, :] - np.einsum("...j,...ij->...i", mobile_centre[..., 0, :], rotations)
+    return rotations, translations
+
+
+def batch_fit_rmsd(mobile: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    """RMSD after optimal superposition of each coordinate set in mobile (batch x n x 3) onto reference
+    ((n x 3) or (batch x n x 3)). Uses the singular values of the covariance matrices directly,
+    so no rotated coordinates are built."""
+    mobile = mobile - mobile.mean(axis=-2, keepdims=True)
+    reference = reference - reference.mean(axis=-2, keepdims=True)
+    covariance = np.einsum("...ni,...nj->...ij", mobile, reference)
+
+    u, s, vt = np.linalg.svd(covariance)
+    d = np.sign(np.linalg.det(u) * np.linalg.det(vt))
+    s[..., -1] *= d
+    squared = (mobile ** 2).sum(axis=(-1, -2)) + (reference ** 2).sum(axis=(-1, -2)) - 2 * s.sum(axis=-1)
+    return np.sqrt(np.maximum(squared, 0.0) / mobile.shape[-2])
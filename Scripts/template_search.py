@@ -0,0 +1,311 @@
+# Template search over the refined VCAb table with an inverted k-mer index.
+# Every sequence in HV_seq, LV_seq, HC_coordinate_seq and LC_coordinate_seq is split into its
+# distinct k-mers, and each k-mer points to the rows that contain it (a sorted posting list).
+# A query looks up only its own k-mers and counts the hits per row, so ranking the whole table
+# takes milliseconds instead of aligning the target to every entry. Rows are scored by the Dice
+# overlap of their k-mer sets with the query's.
+# The index is saved next to the VCAb cache and rebuilt when VCAb.csv or the index format changes.
+#
+#   index = template_search.load_index(df_refined)
+#   index.variable_templates(vh="EVQLVESGG...", vl="DIQMTQSPS...")   # ranked V templates
+#   index.constant_templates("IgG1")                                  # ranked C templates
+#
+# Usage (from the Scripts directory):
+#   python template_search.py --vh EVQLVESGG... --vl DIQMTQSPS... --top 10
+#   python template_search.py --isotype IgG4
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import my_run_info
+import profiling
+import vcab_cache
+
+# Bump this whenever the index layout or scoring changes, so saved indexes are rebuilt
+INDEX_VERSION = 1
+
+indexed_columns = ["HV_seq", "LV_seq", "HC_coordinate_seq", "LC_coordinate_seq"]
+_bits = 5  # bits per residue in a k-mer code (A-Z are 1-26)
+_row_bits = 32  # (k-mer, row) pairs are packed into one int64 as kmer << 32 | row
+max_kmer = (62 - _row_bits) // _bits  # longest k whose packed pairs fit in an int64 (6)
+
+
+def check_kmer(k: int):
+    """Raises ValueError for k-mer lengths the index cannot pack into int64 (k > max_kmer)."""
+    if not 1 <= k <= max_kmer:
+        raise ValueError(f"template_kmer must be between 1 and {max_kmer} (a k-mer takes {_bits} bits per residue "
+                         f"and is packed with a {_row_bits}-bit row number into an int64), got {k}")
+
+
+def encode_sequences(sequences) -> tuple:
+    """Joins sequences into one uint8 array of residue codes (A-Z -> 1-26, anything else 0),
+    with a 0 after each sequence. Returns (codes, start position of each sequence)."""
+    sequences = ["" if pd.isna(seq) else str(seq) for seq in sequences]
+    joined = np.frombuffer(("\0".join(sequences) + "\0").upper().encode("ascii", "replace"), dtype=np.uint8)
+    codes = np.where((joined >= ord("A")) & (joined <= ord("Z")), joined - (ord("A") - 1), 0).astype(np.int64)
+    starts = np.zeros(len(sequences), dtype=np.int64)
+    np.cumsum([len(seq) + 1 for seq in sequences[:-1]], out=starts[1:])
+    return codes, starts
+
+
+def kmer_codes(codes: np.ndarray, k: int) -> tuple:
+    """Integer code of every window of k residues that contains no 0 (no gap, unknown residue or
+    sequence break). Returns (kmer codes, window start positions)."""
+    if len(codes) < k:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+    weights = np.left_shift(1, _bits * np.arange(k - 1, -1, -1), dtype=np.int64)
+    kmers = windows @ weights
+
+    # windows containing a 0 from the running count of zeros
+    zeros = np.concatenate(([0], np.cumsum(codes == 0)))
+    valid = np.flatnonzero(zeros[k:] == zeros[:-k])
+    return kmers[valid], valid
+
+
+def sorted_unique(values: np.ndarray) -> np.ndarray:
+    """Sorted distinct values (by sorting and comparing neighbours, faster than np.unique on large arrays)."""
+    values = np.sort(values)
+    return values[np.concatenate(([True], values[1:] != values[:-1]))] if values.size else values
+
+
+def sequence_kmers(sequence: str, k: int) -> np.ndarray:
+    """Distinct k-mer codes of one sequence."""
+    codes, _ = encode_sequences([sequence])
+    return sorted_unique(kmer_codes(codes, k)[0])
+
+
+class PostingLists:
+    """Inverted index of one column: `rows[offsets[i]:offsets[i + 1]]` are the rows containing
+    k-mer `kmers[i]` (kmers sorted). `counts` is the number of distinct k-mers of every row."""
+
+    __slots__ = ("kmers", "offsets", "rows", "counts")
+
+    def __init__(self, kmers, offsets, rows, counts):
+        self.kmers = kmers
+        self.offsets = offsets
+        self.rows = rows
+        self.counts = counts
+
+    @classmethod
+    def build(cls, sequences, k: int, chunk_rows: int = 50000) -> "PostingLists":
+        """Builds the posting lists of a column, chunk_rows sequences at a time."""
+        check_kmer(k)
+        n_rows = len(sequences)
+        pairs = []
+        for first in range(0, n_rows, chunk_rows):
+            codes, starts = encode_sequences(sequences[first:first + chunk_rows])
+            kmers, positions = kmer_codes(codes, k)
+            rows = np.searchsorted(starts, positions, side="right") - 1 + first
+            # one (k-mer, row) pair per distinct k-mer of a row, ordered by k-mer then row
+            pairs.append(sorted_unique((kmers << _row_bits) | rows))
+        pairs = np.sort(np.concatenate(pairs)) if pairs else np.zeros(0, dtype=np.int64)
+
+        rows = (pairs & ((1 << _row_bits) - 1)).astype(np.int32)
+        pair_kmers = pairs >> _row_bits
+        first_pair = np.flatnonzero(np.concatenate(([True], pair_kmers[1:] != pair_kmers[:-1])))
+        kmers = pair_kmers[first_pair]
+        offsets = np.append(first_pair, len(pairs)).astype(np.int64)
+        return cls(kmers, offsets, rows, np.bincount(rows, minlength=n_rows).astype(np.int32))
+
+    def shared(self, query: np.ndarray) -> np.ndarray:
+        """Number of the (distinct) query k-mers found in every row."""
+        found = np.searchsorted(self.kmers, query)
+        in_range = found < len(self.kmers)
+        found = found[in_range][self.kmers[found[in_range]] == query[in_range]]
+        if found.size == 0:
+            return np.zeros(len(self.counts), dtype=np.int64)
+        hits = np.concatenate([self.rows[self.offsets[i]:self.offsets[i + 1]] for i in found])
+        return np.bincount(hits, minlength=len(self.counts))
+
+    def dice(self, query: np.ndarray) -> np.ndarray:
+        """Dice overlap (0-1) of the query k-mer set with every row's k-mer set."""
+        if query.size == 0:
+            return np.zeros(len(self.counts))
+        return 2 * self.shared(query) / (query.size + self.counts)
+
+
+def coordinate_coverage(df: pd.DataFrame) -> np.ndarray:
+    """Fraction of the heavy and light chain residues with coordinates (the lower of the two)."""
+    def fraction(chain):
+        observed = df[f"{chain}_coordinate_seq"].fillna("").astype(str).str.len().to_numpy()
+        total = df[f"{chain}_seq"].fillna("").astype(str).str.len().to_numpy()
+        return np.divide(observed, total, out=np.zeros(len(df)), where=total > 0)
+    return np.minimum(fraction("H"), fraction("L"))
+
+
+class TemplateIndex:
+    """k-mer posting lists of the indexed columns of a refined VCAb table, with the
+    resolution, method and coordinate coverage of every row for filtering."""
+
+    def __init__(self, df: pd.DataFrame, k: int, columns: dict, coverage: np.ndarray):
+        self.df = df
+        self.k = k
+        self.columns = columns
+        self.coverage = coverage
+        self.resolution = pd.to_numeric(df["resolution"], errors="coerce").to_numpy(dtype=np.float64)
+        # columns reported with every candidate, as arrays so a query only indexes them
+        self.info = {col: df[col].to_numpy() for col in ["pdb", "Hchain", "Lchain", "H_isotype_clean", "method"]}
+
+    @classmethod
+    @profiling.profiled(name="build_template_index")
+    def build(cls, df: pd.DataFrame, k: int = my_run_info.template_kmer) -> "TemplateIndex":
+        columns = {col: PostingLists.build(df[col].tolist(), k) for col in indexed_columns}
+        return cls(df, k, columns, coordinate_coverage(df))
+
+    def save(self, path: str, key: str):
+        """Writes the index to an .npz file (via a temporary file) with the key of the table it was built from."""
+        arrays = {"coverage": self.coverage}
+        for col, lists in self.columns.items():
+            for name in PostingLists.__slots__:
+                arrays[f"{col}.{name}"] = getattr(lists, name)
+        meta = {"index_version": INDEX_VERSION, "key": key, "k": self.k, "rows": len(self.df)}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, df: pd.DataFrame, key: str, k: int):
+        """Reads a saved index, or returns None if it is missing or was built from another table."""
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as saved:
+            meta = json.loads(str(saved["meta"]))
+            if meta != {"index_version": INDEX_VERSION, "key": key, "k": k, "rows": len(df)}:
+                return None
+            columns = {
+                col: PostingLists(*(saved[f"{col}.{name}"] for name in PostingLists.__slots__))
+                for col in indexed_columns
+            }
+            return cls(df, k, columns, saved["coverage"])
+
+    def filter_mask(self, max_resolution=my_run_info.template_max_resolution,
+                    methods=my_run_info.template_methods,
+                    min_coverage=my_run_info.template_min_coverage) -> np.ndarray:
+        """Rows passing the resolution, experimental method and coordinate coverage filters (None skips a filter)."""
+        mask = np.ones(len(self.df), dtype=bool)
+        if max_resolution is not None:
+            mask &= self.resolution <= max_resolution
+        if methods:
+            mask &= self.df["method"].isin(methods).to_numpy()
+        if min_coverage is not None:
+            mask &= self.coverage >= min_coverage
+        return mask
+
+    def score(self, queries: dict) -> dict:
+        """Dice score of every row for each {column: sequence} query, and their mean as "score"."""
+        scores = {
+            f"{col}_score": self.columns[col].dice(sequence_kmers(seq, self.k))
+            for col, seq in queries.items() if seq
+        }
+        scores["score"] = np.mean(list(scores.values()), axis=0) if scores else np.zeros(len(self.df))
+        return scores
+
+    def ranked(self, scores: dict, mask: np.ndarray, top: int) -> pd.DataFrame:
+        """Best row of each PDB entry passing the mask, ordered by score, then coverage and resolution."""
+        rows = np.flatnonzero(mask)
+        rows = rows[np.lexsort((self.resolution[rows], -self.coverage[rows], -scores["score"][rows]))]
+
+        # keep the first (best) row of every PDB code, stopping once `top` codes are found
+        pdb = self.info["pdb"]
+        best, seen = [], set()
+        for row in rows:
+            if pdb[row] not in seen:
+                seen.add(pdb[row])
+                best.append(row)
+                if top and len(best) == top:
+                    break
+
+        candidates = pd.DataFrame({col: values[best] for col, values in self.info.items()})
+        candidates["resolution"] = self.resolution[best]
+        candidates["coverage"] = self.coverage[best]
+        for name, values in scores.items():
+            candidates[name] = values[best]
+        return candidates
+
+    @profiling.profiled
+    def variable_templates(self, vh: str = None, vl: str = None, top: int = 10, **filters) -> pd.DataFrame:
+        """Entries whose VH/VL are most similar to the target's, best first."""
+        if not (vh or vl):
+            raise ValueError("Give a target VH and/or VL sequence to search variable region templates")
+        return self.ranked(self.score({"HV_seq": vh, "LV_seq": vl}), self.filter_mask(**filters), top)
+
+    @profiling.profiled
+    def constant_templates(self, isotype: str, ch: str = None, cl: str = None, top: int = 10, **filters) -> pd.DataFrame:
+        """Entries of an isotype, ranked by similarity to the given CH/CL sequences if any,
+        otherwise by coordinate coverage and resolution."""
+        mask = self.filter_mask(**filters) & (self.df["H_isotype_clean"] == isotype).to_numpy()
+        return self.ranked(self.score({"HC_coordinate_seq": ch, "LC_coordinate_seq": cl}), mask, top)
+
+
+def index_path(csv_path: str, cache_dir: str, k: int) -> str:
+    """The index is stored beside the refined table's Parquet cache, named after the csv."""
+    stem = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(cache_dir, f"{stem}_kmer{k}_index.npz")
+
+
+def load_index(df_refined: pd.DataFrame,
+               csv_path: str = my_run_info.VCAb_dir,
+               cache_dir: str = my_run_info.VCAb_cache_dir,
+               k: int = my_run_info.template_kmer) -> TemplateIndex:
+    """Returns the template index of the refined table (as returned by vcab_cache.load_refined_VCAb),
+    read from disk when VCAb.csv is unchanged, otherwise built and saved."""
+    check_kmer(k)
+    df_refined = df_refined.reset_index(drop=True)
+    key = vcab_cache.refined_VCAb_key(csv_path, cache_dir)
+    path = index_path(csv_path, cache_dir, k)
+
+    index = TemplateIndex.load(path, df_refined, key, k)
+    if index is not None:
+        print(f"Loaded template index: {path}")
+        return index
+
+    index = TemplateIndex.build(df_refined, k)
+    index.save(path, key)
+    print(f"Template index written to: {path}")
+    return index
+
+
+def first_with_structure(candidates: pd.DataFrame, cif_dir: str = my_run_info.cif_dir):
+    """PDB code of the best candidate whose .cif is in cif_dir, or None."""
+    for pdb in candidates["pdb"]:
+        if os.path.isfile(os.path.join(cif_dir, f"{pdb}.cif")):
+            return pdb
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rank VCAb entries as variable or constant region templates.")
+    parser.add_argument("--vh", help="Target VH sequence")
+    parser.add_argument("--vl", help="Target VL sequence")
+    parser.add_argument("--isotype", help="Rank constant region templates of this isotype (e.g. IgG1)")
+    parser.add_argument("--ch", help="Target heavy constant sequence, to rank constant templates by similarity")
+    parser.add_argument("--cl", help="Target light constant sequence")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--max-resolution", type=float, default=my_run_info.template_max_resolution)
+    parser.add_argument("--methods", nargs="*", default=my_run_info.template_methods, help="Experimental methods to keep (none: all)")
+    parser.add_argument("--min-coverage", type=float, default=my_run_info.template_min_coverage)
+    args = parser.parse_args(argv)
+    if not (args.vh or args.vl or args.isotype):
+        parser.error("give --vh/--vl and/or --isotype")
+
+    df_refined = vcab_cache.load_refined_VCAb(use_cache=my_run_info.use_VCAb_cache)
+    index = load_index(df_refined)
+    filters = {"max_resolution": args.max_resolution, "methods": args.methods, "min_coverage": args.min_coverage}
+
+    if args.vh or args.vl:
+        print("Variable region templates:")
+        print(index.variable_templates(args.vh, args.vl, args.top, **filters).to_string(index=False))
+    if args.isotype:
+        print(f"Constant region templates ({args.isotype}):")
+        print(index.constant_templates(args.isotype, args.ch, args.cl, args.top, **filters).to_string(index=False))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
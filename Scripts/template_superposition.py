@@ -0,0 +1,185 @@
+# Cached replacement for AutoModel's initial_malign3d.
+# Every template is superposed onto the first template (the reference frame) by a Kabsch fit
+# of the CA atoms of residues aligned to each other in the .pir alignment. Each transform is
+# cached by the reference and template files and their aligned columns, so adding a new constant
+# region template only fits that template. The superposed copies of the templates are written to
+# a directory that is put first in env.io.atom_files_directory, and initial_malign3d is turned off.
+
+import json
+import os
+
+import numpy as np
+
+import cif_reader
+import my_run_info
+import pipeline_stages
+from convert_to_pir import read_pir
+from restraint_cache import find_template_files
+from superposition import kabsch, apply_transform, rmsd
+
+
+def residue_keys(atoms: dict) -> np.ndarray:
+    """chain:resseq+icode of every atom, e.g. "A:100B"."""
+    return np.char.add(np.char.add(np.char.add(atoms["chain"], ":"), atoms["resseq"]), atoms["icode"])
+
+
+def template_residue_keys(atoms: dict, start: str, start_chain: str, n_residues: int) -> np.ndarray:
+    """Keys of the n_residues polymer residues read from the .pir header's start residue onwards,
+    in file order, as MODELLER reads them."""
+    polymer = atoms["group"] == "ATOM"
+    keys = residue_keys(atoms)[polymer]
+    chains = atoms["chain"][polymer]
+    _, first_atom = np.unique(keys, return_index=True)
+    order = np.sort(first_atom)
+    residues = keys[order]
+
+    start = start.strip()
+    if start in ("", ".", "FIRST"):
+        in_chain = np.flatnonzero(chains[order] == start_chain) if start_chain not in ("", ".") else np.array([0])
+        if in_chain.size == 0:
+            raise ValueError(f"Chain {start_chain} not found")
+        first = int(in_chain[0])
+    else:
+        hits = np.flatnonzero(residues == f"{start_chain}:{start}")
+        if hits.size == 0:
+            raise ValueError(f"Start residue {start}:{start_chain} not found")
+        first = int(hits[0])
+
+    selected = residues[first:first + n_residues]
+    if len(selected) < n_residues:
+        raise ValueError(f"Alignment has {n_residues} residues but only {len(selected)} follow {start}:{start_chain}")
+    return selected
+
+
+def atom_coords(atoms: dict, keys, atom_name: str = "CA") -> list:
+    """Coordinates of one atom (first alternate location) in each residue, None where it is missing."""
+    wanted = (atoms["group"] == "ATOM") & (atoms["atom"] == atom_name) & np.isin(atoms["altloc"], ["", "A", "1"])
+    coords = {}
+    for key, coord in zip(residue_keys(atoms)[wanted], atoms["coords"][wanted]):
+        coords.setdefault(key, coord)
+    return [coords.get(key) for key in keys]
+
+
+def template_ca(atoms: dict, start: str, start_chain: str, n_residues: int) -> list:
+    """CA coordinates (None if a residue has no CA) of the residues a .pir entry covers."""
+    return atom_coords(atoms, template_residue_keys(atoms, start, start_chain, n_residues), "CA")
+
+
+def residue_positions(sequence: str) -> list:
+    """Index of each alignment column's residue within the sequence, or None for gaps and chain breaks."""
+    positions = []
+    count = 0
+    for letter in sequence:
+        if letter.isalpha():
+            positions.append(count)
+            count += 1
+        else:
+            positions.append(None)
+    return positions
+
+
+def matched_ca(reference: dict, template: dict, reference_atoms: dict, template_atoms: dict):
+    """CA coordinates of residues aligned to each other in the two .pir entries.
+    Returns (template coords, reference coords) as matched n x 3 arrays."""
+    ref_seq = reference["sequence"].replace("/", "")
+    tmpl_seq = template["sequence"].replace("/", "")
+    ref_ca = template_ca(reference_atoms, reference["header"][2], reference["header"][3], sum(c.isalpha() for c in ref_seq))
+    tmpl_ca = template_ca(template_atoms, template["header"][2], template["header"][3], sum(c.isalpha() for c in tmpl_seq))
+
+    pairs = [
+        (tmpl_ca[j], ref_ca[i])
+        for i, j in zip(residue_positions(ref_seq), residue_positions(tmpl_seq))
+        if i is not None and j is not None and ref_ca[i] is not None and tmpl_ca[j] is not None
+    ]
+    if len(pairs) < 3:
+        raise ValueError(f"{template['code']} has fewer than 3 CA atoms aligned to {reference['code']}")
+    return np.array([p[0] for p in pairs]), np.array([p[1] for p in pairs])
+
+
+def _load_transforms(path: str) -> dict:
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_transforms(path: str, transforms: dict):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(transforms, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def superposed_atom_dirs(alnfile: str, knowns, atom_files_directory,
+                         cache_dir: str = my_run_info.superposition_cache_dir):
+    """Superposes the templates of an alignment onto the first one, reusing cached transforms.
+    Returns atom_files_directory with the superposed templates' directory first, or None if the
+    templates cannot be superposed this way (then initial_malign3d should be used instead)."""
+    knowns = [knowns] if isinstance(knowns, str) else list(knowns)
+    atom_files_directory = list(atom_files_directory)
+    if len(knowns) < 2:
+        return atom_files_directory
+
+    entries = {entry["code"]: entry for entry in read_pir(alnfile)}
+    files = {code: find_template_files([code], atom_files_directory) for code in knowns}
+    unusable = [
+        code for code in knowns
+        if code not in entries or not files[code] or not files[code][0].endswith((".cif", ".cif.gz"))
+    ]
+    if unusable:
+        print(f"Cannot superpose {', '.join(unusable)} from cache (not in the alignment or no .cif file), using initial_malign3d")
+        return None
+    files = {code: found[0] for code, found in files.items()}
+
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    transforms_path = os.path.join(cache_dir, "transforms.json")
+    transforms = _load_transforms(transforms_path)
+
+    reference = knowns[0]
+    reference_atoms = None
+    keys = {}
+    for code in knowns[1:]:
+        # The key covers both structures and the columns that pair their residues
+        key = pipeline_stages.stage_key(
+            "superpose",
+            {"reference": reference, "template": code,
+             "columns": [entries[reference]["sequence"], entries[code]["sequence"]],
+             "headers": [entries[reference]["header"][:4], entries[code]["header"][:4]]},
+            input_files=[files[reference], files[code]],
+        )
+        keys[code] = key
+        if key in transforms:
+            continue
+
+        if reference_atoms is None:
+            reference_atoms = cif_reader.read_atoms(files[reference])
+        try:
+            mobile, target = matched_ca(entries[reference], entries[code], reference_atoms, cif_reader.read_atoms(files[code]))
+        except ValueError as e:
+            print(f"Cannot superpose {code} onto {reference}: {e}. Using initial_malign3d")
+            return None
+        rotation, translation = kabsch(mobile, target)
+        transforms[key] = {
+            "reference": reference,
+            "template": code,
+            "rotation": rotation.tolist(),
+            "translation": translation.tolist(),
+            "n_ca": len(mobile),
+            "rmsd": rmsd(apply_transform(mobile, rotation, translation), target),
+        }
+        print(f"Superposed {code} onto {reference}: {len(mobile)} CA, RMSD {transforms[key]['rmsd']:.2f} A")
+        _save_transforms(transforms_path, transforms)
+
+    set_key = pipeline_stages.stage_key("superposed_templates", {"reference": reference}, upstream_keys=[keys[code] for code in knowns[1:]])
+    set_dir = os.path.join(cache_dir, pipeline_stages.short_key(set_key))
+    os.makedirs(set_dir, exist_ok=True)
+    for code in knowns[1:]:
+        out_path = os.path.join(set_dir, os.path.basename(files[code]).removesuffix(".gz"))
+        if not os.path.isfile(out_path):
+            transform = transforms[keys[code]]
+            cif_reader.write_transformed_cif(
+                files[code], out_path, np.array(transform["rotation"]), np.array(transform["translation"])
+                )
+
+    return [set_dir] + atom_files_directory
@@ -0,0 +1,124 @@
+import json
+import os
+
+import pandas as pd
+
+import my_run_info
+import prepare_sequences
+import profiling
+from file_hashes import file_sha256
+
+# Bump this whenever refine_VCAb() changes what it keeps, so old caches are rebuilt
+CACHE_VERSION = 1
+
+
+def cache_paths(csv_path: str, cache_dir: str):
+    """Returns the (parquet, metadata) file paths used to cache a refined VCAb csv.
+    Each csv gets its own pair of files so several snapshots can be cached side by side."""
+    stem = os.path.splitext(os.path.basename(csv_path))[0]
+    return (
+        os.path.join(cache_dir, f"{stem}_refined.parquet"),
+        os.path.join(cache_dir, f"{stem}_refined.json"),
+    )
+
+
+def cache_is_valid(csv_path: str, parquet_path: str, meta_path: str) -> bool:
+    """Checks the cached table against the size, mtime and sha256 of the csv.
+    A changed mtime alone (e.g. after copying the file) only triggers a re-hash,
+    the cache is kept if the content is identical."""
+    if not (os.path.isfile(parquet_path) and os.path.isfile(meta_path)):
+        return False
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    if meta.get("cache_version") != CACHE_VERSION:
+        return False
+
+    stat = os.stat(csv_path)
+    if stat.st_size != meta.get("size"):
+        return False
+    if stat.st_mtime_ns == meta.get("mtime_ns"):
+        return True
+
+    # Same size but touched: compare content
+    if file_sha256(csv_path) != meta.get("sha256"):
+        return False
+
+    # Content unchanged, remember the new mtime so the next run skips the hash
+    meta["mtime_ns"] = stat.st_mtime_ns
+    write_json_atomic(meta_path, meta)
+    return True
+
+
+def write_json_atomic(path: str, data: dict):
+    """Writes json via a temporary file so concurrent readers never see a partial file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def as_categorical(df_refined: pd.DataFrame) -> pd.DataFrame:
+    """Returns a copy of the refined table with a clean index and category dtypes,
+    so cached and freshly parsed tables look the same to the rest of the pipeline."""
+    df_cache = df_refined.reset_index(drop=True)
+    for col in prepare_sequences.categorical_columns:
+        df_cache[col] = df_cache[col].astype("category")
+    return df_cache
+
+
+def write_cache(df_cache: pd.DataFrame, csv_path: str, parquet_path: str, meta_path: str):
+    """Stores the refined table as Parquet alongside the csv fingerprint."""
+    os.makedirs(os.path.dirname(parquet_path) or ".", exist_ok=True)
+
+    tmp_path = f"{parquet_path}.{os.getpid()}.tmp"
+    df_cache.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, parquet_path)
+
+    stat = os.stat(csv_path)
+    write_json_atomic(meta_path, {
+        "cache_version": CACHE_VERSION,
+        "csv_path": os.path.abspath(csv_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": file_sha256(csv_path),
+        "rows": len(df_cache),
+    })
+
+
+@profiling.profiled
+def load_refined_VCAb(csv_path: str = my_run_info.VCAb_dir,
+                      cache_dir: str = my_run_info.VCAb_cache_dir,
+                      use_cache: bool = True) -> pd.DataFrame:
+    """Returns the refined VCAb table, reading it from the Parquet cache when the csv is unchanged.
+    Otherwise the csv is streamed through load_VCAb_chunked() and the cache is rewritten."""
+    parquet_path, meta_path = cache_paths(csv_path, cache_dir)
+
+    if use_cache and cache_is_valid(csv_path, parquet_path, meta_path):
+        print(f"Loading refined VCAb from cache: {parquet_path}")
+        return pd.read_parquet(parquet_path)
+
+    df_refined = as_categorical(prepare_sequences.load_VCAb_chunked(csv_path))
+
+    if use_cache:
+        try:
+            write_cache(df_refined, csv_path, parquet_path, meta_path)
+            print(f"Refined VCAb cached to: {parquet_path}")
+        except ImportError as e:
+            # Parquet support needs pyarrow (or fastparquet)
+            print(f"VCAb cache not written, install pyarrow to enable it: {e}")
+
+    return df_refined
+
+
+def refined_VCAb_key(csv_path: str = my_run_info.VCAb_dir, cache_dir: str = my_run_info.VCAb_cache_dir) -> str:
+    """Returns the content key of the refined table (csv sha256 plus cache version) for pipeline_stages.
+    Reuses the hash stored with the cache when it is current."""
+    parquet_path, meta_path = cache_paths(csv_path, cache_dir)
+    if cache_is_valid(csv_path, parquet_path, meta_path):
+        with open(meta_path) as f:
+            csv_hash = json.load(f)["sha256"]
+    else:
+        csv_hash = file_sha256(csv_path)
+    return f"{csv_hash}:v{CACHE_VERSION}"
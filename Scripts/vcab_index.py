@@ -0,0 +1,77 @@
+import pandas as pd
+
+from numbering_arrays import RaggedNumbering
+
+
+class VCAbIndex:
+    """Lookup table over a VCAb-shaped DataFrame, built once per run.
+
+    Rows are found by PDB code in O(1) instead of scanning the frame with iterrows().
+    Grouped lookups by isotype and species are built on first use.
+    The wrapped DataFrame is kept as-is, so index labels can still be used with df.at[...]."""
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+
+        # {pdb: array of row positions}, in the order rows appear in df
+        self._positions = df.groupby("pdb", sort=False, observed=True).indices
+        self._groups = None
+        self._numbering = {}
+
+    def __len__(self):
+        return len(self.df)
+
+    def __contains__(self, pdb_code):
+        return pdb_code in self._positions
+
+    def positions(self, pdb_code: str):
+        """Returns the row positions for a PDB code, raising KeyError if it is not in the table."""
+        try:
+            return self._positions[pdb_code]
+        except KeyError:
+            raise KeyError(f"PDB code '{pdb_code}' not found in VCAb table") from None
+
+    def row(self, pdb_code: str) -> pd.Series:
+        """Returns the first row for a PDB code (VCAb can list several H/L pairs per entry)."""
+        return self.df.iloc[self.positions(pdb_code)[0]]
+
+    def label(self, pdb_code: str):
+        """Returns the DataFrame index label of the first row for a PDB code."""
+        return self.df.index[self.positions(pdb_code)[0]]
+
+    def rows(self, pdb_codes) -> pd.DataFrame:
+        """Returns all rows for one PDB code or a list of PDB codes, keeping the table order."""
+        if isinstance(pdb_codes, str):
+            pdb_codes = [pdb_codes]
+        positions = sorted(pos for code in pdb_codes for pos in self.positions(code))
+        return self.df.iloc[positions]
+
+    def by_isotype(self, isotype: str, species: str = None) -> pd.DataFrame:
+        """Returns all rows with a heavy chain isotype, optionally restricted to one species."""
+        if self._groups is None:
+            self._groups = self.df.groupby(["H_isotype_clean", "HC_species"], sort=False, observed=True).indices
+
+        positions = sorted(
+            pos
+            for (group_isotype, group_species), group_positions in self._groups.items()
+            if group_isotype == isotype and (species is None or group_species == species)
+            for pos in group_positions
+        )
+        return self.df.iloc[positions]
+
+    def numbering(self, chain: str) -> RaggedNumbering:
+        """Returns the parsed PDB numbering of every row for chain "H" or "L", parsed on first use."""
+        if chain not in self._numbering:
+            self._numbering[chain] = RaggedNumbering.from_table(self.df, chain)
+        return self._numbering[chain]
+
+    def isotypes(self) -> list:
+        """Returns the heavy chain isotypes present in the table."""
+        return sorted(self.df["H_isotype_clean"].dropna().unique())
+
+
+def as_index(df_or_index) -> VCAbIndex:
+    """Returns the argument if it is already a VCAbIndex, otherwise indexes the DataFrame."""
+    if isinstance(df_or_index, VCAbIndex):
+        return df_or_index
+    return VCAbIndex(df_or_index)
@@ -0,0 +1,38 @@
+# Stand-in for the parts of MODELLER the pipeline's model classes use, so the benchmarks run on
+# machines without a MODELLER licence. Nothing is modelled: AutoModel.make() writes a small mmCIF
+# file per model with a made-up DOPE score after a fixed amount of CPU work, which is enough to
+# time the pipeline's own per-model overhead (checkpoints, restraint cache, result handling).
+# run_benchmarks.py puts this directory first on sys.path unless --real-modeller is given.
+
+
+class _Info:
+    version = "standin"
+    version_info = (0, 0)
+
+
+info = _Info()
+
+
+class _Log:
+    def verbose(self):
+        pass
+
+    def minimal(self):
+        pass
+
+    def none(self):
+        pass
+
+
+log = _Log()
+
+
+class _IO:
+    def __init__(self):
+        self.atom_files_directory = ["."]
+
+
+class Environ:
+    def __init__(self, rand_seed: int = -8123, **kwargs):
+        self.rand_seed = rand_seed
+        self.io = _IO()
@@ -0,0 +1,309 @@
+# Benchmarks of the sequence preparation and .pir stages on synthetic VCAb tables of increasing size,
+# plus the per-model overhead of the model classes against a MODELLER stand-in.
+# Synthetic data (synthetic_vcab.py) is generated once per scale under --data-dir and reused.
+# Results are written as json (one file per run, named by date and git commit) so runs on
+# different commits can be compared with --compare.
+#
+# Usage (from the benchmarks directory):
+#   python run_benchmarks.py                          # 1k, 100k and 1M rows
+#   python run_benchmarks.py --scales 1k 100k --repeats 5
+#   python run_benchmarks.py --compare results/a.json results/b.json
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+scripts_dir = os.path.join(os.path.dirname(benchmarks_dir), "Scripts")
+standin_dir = os.path.join(benchmarks_dir, "modeller_standin")
+
+scale_rows = {"k": 1000, "m": 1000000}
+
+
+def parse_scale(scale: str) -> int:
+    """"1k" -> 1000, "1m" -> 1000000, "2500" -> 2500."""
+    scale = scale.lower()
+    if scale[-1] in scale_rows:
+        return int(float(scale[:-1]) * scale_rows[scale[-1]])
+    return int(scale)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=benchmarks_dir,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def timed(func, repeats: int, setup=None):
+    """Runs func(*setup()) `repeats` times with its printing silenced.
+    Returns (list of seconds, result of the last run). setup() is not timed."""
+    times = []
+    result = None
+    for _ in range(repeats):
+        args = setup() if setup else ()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func(*args)
+            times.append(time.perf_counter() - start)
+    return times, result
+
+
+def summary(name: str, scale: str, rows: int, times: list, calls: int = 1) -> dict:
+    best = min(times)
+    print(f"{scale:>6} {name:<28} best {best:10.4f} s  median {statistics.median(times):10.4f} s"
+          + (f"  ({best / calls * 1000:.3f} ms per call)" if calls > 1 else ""))
+    return {"benchmark": name, "scale": scale, "rows": rows, "calls": calls, "repeats": len(times),
+            "times_s": times, "best_s": best, "median_s": statistics.median(times)}
+
+
+def ensure_data(rows: int, data_dir: str, seed: int, cif_files: int) -> str:
+    """Synthetic VCAb.csv and mmCIF files for this many rows (generated on first use). Returns the directory."""
+    import synthetic_vcab
+
+    out_dir = os.path.join(data_dir, f"{rows}_seed{seed}")
+    csv_path = os.path.join(out_dir, "VCAb.csv")
+    if not os.path.isfile(csv_path):
+        print(f"Generating {rows} synthetic VCAb rows in {out_dir}")
+        synthetic_vcab.main(["--rows", str(rows), "--out", out_dir, "--seed", str(seed), "--cif-files", str(cif_files)])
+    return out_dir
+
+
+def hybrid_tables(vcab_index, v_template: str, c_template: str):
+    """Light and heavy chain tables of one hybrid, as run_model_pipeline.py builds them."""
+    import prepare_sequences
+
+    df_matches = vcab_index.rows([v_template, c_template]).copy()
+    df_matches.insert(loc=1, column="template", value=None)
+    df_matches.loc[df_matches["pdb"] == v_template, "template"] = "v_template"
+    df_matches.loc[df_matches["pdb"] == c_template, "template"] = "c_template"
+    cl_zip, ch_zip = prepare_sequences.get_constant_region(*prepare_sequences.zip_template_cif(vcab_index, c_template))
+    vl_zip, vh_zip = prepare_sequences.get_variable_region(*prepare_sequences.zip_template_cif(vcab_index, v_template))
+    light, heavy = prepare_sequences.make_recombinant_seqs(vl_zip, vh_zip, cl_zip, ch_zip)
+    return (df_matches,
+            prepare_sequences.make_df_lights(df_matches, light),
+            prepare_sequences.make_df_heavies(df_matches, heavy))
+
+
+def run_scale(scale: str, rows: int, args, work_dir: str) -> list:
+    import my_run_info
+    import prepare_sequences
+    import convert_to_pir
+    import synthetic_vcab
+    from vcab_index import VCAbIndex
+
+    data = ensure_data(rows, args.data_dir, args.seed, args.cif_files)
+    csv_path = os.path.join(data, "VCAb.csv")
+    cif_dir = os.path.join(data, "atom_files")
+    my_run_info.VCAb_dir = csv_path
+    repeats = args.repeats if rows < 1000000 else max(1, args.repeats // 3)
+    results = []
+
+    # Loading and refining the table
+    times, df_raw = timed(prepare_sequences.load_VCAb, repeats)
+    results.append(summary("load_VCAb", scale, rows, times))
+    times, df_refined = timed(prepare_sequences.refine_VCAb, repeats, setup=lambda df=df_raw: (df.copy(),))
+    results.append(summary("refine_VCAb", scale, rows, times))
+    del df_raw
+    times, _ = timed(lambda: prepare_sequences.load_VCAb_chunked(csv_path, my_run_info.VCAb_chunksize), repeats)
+    results.append(summary("load_VCAb_chunked", scale, rows, times))
+    df_refined = df_refined.reset_index(drop=True)
+
+    # Indexing and numbering
+    times, vcab_index = timed(VCAbIndex, repeats, setup=lambda: (df_refined,))
+    results.append(summary("VCAbIndex", scale, rows, times))
+    times, _ = timed(lambda index: (index.numbering("H"), index.numbering("L")), repeats,
+                     setup=lambda: (VCAbIndex(df_refined),))
+    results.append(summary("parse_numbering", scale, rows, times))
+    vcab_index.numbering("H"), vcab_index.numbering("L")
+
+    # Per-template lookups on a sample of codes
+    codes = list(dict.fromkeys(df_refined["pdb"].tolist()))[:args.sample]
+    times, zips = timed(lambda: [prepare_sequences.zip_template_cif(vcab_index, code) for code in codes], repeats)
+    results.append(summary("zip_template_cif", scale, rows, times, calls=len(codes)))
+    times, _ = timed(lambda: [(prepare_sequences.get_variable_region(*z), prepare_sequences.get_constant_region(*z))
+                              for z in zips], repeats)
+    results.append(summary("region_split", scale, rows, times, calls=len(zips)))
+
+    def reset_boundaries():
+        for chain in ("H", "L"):
+            vcab_index.numbering(chain)._boundary_indices = None
+        return ()
+    times, _ = timed(lambda: (vcab_index.numbering("H").split_points(), vcab_index.numbering("L").split_points()),
+                     repeats, setup=reset_boundaries)
+    results.append(summary("region_split_table", scale, rows, times))
+
+    # One hybrid through the FASTA and .pir stages
+    v_template, c_template = "1n8z", "3m8o"
+    with contextlib.redirect_stdout(io.StringIO()):
+        df_matches, df_light, df_heavy = hybrid_tables(vcab_index, v_template, c_template)
+    isotype = str(vcab_index.row(c_template)["H_isotype_clean"])
+    for name in ("fasta_sequences", "alignments", "pir_files"):
+        os.makedirs(os.path.join(work_dir, name), exist_ok=True)
+    times, fasta_paths = timed(prepare_sequences.write_fastas, repeats,
+                               setup=lambda: (df_light, df_heavy, os.path.join(work_dir, "fasta_sequences"), df_matches, "bench"))
+    results.append(summary("write_fastas", scale, rows, times))
+
+    clustal_dir = os.path.join(work_dir, "alignments")
+    clustal_names = {}
+    for chain, fasta_path in zip(("light", "heavy"), fasta_paths):
+        clustal_names[chain] = f"Fab_alignment_{isotype}_{chain}.aln-clustal"
+        synthetic_vcab.write_hybrid_clustal(fasta_path, os.path.join(clustal_dir, clustal_names[chain]))
+
+    cif_codes = sorted(name[:-4] for name in os.listdir(cif_dir) if name.endswith(".cif"))
+    cache_path = os.path.join(work_dir, "chain_order.json")
+
+    def clear_chain_cache():
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        return ()
+    times, _ = timed(lambda: [convert_to_pir.cif_parse(code, f"{code}.cif", cif_dir, cache_path) for code in cif_codes],
+                     repeats, setup=clear_chain_cache)
+    results.append(summary("cif_parse", scale, rows, times, calls=len(cif_codes)))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        v_order = convert_to_pir.cif_parse(v_template, f"{v_template}.cif", cif_dir, cache_path)
+        c_order = convert_to_pir.cif_parse(c_template, f"{c_template}.cif", cif_dir, cache_path)
+
+    def populated():
+        with contextlib.redirect_stdout(io.StringIO()):
+            df_combined = convert_to_pir.merge_df_for_pir(df_light, df_heavy)
+            return (convert_to_pir.relevant_chains(df_combined, v_order, c_order, v_template, c_template),
+                    clustal_dir, clustal_names["light"], clustal_names["heavy"])
+    times, df_for_pir = timed(convert_to_pir.extract_gapped_seqs, repeats, setup=populated)
+    results.append(summary("extract_gapped_seqs", scale, rows, times))
+
+    pir_path = os.path.join(work_dir, "pir_files", f"pir_alignment_{isotype}_bench.pir")
+    times, _ = timed(convert_to_pir.write_modeller_pir, repeats,
+                     setup=lambda: (df_for_pir, pir_path, v_template, c_template, isotype))
+    results.append(summary("write_modeller_pir", scale, rows, times))
+    return results
+
+
+def run_models(args, work_dir: str) -> list:
+    """Builds an ensemble with the pipeline's model class mixins (restraint cache and checkpoints)
+    on top of AutoModel, cold and then resumed from its checkpoint."""
+    from modeller import Environ
+    from modeller.automodel import AutoModel, assess
+    import model_checkpoint
+    import restraint_cache
+
+    models_dir = os.path.join(work_dir, "models")
+    os.makedirs(models_dir, exist_ok=True)
+    alnfile = os.path.join(models_dir, "bench.pir")
+    with open(alnfile, "w") as f:
+        f.write(">P1;bench_target\nsequence:bench_target::::::::\nEVQLVESGG*\n")
+
+    model_class = model_checkpoint.checkpointed(restraint_cache.with_restraint_cache(AutoModel))
+    model_class.restraint_cache_dir = os.path.join(work_dir, "restraints")
+
+    def build():
+        os.chdir(models_dir)
+        a = model_class(Environ(rand_seed=-8123), alnfile=alnfile, knowns=[], sequence="bench_target",
+                        assess_methods=(assess.DOPE, assess.GA341))
+        a.starting_model, a.ending_model = 1, args.models
+        a.checkpoint_seed = -8123
+        a.set_output_model_format("MMCIF")
+        a.make()
+        return a.outputs
+
+    def fresh():
+        shutil.rmtree(models_dir, ignore_errors=True)
+        shutil.rmtree(model_class.restraint_cache_dir, ignore_errors=True)
+        os.makedirs(models_dir)
+        with open(alnfile, "w") as f:
+            f.write(">P1;bench_target\nsequence:bench_target::::::::\nEVQLVESGG*\n")
+        return ()
+
+    results = []
+    cwd = os.getcwd()
+    try:
+        times, _ = timed(build, args.repeats, setup=fresh)
+        results.append(summary("models_cold", "-", 0, times, calls=args.models))
+        times, _ = timed(build, args.repeats)
+        results.append(summary("models_resumed", "-", 0, times, calls=args.models))
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def compare(old_path: str, new_path: str):
+    """Prints the best time of every benchmark in two result files and their ratio."""
+    with open(old_path) as f:
+        old = {(r["benchmark"], r["scale"]): r for r in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = json.load(f)["results"]
+    print(f"{'scale':>6} {'benchmark':<28} {'old s':>10} {'new s':>10} {'new/old':>8}")
+    for result in new:
+        before = old.get((result["benchmark"], result["scale"]))
+        if before is None:
+            continue
+        ratio = result["best_s"] / before["best_s"] if before["best_s"] else float("inf")
+        print(f"{result['scale']:>6} {result['benchmark']:<28} {before['best_s']:>10.4f} {result['best_s']:>10.4f} {ratio:>8.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic VCAb data.")
+    parser.add_argument("--scales", nargs="+", default=["1k", "100k", "1m"], help="Table sizes, e.g. 1k 100k 1m")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per benchmark (a third of this at 1M rows)")
+    parser.add_argument("--sample", type=int, default=200, help="Templates looked up per zip_template_cif run")
+    parser.add_argument("--models", type=int, default=20, help="Models per stand-in ensemble (0 to skip)")
+    parser.add_argument("--cif-files", type=int, default=20, help="Synthetic mmCIF files per scale")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=os.path.join(benchmarks_dir, "data"))
+    parser.add_argument("--out", help="Result json (default: results/<date>_<commit>.json)")
+    parser.add_argument("--real-modeller", action="store_true", help="Use the installed MODELLER instead of the stand-in")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    if not args.real_modeller:
+        sys.path.insert(0, standin_dir)
+    sys.path.insert(0, scripts_dir)
+    sys.path.insert(0, benchmarks_dir)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="vcab_bench_") as work_dir:
+        for scale in args.scales:
+            results.extend(run_scale(scale, parse_scale(scale), args, os.path.join(work_dir, scale)))
+        if args.models > 0:
+            results.extend(run_models(args, work_dir))
+
+    import numpy
+    import pandas
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "pandas": pandas.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "modeller": "real" if args.real_modeller else "standin",
+        "results": results,
+    }
+    out_path = args.out or os.path.join(benchmarks_dir, "results", f"{datetime.now():%Y%m%d_%H%M%S}_{commit}.json")
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"Results written to {out_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
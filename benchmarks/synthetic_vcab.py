@@ -0,0 +1,289 @@
+# Synthetic VCAb-shaped data for the benchmarks.
+# Rows are built from a pool of mutated Fab variable and constant domains (trastuzumab VH/VL,
+# human CH1 and kappa CL as the starting point), so sequences, Kabat/EU style PDB numbering
+# (repeated numbers for insertions, a gap between the V and C numbering), VC boundaries and
+# disulfide bonds ("H:22-H:92;..." chain:number pairs) look like the real table. Each PDB code has
+# two rows (two H/L pairs), and about a third of the rows are mouse or lambda and are dropped by refine_VCAb().
+# Also writes mmCIF files for some of the entries and Clustal alignments of two of them.
+#
+# Usage (from the benchmarks directory):
+#   python synthetic_vcab.py --rows 100000 --out data/100k
+
+import argparse
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+# Starting sequences
+_vh = "EVQLVESGGGLVQPGGSLRLSCAASGFNIKDTYIHWVRQAPGKGLEWVARIYPTNGYTRYADSVKGRFTISADTSKNTAYLQMNSLRAEDTAVYYCSRWGGDGFYAMDYWGQGTLVTVSS"
+_vl = "DIQMTQSPSSLSASVGDRVTITCRASQDVNTAVAWYQQKPGKAPKLLIYSASFLYSGVPSRFSGSRSGTDFTLTISSLQPEDFATYYCQQHYTTPPTFGQGTKVEIK"
+_ch1 = "ASTKGPSVFPLAPSSKSTSGGTAALGCLVKDYFPEPVTVSWNSGALTSGVHTFPAVLQSSGLYSLSSVVTVPSSSLGTQTYICNVNHKPSNTKVDKKVEPKSC"
+_cl = "RTVAAPSVFIFPPSDEQLKSGTASVVCLLNNFYPREAKVQWKVDNALQSGNSQESVTEQDSKDSTYSLSSTLTLSKADYEKHKVYACEVTHQGLSSPVTKSFNRGEC"
+_amino_acids = np.array(list("ACDEFGHIKLMNPQRSTVWY".replace("C", "")))
+
+# VH CDR3 (Kabat 95-102) sits between these positions of _vh; its length varies between variants
+_vh_cdr3 = (98, 109)
+_heavy_boundary = 113  # Kabat end of VH
+_light_boundary = 107  # Kabat end of VL
+_heavy_constant_start = 118  # EU numbering of CH1
+_light_constant_start = 108
+
+isotypes = ["IgG1", "IgG2", "IgG3", "IgG4", "IgA1", "IgA2", "IgM", "IgE", "IgD"]
+vcab_columns = [
+    "pdb", "Hchain", "Lchain", "H_seq", "L_seq", "H_coordinate_seq", "L_coordinate_seq",
+    "H_PDB_numbering", "L_PDB_numbering", "pdb_H_VC_Boundary", "pdb_L_VC_Boundary",
+    "title", "release_date", "method", "resolution", "carbohydrate", "HC_species",
+    "Htype", "Ltype", "HC_coordinate_seq", "LC_coordinate_seq", "HV_seq", "LV_seq", "disulfide_bond",
+    "iden_code", "structural_coverage",
+]
+_chain_pairs = [("H", "L"), ("B", "A"), ("D", "C"), ("F", "E")]
+_three_letter = {
+    "A": "ALA", "C": "CYS", "D": "ASP", "E": "GLU", "F": "PHE", "G": "GLY", "H": "HIS", "I": "ILE", "K": "LYS",
+    "L": "LEU", "M": "MET", "N": "ASN", "P": "PRO", "Q": "GLN", "R": "ARG", "S": "SER", "T": "THR", "V": "VAL",
+    "W": "TRP", "Y": "TYR",
+}
+
+
+def mutate(rng, sequence: str, rate: float) -> str:
+    """Substitutes a fraction of the residues, never creating or removing a cysteine."""
+    letters = np.array(list(sequence))
+    positions = np.flatnonzero((rng.random(len(letters)) < rate) & (letters != "C"))
+    letters[positions] = rng.choice(_amino_acids, size=len(positions))
+    return "".join(letters)
+
+
+def heavy_variable_variant(rng, kabat: bool):
+    """(sequence, numbers) of a VH with a CDR3 of random length, numbered Kabat style (repeats at
+    52 and 100 for insertions) or sequentially from 1."""
+    cdr3 = "".join(rng.choice(_amino_acids, size=rng.integers(8, 19)))
+    sequence = mutate(rng, _vh[:_vh_cdr3[0]], 0.08) + cdr3 + _vh[_vh_cdr3[1]:]
+    if not kabat:
+        return sequence, list(range(1, len(sequence) + 1))
+    # 1-52, 52A, 53-82, 82ABC, 83-100, 100A..., 101-113 with insertion letters written as repeats
+    extra = len(sequence) - 117
+    numbers = list(range(1, 53)) + [52] + list(range(53, 83)) + [82] * 3 + list(range(83, 101))
+    numbers += [100] * extra + list(range(101, 114))
+    return sequence, numbers
+
+
+def light_variable_variant(rng, kabat: bool):
+    """(sequence, numbers) of a VL, sometimes with a longer CDR1 (repeats at 27)."""
+    cdr1_extra = int(rng.choice([0, 0, 0, 1, 4, 5]))
+    sequence = mutate(rng, _vl[:27], 0.08) + "".join(rng.choice(_amino_acids, size=cdr1_extra)) + mutate(rng, _vl[27:], 0.08)
+    if not kabat:
+        return sequence, list(range(1, len(sequence) + 1))
+    return sequence, list(range(1, 28)) + [27] * cdr1_extra + list(range(28, 108))
+
+
+def constant_variant(rng, base: str, start: int, rate: float, trim: int):
+    """(sequence, numbers) of a constant domain numbered from `start`, missing `trim` C-terminal residues
+    (unobserved in the structure)."""
+    sequence = mutate(rng, base, rate)
+    sequence = sequence[:len(sequence) - trim] if trim else sequence
+    return sequence, list(range(start, start + len(sequence)))
+
+
+def cys_pairs(chain: str, sequence: str, numbers: list):
+    """Intra-domain disulfides of an Ig chain, consecutive cysteines paired up (e.g. "H:22-H:92").
+    Returns (pairs, number of the unpaired last cysteine or None), the latter being the H-L disulfide."""
+    cys = [numbers[i] for i, letter in enumerate(sequence) if letter == "C"]
+    pairs = [f"{chain}:{cys[i]}-{chain}:{cys[i + 1]}" for i in range(0, len(cys) - 1, 2)]
+    return pairs, cys[-1] if len(cys) % 2 else None
+
+
+def make_pools(seed: int, pool_size: int) -> dict:
+    """Variant pools every row picks from (so rows are cheap to build at 1M rows)."""
+    rng = np.random.default_rng(seed)
+    pools = {"heavy_v": [], "light_v": [], "heavy_c": {}, "light_c": {}}
+    for i in range(pool_size):
+        kabat = i % 5 != 0  # a fifth of the entries are numbered sequentially
+        pools["heavy_v"].append((kabat,) + heavy_variable_variant(rng, kabat))
+        pools["light_v"].append((kabat,) + light_variable_variant(rng, kabat))
+    for k, isotype in enumerate(isotypes):
+        # each isotype is its own (synthetic) constant sequence, with a few unobserved C-terminal residues
+        isotype_rng = np.random.default_rng(seed + 1000 + k)
+        base = mutate(isotype_rng, _ch1, 0.0 if isotype == "IgG1" else 0.2)
+        pools["heavy_c"][isotype] = [constant_variant(rng, base, _heavy_constant_start, 0.01, trim) for trim in (0, 2, 5)]
+    for light_type in ("kappa", "lambda"):
+        base = _cl if light_type == "kappa" else mutate(np.random.default_rng(seed + 2000), _cl, 0.35)
+        pools["light_c"][light_type] = [constant_variant(rng, base, _light_constant_start, 0.01, trim) for trim in (0, 1, 3)]
+    return pools
+
+
+_n_codes = 9 * 36 ** 3
+
+
+def pdb_code(i: int) -> str:
+    """Four-character PDB-like code for entry i (a digit then three letters or digits)."""
+    alphabet = "abcdefghijklmnopqrstuvwxyz0123456789"
+    return f"{1 + i % 9}{alphabet[(i // 9) % 36]}{alphabet[(i // 324) % 36]}{alphabet[(i // 11664) % 36]}"
+
+
+def make_rows(pools: dict, first_row: int, n_rows: int, seed: int, template_codes=("1n8z", "3m8o")) -> pd.DataFrame:
+    """Rows first_row..first_row + n_rows of the synthetic table. The first rows get the template codes."""
+    rng = np.random.default_rng([seed, first_row])
+    rows_per_entry = 2  # chain pairs per PDB code
+    heavy_v = rng.integers(len(pools["heavy_v"]), size=n_rows)
+    light_v = rng.integers(len(pools["light_v"]), size=n_rows)
+    heavy_c = rng.integers(3, size=n_rows)
+    light_c = rng.integers(3, size=n_rows)
+    isotype = rng.choice(isotypes, size=n_rows, p=[0.55, 0.08, 0.04, 0.12, 0.06, 0.03, 0.05, 0.04, 0.03])
+    light_type = np.where(rng.random(n_rows) < 0.8, "kappa", "lambda")
+    species = np.where(rng.random(n_rows) < 0.85, "homo_sapiens", "mus_musculus")
+    method = np.where(rng.random(n_rows) < 0.9, "X-RAY DIFFRACTION", "ELECTRON MICROSCOPY")
+    resolution = np.round(rng.gamma(9.0, 0.25, size=n_rows), 2)
+
+    records = []
+    for j in range(n_rows):
+        i = first_row + j
+        entry, pair = divmod(i, rows_per_entry)
+        pair += rows_per_entry * (entry // _n_codes)  # codes repeat past _n_codes entries, with other chain IDs
+        if i < len(template_codes):
+            code, pair = template_codes[i], 1 - i % 2  # B/A chains, as in the real 1n8z, then H/L
+            isotype[j], light_type[j], species[j], method[j] = ("IgG1" if i == 0 else "IgG2"), "kappa", "homo_sapiens", "X-RAY DIFFRACTION"
+        else:
+            code = pdb_code(entry + 10)
+        h_id, l_id = _chain_pairs[pair % len(_chain_pairs)]
+        heavy_kabat, hv_seq, hv_num = pools["heavy_v"][heavy_v[j]]
+        light_kabat, lv_seq, lv_num = pools["light_v"][light_v[j]]
+        hc_seq, hc_num = pools["heavy_c"][isotype[j]][heavy_c[j]]
+        lc_seq, lc_num = pools["light_c"][light_type[j]][light_c[j]]
+        # sequential numbering runs on through the constant domain
+        if not heavy_kabat:
+            hc_num = list(range(len(hv_num) + 1, len(hv_num) + 1 + len(hc_seq)))
+        if not light_kabat:
+            lc_num = list(range(len(lv_num) + 1, len(lv_num) + 1 + len(lc_seq)))
+
+        h_seq = hv_seq + hc_seq
+        l_seq = lv_seq + lc_seq
+        h_numbers = hv_num + hc_num
+        l_numbers = lv_num + lc_num
+        heavy_pairs, heavy_free = cys_pairs(h_id, h_seq, h_numbers)
+        light_pairs, light_free = cys_pairs(l_id, l_seq, l_numbers)
+        disulfides = heavy_pairs + light_pairs
+        if heavy_free is not None and light_free is not None:
+            disulfides.append(f"{h_id}:{heavy_free}-{l_id}:{light_free}")
+        records.append((
+            code, h_id, l_id,
+            h_seq + ("HHHHHH" if i % 7 == 0 else ""), l_seq,
+            h_seq, l_seq,
+            ",".join(map(str, h_numbers)), ",".join(map(str, l_numbers)),
+            hv_num[-1], lv_num[-1],
+            f"Synthetic Fab {code.upper()} in complex with antigen", f"{2000 + i % 24}-{1 + i % 12:02d}-{1 + i % 28:02d}",
+            method[j], resolution[j], "" if i % 3 else "NAG",
+            species[j], f"{isotype[j]}(IGH{isotype[j][2:].upper()}*01)", f"{light_type[j]}(IG{'K' if light_type[j] == 'kappa' else 'L'}C*01)",
+            hc_seq, lc_seq, hv_seq, lv_seq, ";".join(disulfides),
+            f"{code}_{h_id}{l_id}", round(float(0.9 + 0.1 * (i % 10) / 10), 3),
+        ))
+    return pd.DataFrame.from_records(records, columns=vcab_columns)
+
+
+def write_vcab_csv(path: str, n_rows: int, seed: int = 0, pool_size: int = 512, chunk_rows: int = 50000) -> str:
+    """Writes a synthetic VCAb.csv of n_rows rows, chunk by chunk so memory stays bounded."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    pools = make_pools(seed, pool_size)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    for first_row in range(0, n_rows, chunk_rows):
+        chunk = make_rows(pools, first_row, min(chunk_rows, n_rows - first_row), seed)
+        chunk.to_csv(tmp_path, mode="w" if first_row == 0 else "a", header=first_row == 0, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def write_cif(path: str, code: str, chains: list):
+    """Writes a minimal mmCIF file with N, CA, C, O (and SG for cysteines) of each (chain id, sequence, numbers)
+    chain, laid out along a helix-like CA trace so neighbouring CA atoms are 3.8 A apart."""
+    fields = ["group_PDB", "id", "type_symbol", "label_atom_id", "label_alt_id", "label_comp_id", "label_asym_id",
+              "label_entity_id", "label_seq_id", "pdbx_PDB_ins_code", "Cartn_x", "Cartn_y", "Cartn_z", "occupancy",
+              "B_iso_or_equiv", "pdbx_formal_charge", "auth_seq_id", "auth_comp_id", "auth_asym_id", "auth_atom_id",
+              "pdbx_PDB_model_num"]
+    lines = [f"data_{code}", "#", "loop_"] + [f"_atom_site.{field}" for field in fields]
+    atom_id = 1
+    for c, (chain_id, sequence, numbers) in enumerate(chains):
+        previous = None
+        insertion = ""
+        for i, (letter, number) in enumerate(zip(sequence, numbers)):
+            # repeated numbers are insertions: 52, 52A, 52B, ...
+            insertion = chr(ord(insertion or "@") + 1) if number == previous else ""
+            previous = number
+            angle = i * 100 * math.pi / 180
+            ca = np.array([2.3 * math.cos(angle) + 30 * c, 2.3 * math.sin(angle), 1.5 * i])
+            atoms = [("N", "N", ca + [-1.2, 0.6, -0.5]), ("CA", "C", ca), ("C", "C", ca + [1.2, 0.5, 0.6]),
+                     ("O", "O", ca + [1.4, 1.6, 1.1])]
+            if letter == "C":
+                atoms.append(("SG", "S", ca + [-0.9, -1.6, 0.3]))
+            for name, element, xyz in atoms:
+                lines.append(
+                    f"ATOM {atom_id} {element} {name} . {_three_letter[letter]} {chain_id} {c + 1} {i + 1} "
+                    f"{insertion or '?'} {xyz[0]:.3f} {xyz[1]:.3f} {xyz[2]:.3f} 1.00 30.00 ? {number} "
+                    f"{_three_letter[letter]} {chain_id} {name} 1"
+                )
+                atom_id += 1
+    lines.append("#")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_cifs(df: pd.DataFrame, cif_dir: str, codes: list) -> list:
+    """Writes {code}.cif for the first row of each code (light chain first for even rows,
+    as chain order varies in real entries). Returns the paths."""
+    os.makedirs(cif_dir, exist_ok=True)
+    paths = []
+    for k, code in enumerate(codes):
+        row = df[df["pdb"] == code].iloc[0]
+        heavy = (row["Hchain"], row["H_coordinate_seq"], [int(n) for n in row["H_PDB_numbering"].split(",")])
+        light = (row["Lchain"], row["L_coordinate_seq"], [int(n) for n in row["L_PDB_numbering"].split(",")])
+        path = os.path.join(cif_dir, f"{code}.cif")
+        write_cif(path, code, [light, heavy] if k % 2 == 0 else [heavy, light])
+        paths.append(path)
+    return paths
+
+
+def write_clustal(path: str, records: list, width: int = 60):
+    """Writes (id, gapped sequence) records as a Clustal alignment."""
+    lines = ["CLUSTAL W multiple sequence alignment", "", ""]
+    length = max(len(sequence) for _, sequence in records)
+    for start in range(0, length, width):
+        for name, sequence in records:
+            lines.append(f"{name:<36}{sequence[start:start + width]}")
+        lines.extend(["", ""])
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+
+
+def write_hybrid_clustal(fasta_path: str, out_path: str):
+    """Aligns the sequences of a FASTA file by padding them to the same length with gaps at the
+    V/C junction, which is enough for the .pir stages to parse."""
+    records = []
+    with open(fasta_path) as f:
+        name = None
+        for line in f:
+            line = line.strip()
+            if line.startswith(">"):
+                name = line[1:].split()[0]
+            elif name:
+                records.append((name, line))
+                name = None
+    length = max(len(sequence) for _, sequence in records)
+    write_clustal(out_path, [(name, sequence + "-" * (length - len(sequence))) for name, sequence in records])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic VCAb.csv plus mmCIF files for benchmarking.")
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--out", default="data/1k", help="Directory for VCAb.csv and atom_files/")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cif-files", type=int, default=20, help="Entries written as mmCIF files")
+    args = parser.parse_args(argv)
+
+    csv_path = write_vcab_csv(os.path.join(args.out, "VCAb.csv"), args.rows, args.seed)
+    head = pd.read_csv(csv_path, nrows=4 * args.cif_files)
+    write_cifs(head, os.path.join(args.out, "atom_files"), head["pdb"].drop_duplicates().tolist()[:args.cif_files])
+    print(f"Wrote {csv_path} ({os.path.getsize(csv_path) / 1e6:.1f} MB)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
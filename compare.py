@@ -4,28 +4,184 @@
 # Align all of the best template structures detected in the previous step
 # and compare them. Then align the target sequence with this block of
 # aligned structures to generate an alignment suitable for modeling.
+#
+# Pairwise comparisons (sequence identity, RMSD and the superposition of every
+# pair of templates in atom_files) are cached in template_comparison.json, keyed
+# by the contents of the template files. Only pairs that are not in the cache are
+# compared, so adding a template to atom_files compares just that template with
+# the others. family.mat and the dendrogram are written from the cached matrix.
+#
+# Usage:
+#   python compare.py                                  # every template in ../atom_files
+#   python compare.py --templates 1clf:A 1dur:A 1fca:A 2fdn:A --target 1fdx.chn
+
+import argparse
+import glob
+import hashlib
+import itertools
+import json
+import os
 
 from modeller import *
 
-env = Environ()
-env.io.atom_files_directory = ['../atom_files']
-
-# Create an alignment of the 'A' chains of 1clf, 1dur, 1fca and 2fdn
-aln = Alignment(env)
-for (pdb, chain) in (('1clf', 'A'), ('1dur', 'A'), ('1fca', 'A'),
-                     ('2fdn', 'A')):
-    m = Model(env, file=pdb, model_segment=('FIRST:'+chain, 'LAST:'+chain))
-    aln.append_model(m, atom_files=pdb, align_codes=pdb+chain)
-
-# Structurally align all four templates and compare them
-aln.malign()
-aln.malign3d()
-aln.compare_structures()
-aln.id_table(matrix_file='family.mat')
-env.dendrogram(matrix_file='family.mat', cluster_cut=-1.0)
-
-# Align the target sequence to the previously-aligned structures
-align_block = len(aln)
-aln.append(file='1fdx.chn')
-aln.align2d(align_block=align_block, max_gap_length=50)
-aln.write(file='alignment.ali')
+atom_files_dir = '../atom_files'
+cache_file = 'template_comparison.json'
+structure_suffixes = ('.pdb', '.cif', '.ent', '.atm')
+# Bump this whenever compare_pair() changes, so cached pairs are recompared
+comparison_version = 1
+
+# The templates aligned with the target for modeling
+alignment_templates = ['1clf:A', '1dur:A', '1fca:A', '2fdn:A']
+
+
+def parse_template(template):
+    """'1clf:A' -> ('1clf', 'A'); a template without a chain is read whole."""
+    pdb, _, chain = template.partition(':')
+    return pdb, chain or None
+
+
+def template_label(template):
+    pdb, chain = parse_template(template)
+    return pdb + (chain or '')
+
+
+def template_segment(template):
+    _, chain = parse_template(template)
+    return ('FIRST:' + chain, 'LAST:' + chain) if chain else ('FIRST:@', 'END:')
+
+
+def template_file(template):
+    pdb, _ = parse_template(template)
+    for suffix in structure_suffixes:
+        path = os.path.join(atom_files_dir, pdb + suffix)
+        if os.path.isfile(path):
+            return path
+    raise FileNotFoundError(f"No structure file for {pdb} in {atom_files_dir}")
+
+
+def library_templates():
+    """Every structure file in atom_files, read whole."""
+    names = {os.path.splitext(os.path.basename(path))[0]
+             for suffix in structure_suffixes
+             for path in glob.glob(os.path.join(atom_files_dir, '*' + suffix))}
+    return sorted(names)
+
+
+def template_key(template):
+    """Contents of the structure file plus the chain read from it."""
+    with open(template_file(template), 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    _, chain = parse_template(template)
+    return f"{digest}:{chain or '*'}"
+
+
+def pair_key(key_a, key_b):
+    return f"v{comparison_version}|" + '|'.join(sorted((key_a, key_b)))
+
+
+def load_cache(path=cache_file):
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_cache(cache, path=cache_file):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def read_template(env, template):
+    pdb, _ = parse_template(template)
+    return Model(env, file=pdb, model_segment=template_segment(template))
+
+
+def compare_pair(env, template_a, template_b):
+    """Structurally aligns two templates (as malign/malign3d do for the whole block) and returns
+    their sequence identity, CA RMSD and the superposition of a onto b."""
+    model_a = read_template(env, template_a)
+    model_b = read_template(env, template_b)
+    aln = Alignment(env)
+    for template, m in ((template_a, model_a), (template_b, model_b)):
+        aln.append_model(m, atom_files=parse_template(template)[0], align_codes=template_label(template))
+    aln.malign()
+    aln.malign3d()
+
+    fit = Selection(model_a).only_atom_types('CA').superpose(model_b, aln)
+    return {
+        'templates': [template_a, template_b],
+        'identity': aln[0].get_sequence_identity(aln[1]),
+        'rmsd': fit.rms,
+        'equivalent_positions': fit.num_equiv_pos,
+        'rotation': [list(row) for row in fit.rotation],
+        'translation': list(fit.translation),
+    }
+
+
+def update_cache(env, templates, cache):
+    """Compares every pair of templates that is not in the cache yet. Returns {template: key}."""
+    keys = {template: template_key(template) for template in templates}
+    missing = [(a, b) for a, b in itertools.combinations(templates, 2) if pair_key(keys[a], keys[b]) not in cache]
+    for n, (a, b) in enumerate(missing, start=1):
+        print(f"Comparing {a} with {b} ({n}/{len(missing)})")
+        cache[pair_key(keys[a], keys[b])] = compare_pair(env, a, b)
+        if n % 20 == 0:
+            save_cache(cache)  # keep finished pairs if the run is interrupted
+    if missing:
+        save_cache(cache)
+    print(f"{len(missing)} new pairs compared, {len(templates) * (len(templates) - 1) // 2 - len(missing)} read from the cache")
+    return keys
+
+
+def write_matrix(path, templates, keys, cache, distance):
+    """Writes a square distance matrix in PHYLIP format, as id_table writes family.mat."""
+    with open(path, 'w') as f:
+        f.write(f"{len(templates):5d}\n")
+        for a in templates:
+            row = [0.0 if a == b else distance(cache[pair_key(keys[a], keys[b])]) for b in templates]
+            f.write(f"{template_label(a):<10}" + ''.join(f"{value:8.2f}" for value in row) + '\n')
+
+
+def align_target(env, templates, target_file, out_file='alignment.ali'):
+    """Aligns the target sequence with the structurally aligned block of templates."""
+    aln = Alignment(env)
+    for template in templates:
+        aln.append_model(read_template(env, template), atom_files=parse_template(template)[0],
+                         align_codes=template_label(template))
+    aln.malign()
+    aln.malign3d()
+
+    align_block = len(aln)
+    aln.append(file=target_file)
+    aln.align2d(align_block=align_block, max_gap_length=50)
+    aln.write(file=out_file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cached all-vs-all comparison of the templates, then the target alignment.")
+    parser.add_argument('--library', nargs='+', help="Templates to compare (pdb or pdb:chain, default: every file in atom_files)")
+    parser.add_argument('--templates', nargs='+', default=alignment_templates, help="Templates aligned with the target")
+    parser.add_argument('--target', default='1fdx.chn', help="Target sequence (PIR), or 'none' to only compare templates")
+    args = parser.parse_args(argv)
+
+    env = Environ()
+    env.io.atom_files_directory = [atom_files_dir]
+
+    # Compare all templates, reusing every pair already in the cache
+    library = args.library or library_templates()
+    cache = load_cache()
+    keys = update_cache(env, library, cache)
+    write_matrix('family.mat', library, keys, cache, lambda pair: 100.0 - pair['identity'])
+    write_matrix('family_rmsd.mat', library, keys, cache, lambda pair: pair['rmsd'])
+    env.dendrogram(matrix_file='family.mat', cluster_cut=-1.0)
+
+    # Align the target sequence to the structurally aligned templates
+    if args.target != 'none':
+        align_target(env, args.templates, args.target)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
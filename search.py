@@ -5,41 +5,283 @@
 # This will only work if pdb_95.pir is first downloaded from the Modeller
 # website into this directory.
 # The output is a file search.prf listing potential templates.
+#
+# With --shards, pdb_95.pir is converted once into that many binary database
+# shards (cached in search_db/ until pdb_95.pir changes), the shards are scanned
+# by parallel worker processes, and the hits of every shard are merged into one
+# profile. Shard E-values are rescaled to the size of the whole database, so the
+# merged profile keeps the same max_aln_evalue cut-off as a single scan.
+# Several targets can be searched in one pass over the shards.
+#
+# Usage:
+#   python search.py                                   # single scan of the text database
+#   python search.py --shards 8 --workers 8            # sharded, parallel scan
+#   python search.py --shards 8 --targets 1fdx.chn 2abc.chn
 
-from modeller import *
+import argparse
+import json
+import multiprocessing
+import os
+import re
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from modeller import *
+
+database_file = 'pdb_95.pir'
+database_cache_dir = 'search_db'
+read_options = dict(chains_list='ALL', minmax_db_seq_len=(30, 4000), clean_sequences=True)
+build_options = dict(matrix_offset=-450, rr_file='${LIB}/blosum62.sim.mat',
+                     gap_penalties_1d=(-500, -50), n_prof_iterations=1,
+                     check_profile=False)
+max_aln_evalue = 0.01
 
-log.verbose()
-env = Environ()
-
-# Read in the database of PDB chains clustered at 95% sequence identity
-sdb = SequenceDB(env)
-try:
-    sdb.read(seq_database_file='pdb_95.pir', seq_database_format='PIR',
-             chains_list='ALL', minmax_db_seq_len=(30, 4000),
-             clean_sequences=True)
-except IOError:
-    errmsg = str(sys.exc_info()[1]) + """
+missing_database = """
    Could not open the PDB 95 database. This database is *not* included in the
    Modeller release, since it is frequently updated. To run this example, you
    first need to download pdb_95.pir.gz from the "Data file downloads" page on
    the Modeller website. (However, you can still run the rest of the
    examples in this directory without that database.)
 """
-    print(errmsg)
-    sys.exit(0)
 
-# Read in the target sequence in PIR alignment format
-aln = Alignment(env)
-aln.append(file='1fdx.chn', alignment_format='PIR', align_codes='ALL')
 
-# Convert the target sequence from alignment to profile format
-prf = aln.to_profile()
+def target_profile(env, target_file):
+    """Reads the target sequence in PIR alignment format and converts it to profile format."""
+    aln = Alignment(env)
+    aln.append(file=target_file, alignment_format='PIR', align_codes='ALL')
+    return aln.to_profile()
+
+
+def search(target_file, out_file='search.prf'):
+    """Scans the whole text database with one profile search (the original tutorial step)."""
+    env = Environ()
+
+    # Read in the database of PDB chains clustered at 95% sequence identity
+    sdb = SequenceDB(env)
+    try:
+        sdb.read(seq_database_file=database_file, seq_database_format='PIR', **read_options)
+    except IOError:
+        print(str(sys.exc_info()[1]) + missing_database)
+        sys.exit(0)
+
+    # Scan sequence database to pick up homologous sequences
+    prf = target_profile(env, target_file)
+    prf.build(sdb, max_aln_evalue=max_aln_evalue, **build_options)
+
+    # Write out the profile in text format
+    prf.write(file=out_file, profile_format='TEXT')
+
+
+# === Binary database shards ===
+
+def shard_dir(n_shards):
+    stem = os.path.splitext(os.path.basename(database_file))[0]
+    return os.path.join(database_cache_dir, f"{stem}_{n_shards}shards")
+
+
+def read_manifest(n_shards):
+    """The shard manifest if it was made from the current database file and read options, else None."""
+    path = os.path.join(shard_dir(n_shards), 'manifest.json')
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    stat = os.stat(database_file)
+    if (manifest.get('size'), manifest.get('mtime_ns')) != (stat.st_size, stat.st_mtime_ns):
+        return None
+    if manifest.get('read_options') != json.loads(json.dumps(read_options)):
+        return None
+    return manifest
+
+
+def split_pir(pir_path, out_paths):
+    """Deals the entries of a PIR file round-robin into len(out_paths) files. Returns entries per file."""
+    outs = [open(path, 'w') for path in out_paths]
+    counts = [0] * len(outs)
+    current = -1
+    try:
+        with open(pir_path) as f:
+            for line in f:
+                if line.startswith('>'):
+                    current = (current + 1) % len(outs)
+                    counts[current] += 1
+                if current >= 0:
+                    outs[current].write(line)
+    finally:
+        for out in outs:
+            out.close()
+    return counts
+
+
+def convert_shard(pir_path, bin_path):
+    """Reads one PIR shard and writes it in MODELLER's binary database format.
+    Returns the number of sequences kept by the read options."""
+    env = Environ()
+    sdb = SequenceDB(env)
+    sdb.read(seq_database_file=pir_path, seq_database_format='PIR', **read_options)
+    sdb.write(seq_database_file=bin_path, seq_database_format='BINARY', chains_list='ALL')
+    os.remove(pir_path)
+    return len(sdb)
+
+
+def convert_database(n_shards, workers):
+    """Splits the text database into n_shards binary databases (once) and returns the manifest."""
+    manifest = read_manifest(n_shards)
+    if manifest is not None:
+        return manifest
+    if not os.path.isfile(database_file):
+        print(f"[Errno 2] No such file or directory: '{database_file}'" + missing_database)
+        sys.exit(0)
+
+    out_dir = shard_dir(n_shards)
+    os.makedirs(out_dir, exist_ok=True)
+    print(f"Converting {database_file} into {n_shards} binary shards in {out_dir}")
+    pir_paths = [os.path.join(out_dir, f"shard_{i:03d}.pir") for i in range(n_shards)]
+    bin_paths = [os.path.join(out_dir, f"shard_{i:03d}.bin") for i in range(n_shards)]
+    split_pir(database_file, pir_paths)
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        sizes = list(pool.map(convert_shard, pir_paths, bin_paths))
+
+    stat = os.stat(database_file)
+    manifest = {
+        'database': os.path.abspath(database_file),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'read_options': read_options,
+        'shards': [os.path.basename(path) for path in bin_paths],
+        'sequences': sizes,
+    }
+    tmp_path = os.path.join(out_dir, f"manifest.json.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(out_dir, 'manifest.json'))
+    return manifest
+
+
+def scan_shard(bin_path, target_files, out_paths, shard_evalue):
+    """Reads one binary shard once and scans it with the profile of every target.
+    Hits are kept up to shard_evalue (the cut-off scaled to the shard's share of the database)."""
+    log.none()
+    env = Environ()
+    sdb = SequenceDB(env)
+    sdb.read(seq_database_file=bin_path, seq_database_format='BINARY', chains_list='ALL')
+    for target_file, out_path in zip(target_files, out_paths):
+        prf = target_profile(env, target_file)
+        prf.build(sdb, max_aln_evalue=shard_evalue, **build_options)
+        prf.write(file=out_path, profile_format='TEXT')
+    return out_paths
+
+
+# === Merging shard profiles ===
+
+def count_entries(pir_path):
+    with open(pir_path) as f:
+        return sum(line.startswith('>') for line in f)
+
+
+def replace_field(line, span, text):
+    """Replaces the field at span, padded to its old width so the columns after it do not move."""
+    start, end = span
+    return line[:start] + text.rjust(end - start) + line[end:]
+
+
+def format_evalue(evalue, width):
+    """E-value in scientific notation, with as many digits as fit in width."""
+    for digits in (2, 1, 0):
+        text = f"{evalue:.{digits}E}"
+        if len(text) <= width:
+            return text
+    return f"{evalue:.0E}"
+
+
+def merge_profiles(shard_paths, shard_sizes, n_target, out_path, evalue_cutoff=max_aln_evalue):
+    """Merges the text profiles of all shards into one: the target sequence(s) once, then every hit
+    ordered by E-value. Each hit's E-value is multiplied by (database size / shard size),
+    which is what a scan of the whole database would report. Returns the number of hits."""
+    total = sum(shard_sizes)
+    header, targets, hits = [], [], []
+    for i, (path, size) in enumerate(zip(shard_paths, shard_sizes)):
+        with open(path) as f:
+            lines = [line.rstrip('\n') for line in f]
+        rows = [line for line in lines if line.strip() and not line.startswith('#')]
+        if i == 0:
+            header = [line for line in lines if line.startswith('#')]
+            targets = rows[:n_target]
+        for row in rows[n_target:]:
+            spans = [match.span() for match in re.finditer(r'\S+', row)]
+            # the last two fields are the E-value and the aligned sequence
+            evalue = float(row[spans[-2][0]:spans[-2][1]]) * total / max(size, 1)
+            if evalue <= evalue_cutoff:
+                hits.append((evalue, row, spans))
+    hits.sort(key=lambda hit: hit[0])
+
+    rows = list(targets)
+    for index, (evalue, row, spans) in enumerate(hits, start=len(targets) + 1):
+        row = replace_field(row, spans[-2], format_evalue(evalue, spans[-2][1] - spans[-2][0]))
+        rows.append(replace_field(row, spans[0], str(index)))
+
+    header = [
+        re.sub(r'(Number of sequences\s*:\s*)(\d+)', lambda m: m.group(1) + str(len(rows)).rjust(len(m.group(2))), line)
+        for line in header
+    ]
+    with open(out_path, 'w') as f:
+        f.write('\n'.join(header + rows) + '\n')
+    return len(hits)
+
+
+def sharded_search(target_files, out_files, n_shards, workers):
+    """Scans every shard for all targets in parallel and writes one merged profile per target."""
+    manifest = convert_database(n_shards, workers)
+    out_dir = shard_dir(n_shards)
+    total = sum(manifest['sequences'])
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = {}
+        for i, (shard, size) in enumerate(zip(manifest['shards'], manifest['sequences'])):
+            shard_outs = [os.path.join(out_dir, f"{os.path.splitext(os.path.basename(t))[0]}.shard{i:03d}.prf")
+                          for t in target_files]
+            shard_evalue = max_aln_evalue * size / max(total, 1)
+            futures[pool.submit(scan_shard, os.path.join(out_dir, shard), target_files, shard_outs, shard_evalue)] = i
+        shard_outs = [None] * len(futures)
+        for future in as_completed(futures):
+            shard_outs[futures[future]] = future.result()
+            print(f"Shard {futures[future] + 1}/{len(futures)} scanned")
+
+    for t, (target_file, out_file) in enumerate(zip(target_files, out_files)):
+        paths = [outs[t] for outs in shard_outs]
+        n_hits = merge_profiles(paths, manifest['sequences'], count_entries(target_file), out_file)
+        for path in paths:
+            os.remove(path)
+        print(f"{target_file}: {n_hits} hits in {total} sequences written to {out_file}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profile search of the PDB 95 database.")
+    parser.add_argument('--targets', nargs='+', default=['1fdx.chn'], help="Target sequences in PIR format")
+    parser.add_argument('--out', help="Output profile (one target only, default search.prf)")
+    parser.add_argument('--shards', type=int, default=0,
+                        help="Scan the database as this many cached binary shards in parallel (0: single text scan)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Worker processes for --shards")
+    args = parser.parse_args(argv)
+
+    if len(args.targets) == 1:
+        out_files = [args.out or 'search.prf']
+    elif args.out:
+        parser.error("--out needs a single target")
+    else:
+        out_files = [f"{os.path.splitext(os.path.basename(t))[0]}_search.prf" for t in args.targets]
+
+    log.verbose()
+    if args.shards > 0:
+        sharded_search(args.targets, out_files, args.shards, min(args.workers, args.shards))
+    else:
+        for target_file, out_file in zip(args.targets, out_files):
+            search(target_file, out_file)
+    return 0
 
-# Scan sequence database to pick up homologous sequences
-prf.build(sdb, matrix_offset=-450, rr_file='${LIB}/blosum62.sim.mat',
-          gap_penalties_1d=(-500, -50), n_prof_iterations=1,
-          check_profile=False, max_aln_evalue=0.01)
 
-# Write out the profile in text format
-prf.write(file='search.prf', profile_format='TEXT')
+if __name__ == '__main__':
+    raise SystemExit(main())
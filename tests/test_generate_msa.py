@@ -0,0 +1,91 @@
+# Tests generate_msa.run_msa_jobs() with a stub aligner (a small Python script) in place of clustalo.
+#
+# Usage (from the repository root):
+#   python -m pytest tests
+
+import os
+import sys
+import textwrap
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "Scripts"))
+
+import generate_msa  # noqa: E402
+
+# Behaves by the first line of its input: "fail" exits with an error, "slow" prints and hangs,
+# anything else is copied to the output. Every run records how many stub jobs were running at its start.
+stub_aligner = textwrap.dedent("""
+    import os, sys, time
+    args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+    running = os.environ["STUB_RUNNING_DIR"]
+    marker = os.path.join(running, str(os.getpid()))
+    open(marker, "w").close()
+    with open(os.path.join(running, "..", "counts.txt"), "a") as f:
+        f.write(f"{len(os.listdir(running))}\\n")
+    try:
+        with open(args["-i"]) as f:
+            text = f.read()
+        if text.startswith("fail"):
+            print("stub: bad input", file=sys.stderr)
+            sys.exit(2)
+        if text.startswith("slow"):
+            print("stub: still aligning", file=sys.stderr, flush=True)
+            time.sleep(60)
+        time.sleep(0.3)
+        with open(args["-o"], "w") as f:
+            f.write(text)
+    finally:
+        os.remove(marker)
+""")
+
+
+def make_jobs(tmp_path, contents: dict) -> list:
+    jobs = []
+    for name, text in contents.items():
+        fasta = tmp_path / f"{name}.fasta"
+        fasta.write_text(text)
+        jobs.append({"label": name, "chain": "light", "input": str(fasta), "output": str(tmp_path / f"{name}.aln-clustal")})
+    return jobs
+
+
+def run(tmp_path, monkeypatch, contents: dict, max_concurrent: int = 2, timeout: float = 10):
+    stub = tmp_path / "stub_aligner.py"
+    stub.write_text(stub_aligner)
+    (tmp_path / "running").mkdir()
+    monkeypatch.setenv("STUB_RUNNING_DIR", str(tmp_path / "running"))
+    command = [sys.executable, str(stub), "-i", "{input}", "-o", "{output}"]
+    jobs = make_jobs(tmp_path, contents)
+    return {result["label"]: result for result in generate_msa.run_msa_jobs(jobs, max_concurrent, timeout, command)}
+
+
+def test_ok_failed_and_timeout(tmp_path, monkeypatch):
+    results = run(tmp_path, monkeypatch, {"good": ">a\nACDE\n", "bad": "fail\n", "hung": "slow\n"}, timeout=3)
+
+    assert results["good"]["status"] == "ok"
+    assert results["good"]["returncode"] == 0
+    assert (tmp_path / "good.aln-clustal").read_text() == ">a\nACDE\n"
+
+    assert results["bad"]["status"] == "failed"
+    assert results["bad"]["returncode"] == 2
+    assert "stub: bad input" in results["bad"]["stderr"]
+    assert not (tmp_path / "bad.aln-clustal").exists()
+
+    # killed on timeout, with the stderr it wrote before the kill
+    assert results["hung"]["status"] == "timeout"
+    assert "stub: still aligning" in results["hung"]["stderr"]
+    assert not (tmp_path / "hung.aln-clustal").exists()
+    assert not any(name.endswith(".tmp") for name in os.listdir(tmp_path))
+
+
+def test_missing_aligner(tmp_path):
+    jobs = make_jobs(tmp_path, {"good": ">a\nACDE\n"})
+    results = generate_msa.run_msa_jobs(jobs, 1, 10, [str(tmp_path / "no_such_aligner"), "{input}", "{output}"])
+    assert results[0]["status"] == "error"
+
+
+def test_concurrency_limit(tmp_path, monkeypatch):
+    results = run(tmp_path, monkeypatch, {f"job{i}": ">a\nACDE\n" for i in range(6)}, max_concurrent=2)
+
+    assert all(result["status"] == "ok" for result in results.values())
+    counts = [int(line) for line in (tmp_path / "counts.txt").read_text().split()]
+    assert len(counts) == 6
+    assert max(counts) <= 2